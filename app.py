@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, abort, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, jsonify, abort, flash, send_file, g, has_request_context, make_response, stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 import datetime
 import boto3
@@ -6,7 +6,7 @@ from datetime import datetime, timedelta, timezone, date
 from calendar import monthrange
 from dotenv import load_dotenv
 from functools import wraps
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, DeleteMany, UpdateMany, UpdateOne
 from bson.objectid import ObjectId
 import pandas as pd
 from io import BytesIO
@@ -17,7 +17,16 @@ from werkzeug.security import generate_password_hash, check_password_hash
 import time
 import uuid
 import json
+import hashlib
+import threading
+from collections import Counter
 from io import BytesIO
+from matriz_estados import MatrizEstados
+from cache_eventos import ContadorVersion, DiarioCambios, NotificadorCambios, crear_cache
+from compresion import GzipEnStreaming, comprimir, deflate_bloque, elegir_codificacion
+from indices import INDICES, asegurar_indices, diagnosticar_consultas
+from campos_fecha import campos_fecha, clave_unica, etapa_dias
+from tramos_eventos import a_fecha, dias_entre, dias_evento, expandir, planificar, recortar, tramos
 
 # Cargar variables de entorno
 load_dotenv()
@@ -31,13 +40,35 @@ db = client["calendario"]
 users_collection = db["usuarios"]
 events_collection = db["eventos"]
 historial_collection = db["historial_conversaciones"]
+metadata_collection = db["metadata"]
+cambios_collection = db["cambios_datos"]
 
 ruta_faqs = "faqs_generadas.json"
 
 # 🔹 Sistema de caché mejorado para eventos
-events_cache = {}
+# CACHE_BACKEND=sqlite comparte las entradas entre todos los workers de la máquina
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memoria")
 CACHE_DURATION = 60  # 1 minuto en segundos (más corto para datos críticos)
-last_data_modification = time.time()  # Timestamp de la última modificación de datos
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_MB", "64")) * 1024 * 1024  # Límite de memoria del caché
+events_cache = crear_cache(CACHE_BACKEND, os.getenv("CACHE_SQLITE_PATH"), CACHE_MAX_BYTES, CACHE_DURATION)
+# Versión de datos compartida por todos los procesos (documento "data_version" en Mongo)
+version_datos = ContadorVersion(metadata_collection, "data_version")
+version_datos_local = None  # Última versión compartida que ha visto este proceso
+# Peticiones y el hilo de precalentado sincronizan a la vez: comparar, aplicar y asignar juntos
+sincronizacion_lock = threading.RLock()
+SINCRONIZACION_INTERVALO = 0.25  # Segundos entre lecturas de la versión desde las peticiones
+ultima_sincronizacion = 0.0  # time.monotonic() de la última lectura de la versión
+# Diario de qué trabajadores/fechas cambió cada versión; caduca al día (índice TTL en indices.py)
+diario_cambios = DiarioCambios(cambios_collection)
+# 🔹 Aviso de cambios a los calendarios abiertos (Server-Sent Events)
+notificador_cambios = NotificadorCambios(version_datos, diario_cambios)
+SSE_LATIDO = 15  # Segundos entre comentarios de keep-alive
+SSE_DURACION = 300  # El navegador reconecta solo (con Last-Event-ID) al cerrar el stream
+# Cada stream abierto ocupa un hilo del worker: como mucho SSE_MAX_CONEXIONES por proceso para
+# que queden hilos libres para el resto de peticiones (debe ser menor que --threads de gunicorn)
+SSE_MAX_CONEXIONES = int(os.getenv("SSE_MAX_CONEXIONES", "4"))
+SSE_REINTENTO_LLENO = 60  # Segundos que espera el navegador antes de reintentar si no hay hueco
+conexiones_sse = threading.BoundedSemaphore(SSE_MAX_CONEXIONES)
 
 DEMO_ADMIN_USERS = {"admin"}
 
@@ -50,13 +81,35 @@ def is_demo_admin_user():
         return False
 
 
+# Mapas de alias anónimos por valor de visible_only: (id_map, fullname_map). Se vacía
+# cuando cambia la colección de usuarios (en este proceso o, vía diario, en otro worker)
+ANONYMIZED_LABELS_CACHE = {}
+
+
+def invalidar_etiquetas_anonimas():
+    ANONYMIZED_LABELS_CACHE.clear()
+
+
 def build_anonymized_label_map(visible_only=True, include_fullname_map=False):
     """Generate deterministic masked labels for users.
 
     Args:
         visible_only: cuando es True solo considera usuarios visibles en calendario.
         include_fullname_map: devuelve un segundo diccionario {nombre completo: alias}.
+
+    Los mapas se cachean hasta el siguiente cambio de usuarios; no deben modificarse.
     """
+    cached = ANONYMIZED_LABELS_CACHE.get(visible_only)
+    if cached is None:
+        cached = _construir_mapas_anonimos(visible_only)
+        ANONYMIZED_LABELS_CACHE[visible_only] = cached
+    id_map, fullname_map = cached
+    if include_fullname_map:
+        return id_map, fullname_map
+    return id_map
+
+
+def _construir_mapas_anonimos(visible_only):
     query = {"visible_calendario": {"$ne": False}} if visible_only else {}
     usuarios = list(
         users_collection.find(
@@ -73,9 +126,7 @@ def build_anonymized_label_map(visible_only=True, include_fullname_map=False):
         fullname = f"{usuario.get('nombre', '')} {usuario.get('apellidos', '')}".strip()
         if fullname:
             fullname_map[fullname] = label
-    if include_fullname_map:
-        return id_map, fullname_map
-    return id_map
+    return id_map, fullname_map
 
 
 def get_display_name_for_user(usuario, anonymized_labels=None):
@@ -99,81 +150,172 @@ def resolve_persona_nombre(persona_param):
     return persona_param
 
 
-def get_cache_key(estados_filtro, persona_filtro, rol_filtro, busqueda):
-    """Genera una clave única para el caché basada en los filtros"""
-    return f"{sorted(estados_filtro)}_{persona_filtro}_{rol_filtro}_{busqueda}"
-
-def is_cache_valid(cache_entry):
-    """Verifica si una entrada del caché sigue siendo válida"""
-    current_time = time.time()
-    # El caché es válido si:
-    # 1. No ha expirado por tiempo
-    # 2. No se han modificado datos desde que se creó
-    return (current_time - cache_entry['timestamp'] < CACHE_DURATION and 
-            cache_entry['timestamp'] > last_data_modification)
-
-def invalidate_cache():
-    """Invalida todo el caché cuando se modifican datos críticos"""
-    global last_data_modification
-    last_data_modification = time.time()
-    events_cache.clear()
-    global DUPLICATES_CACHE
-    DUPLICATES_CACHE = None
-    print("🗑️ Caché invalidado por modificación de datos")
+def get_cache_key(estados_filtro, usuarios_ids, anonimizado, fecha_inicio, fecha_fin, formato="completo"):
+    """Genera la clave del caché a partir del resultado de los filtros y el rango visible.
 
-# Cache para la alerta de duplicados (True/False)
-DUPLICATES_CACHE = None
+    Persona, rol y búsqueda sólo deciden qué usuarios se muestran, así que la clave usa la
+    lista resultante de ids: combinaciones de filtros equivalentes comparten una entrada.
+    """
+    estados = sorted(set(estados_filtro))
+    if set(estados) >= set(ESTADOS_CALENDARIO):
+        estados = []  # Marcar todos los estados equivale a no filtrar
+    base = json.dumps([estados, list(usuarios_ids), int(anonimizado), fecha_inicio, fecha_fin, formato])
+    return "segmento:" + hashlib.sha1(base.encode("utf-8")).hexdigest()
+
+def mes_de_fecha(fecha_valor):
+    """'YYYY-MM' de una fecha (string, date o datetime); None si no hay fecha."""
+    return normalizar_fecha_str(fecha_valor)[:7] if fecha_valor else None
+
+def aplicar_cambio_local(version, trabajadores=None, fecha_inicio=None, fecha_fin=None):
+    """Actualiza el estado de este proceso tras un cambio escrito por otro worker."""
+    if trabajadores is not None and not all(ObjectId.is_valid(t) for t in trabajadores):
+        trabajadores = None  # Entrada del diario escrita con nombres, anterior a user_id
+    matriz_estados.recargar(trabajadores, fecha_inicio, fecha_fin)
+    if not events_cache.compartida:
+        events_cache.invalidar(version, trabajadores, mes_de_fecha(fecha_inicio), mes_de_fecha(fecha_fin))
+
+def sincronizar_version_datos(max_antiguedad=0):
+    """Lee la versión de datos compartida y aplica los cambios que hayan escrito otros procesos.
+
+    Si el diario tiene todas las versiones intermedias sólo se recalculan las celdas y los
+    segmentos afectados; si falta alguna se descarta todo el estado local. Con `max_antiguedad`
+    (segundos) se reutiliza la última versión leída si no es más antigua que eso.
+    """
+    global version_datos_local, ultima_sincronizacion
+    with sincronizacion_lock:
+        ahora = time.monotonic()
+        if version_datos_local is not None and ahora - ultima_sincronizacion < max_antiguedad:
+            if has_request_context():
+                g.version_datos = version_datos_local
+            return version_datos_local
+        version = version_datos.actual()
+        ultima_sincronizacion = ahora
+        if version != version_datos_local:
+            if version_datos_local is not None:
+                cambios = diario_cambios.entre(version_datos_local, version)
+                if version > version_datos_local and len(cambios) == version - version_datos_local:
+                    for cambio in cambios:
+                        aplicar_cambio_local(
+                            cambio["_id"], cambio.get("trabajadores"), cambio.get("fecha_inicio"), cambio.get("fecha_fin")
+                        )
+                        if cambio.get("usuarios"):
+                            invalidar_etiquetas_anonimas()
+                            invalidar_usuario_cache()
+                else:
+                    invalidar_etiquetas_anonimas()
+                    invalidar_usuario_cache()
+                    matriz_estados.marcar_obsoleta()
+                    if not events_cache.compartida:
+                        events_cache.clear(version)
+                if not events_cache.compartida:
+                    programar_calentado()  # Con caché por proceso cada worker calienta el suyo
+            version_datos_local = version
+    if has_request_context():
+        g.version_datos = version
+    return version
+
+def obtener_version_datos():
+    """Versión de datos vigente para la petición actual (se lee una sola vez por petición)."""
+    if has_request_context() and "version_datos" in g:
+        return g.version_datos
+    return sincronizar_version_datos()
+
+def invalidate_cache(trabajadores=None, fecha_inicio=None, fecha_fin=None, cambio_usuarios=False):
+    """Invalida el caché en todos los workers incrementando la versión compartida.
+
+    Con trabajadores y/o fechas sólo se descartan los segmentos de esos meses que
+    incluyen a alguno de esos trabajadores; sin argumentos se descarta todo.
+    `cambio_usuarios` marca escrituras en la colección de usuarios (alias anónimos).
+    """
+    global version_datos_local, ultima_sincronizacion
+    if trabajadores is not None:
+        trabajadores = sorted({str(t) for t in trabajadores if t})
+    fecha_inicio = normalizar_fecha_str(fecha_inicio) if fecha_inicio else None
+    fecha_fin = normalizar_fecha_str(fecha_fin) if fecha_fin else None
+    if fecha_inicio and fecha_fin and fecha_fin < fecha_inicio:
+        fecha_inicio, fecha_fin = fecha_fin, fecha_inicio
+
+    nueva_version = version_datos.incrementar()
+    diario_cambios.registrar(nueva_version, trabajadores, fecha_inicio, fecha_fin, cambio_usuarios)
+    if cambio_usuarios:
+        invalidar_etiquetas_anonimas()
+        invalidar_usuario_cache()
+    with sincronizacion_lock:
+        if version_datos_local == nueva_version - 1:
+            # Ningún otro proceso ha escrito desde la última sincronización: el estado local sigue al día
+            version_datos_local = nueva_version
+        else:
+            ultima_sincronizacion = 0.0  # La siguiente petición lee la versión y aplica lo que falte
+    if has_request_context():
+        g.pop("version_datos", None)
+    if trabajadores is None and fecha_inicio is None and fecha_fin is None:
+        events_cache.clear(nueva_version)
+    else:
+        events_cache.invalidar(nueva_version, trabajadores, mes_de_fecha(fecha_inicio), mes_de_fecha(fecha_fin))
+    print(f"🗑️ Caché invalidado por modificación de datos (trabajadores={trabajadores}, {fecha_inicio} -> {fecha_fin})")
+    programar_calentado()
+
+
+# 🔹 Precalentado: tras una escritura se reconstruyen en segundo plano los segmentos más pedidos
+CALENTADO_MAX_SEGMENTOS = 40
+CALENTADO_RETARDO = 1.0  # Segundos sin escrituras antes de calentar (agrupa ráfagas)
+CALENTADO_MAX_RECETAS = 2000
+uso_segmentos = Counter()  # receta del segmento -> número de peticiones
+uso_segmentos_lock = threading.Lock()
+temporizador_calentado = None
+
+def registrar_uso_segmento(receta):
+    """Cuenta una petición de un segmento; al crecer demasiado se reducen a la mitad (olvido gradual)."""
+    global uso_segmentos
+    with uso_segmentos_lock:
+        uso_segmentos[receta] += 1
+        if len(uso_segmentos) > CALENTADO_MAX_RECETAS:
+            uso_segmentos = Counter({r: n // 2 for r, n in uso_segmentos.items() if n > 1})
+
+def programar_calentado():
+    """Lanza el precalentado cuando pasan CALENTADO_RETARDO segundos sin nuevas escrituras."""
+    global temporizador_calentado
+    with uso_segmentos_lock:
+        if not uso_segmentos:
+            return
+        if temporizador_calentado is not None:
+            temporizador_calentado.cancel()
+        temporizador_calentado = threading.Timer(CALENTADO_RETARDO, calentar_cache)
+        temporizador_calentado.daemon = True
+        temporizador_calentado.start()
+
+def calentar_cache():
+    """Reconstruye los segmentos más pedidos que no estén en caché."""
+    with uso_segmentos_lock:
+        recetas = [receta for receta, _ in uso_segmentos.most_common(CALENTADO_MAX_SEGMENTOS)]
+    version = sincronizar_version_datos()
+    usuarios_por_filtro = {}
+    inicio = time.time()
+    for receta in recetas:
+        rol_filtro, persona_nombre, busqueda, demo_admin_mode, estados, formato, segmento_inicio, segmento_fin = receta
+        try:
+            filtro = (rol_filtro, persona_nombre, busqueda, demo_admin_mode)
+            if filtro not in usuarios_por_filtro:
+                usuarios_por_filtro[filtro] = obtener_usuarios_calendario(*filtro)
+            obtener_segmento_eventos(
+                formato, usuarios_por_filtro[filtro], list(estados), demo_admin_mode,
+                segmento_inicio, segmento_fin, version
+            )
+        except Exception as e:
+            print(f"⚠️ Error precalentando caché: {e}")
+    print(f"🔥 Caché precalentado: {len(recetas)} segmentos en {time.time() - inicio:.2f}s")
 
 def check_duplicates_cached():
-    """Verifica si existen duplicados, usando caché para evitar carga DB."""
-    global DUPLICATES_CACHE
-    
-    if DUPLICATES_CACHE is not None:
-        return DUPLICATES_CACHE
+    """Verifica si hay trabajadores con más de un estado el mismo día hábil.
 
-    # Pipeline optimizado para detección rápida (limit 1)
-    pipeline = [
-        {"$addFields": {"_fechaDate": {"$toDate": "$fecha_inicio"}}},
-        {"$match": {"$expr": {"$not": {"$in": [{"$isoDayOfWeek": "$_fechaDate"}, [6, 7]]}}}},
-        {
-            "$match": {
-                "$expr": {
-                    "$not": {
-                        "$in": [
-                            {"$dateToString": {"format": "%Y-%m-%d", "date": "$_fechaDate"}},
-                            FESTIVOS_LIST
-                        ]
-                    }
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "trabajador": "$trabajador",
-                    "fecha_inicio": "$fecha_inicio",
-                    "fecha_fin": "$fecha_fin"
-                },
-                "count": {"$sum": 1}
-            }
-        },
-        {
-            "$match": {
-                "count": {"$gt": 1}
-            }
-        },
-        {"$limit": 1}
-    ]
-    
+    Se lee de la matriz de estados, que ya se mantiene al día en cada escritura, así que no
+    hace falta recorrer la colección ni guardar el resultado aparte.
+    """
     try:
-        # Si la agregación devuelve al menos un resultado, hay duplicados
-        result = list(events_collection.aggregate(pipeline))
-        DUPLICATES_CACHE = len(result) > 0
+        return matriz_estados.hay_conflictos()
     except Exception as e:
         print(f"Error checking duplicates: {e}")
-        DUPLICATES_CACHE = False
-        
-    return DUPLICATES_CACHE
+        return False
 
 # Lista de festivos utilizados en la aplicación
 FESTIVOS = {
@@ -232,40 +374,523 @@ def normalizar_fecha_str(fecha_valor):
     return str(fecha_valor)
 
 
-def limpiar_vacaciones_duplicadas(trabajador):
-    """Elimina duplicados exactos (mismo día) para un trabajador manteniendo un único registro."""
-    cursor = events_collection.find(
-        {"trabajador": trabajador, "tipo": "Vacaciones"},
-        sort=[("fecha_inicio", ASCENDING), ("_id", ASCENDING)]
-    )
-    vistos = set()
+# Rango completo del calendario (se usa cuando el cliente no indica ventana)
+CALENDARIO_INICIO = date(2025, 1, 1)
+CALENDARIO_FIN = date(2028, 1, 15)
+
+
+def resolver_rango_calendario(start_raw, end_raw):
+    """Convierte los parámetros start/end de FullCalendar en un rango cerrado de fechas.
+
+    FullCalendar envía `end` como límite exclusivo, así que se resta un día. Si falta
+    algún extremo se usa el del rango completo del calendario.
+    """
+    fecha_inicio = _parse_metrics_date(start_raw) or CALENDARIO_INICIO
+    fecha_fin = _parse_metrics_date(end_raw)
+    if fecha_fin is None:
+        fecha_fin = CALENDARIO_FIN
+    else:
+        fecha_fin -= timedelta(days=1)
+    if fecha_fin < fecha_inicio:
+        fecha_fin = fecha_inicio
+    return fecha_inicio, fecha_fin
+
+
+def dividir_en_meses(fecha_inicio, fecha_fin):
+    """Trocea un rango cerrado de fechas en tramos que no cruzan de mes."""
+    tramos = []
+    actual = fecha_inicio
+    while actual <= fecha_fin:
+        fin_mes = date(actual.year, actual.month, monthrange(actual.year, actual.month)[1])
+        tramos.append((actual, min(fin_mes, fecha_fin)))
+        actual = fin_mes + timedelta(days=1)
+    return tramos
+
+
+# Orden de prioridad cuando un trabajador tiene varios estados el mismo día
+PRIORIDAD_ESTADOS = ["Ausencia", "Baja", "CADE 30", "CADE 50", "CADE Tardes", "Guardia CADE", "Refuerzo Cade", "Mail", "Vacaciones"]
+# Valores de estado que ve el frontend (Vacaciones se muestra como Ausente)
+ESTADOS_CALENDARIO = ["PIAS"] + ["Ausente" if tipo == "Vacaciones" else tipo for tipo in PRIORIDAD_ESTADOS]
+# Etiqueta y color con que se pinta cada estado en el calendario
+ESTILO_ESTADOS = {
+    "Vacaciones": ("Ausente", "#E53935"),  # Rojo brillante
+    "Ausencia": ("Ausente", "#757575"),  # Gris medio
+    "Baja": ("Baja", "#757575"),  # Gris medio
+    "CADE 30": ("CADE 30", "#FB8C00"),  # Naranja fuerte
+    "CADE 50": ("CADE 50", "#FDD835"),  # Amarillo brillante
+    "CADE Tardes": ("CADE Tardes", "#F6AE2D"),  # Dorado/miel vibrante
+    "Guardia CADE": ("Guardia CADE", "#49A275"),  # Verde oscuro
+    "Refuerzo Cade": ("Refuerzo Cade", "#FCF2B1"),  # Amarillo clarito
+    "Mail": ("Mail", "#8D6E63"),  # Marrón rosado apagado
+}
+# Tabla de estados del formato compacto: [valor, etiqueta, color]; el índice 0 (PIAS) usa el color del puesto
+ESTADOS_TABLA_COMPACTA = [["PIAS", None, None]] + [
+    [ESTADOS_CALENDARIO[idx + 1]] + list(ESTILO_ESTADOS[tipo]) for idx, tipo in enumerate(PRIORIDAD_ESTADOS)
+]
+# Orden y color de cada puesto en el calendario
+ORDEN_PUESTOS = {"Administrador/a": 1, "ADM": 2, "TS": 3}
+COLORES_PUESTOS = {
+    "Administrador/a": "#9932CC",
+    "ADM": "#B0FFB0",
+    "TS": "#A3C4FF"
+}
+
+
+def obtener_usuarios_calendario(rol_filtro, persona_nombre, busqueda, demo_admin_mode):
+    """Usuarios visibles que pasan los filtros del calendario, ordenados por puesto."""
+    anonymized_labels = build_anonymized_label_map() if demo_admin_mode else None
+
+    usuarios_query = {"visible_calendario": {"$ne": False}}
+    if rol_filtro != 'todos':
+        usuarios_query["puesto"] = rol_filtro
+
+    usuarios = list(users_collection.find(usuarios_query, {"nombre": 1, "apellidos": 1, "puesto": 1}))
+    for usuario in usuarios:
+        usuario['_id'] = str(usuario['_id'])
+        usuario['nombre_completo'] = f"{usuario.get('nombre', '')} {usuario.get('apellidos', '')}".strip()
+        usuario['display_name'] = get_display_name_for_user(usuario, anonymized_labels)
+    usuarios_ordenados = sorted(usuarios, key=lambda u: ORDEN_PUESTOS.get(u.get('puesto', ''), 4))
+
+    # 🔹 Filtrar usuarios por persona si es necesario
+    if persona_nombre:
+        usuarios_ordenados = [u for u in usuarios_ordenados if u['nombre_completo'] == persona_nombre]
+
+    # 🔹 Filtrar usuarios por búsqueda si es necesario
+    if busqueda:
+        busqueda_lower = busqueda.lower()
+        usuarios_ordenados = [
+            u for u in usuarios_ordenados
+            if busqueda_lower in (u['display_name'] if demo_admin_mode else u['nombre_completo']).lower()
+        ]
+    return usuarios_ordenados
+
+
+def fila_usuario_compacta(usuario):
+    """Entrada de la tabla de usuarios del formato compacto: [id, nombre, puesto, color]."""
+    puesto = usuario.get('puesto', '')
+    return [usuario['_id'], usuario['display_name'], puesto, COLORES_PUESTOS.get(puesto, "#D3D3D3")]
+
+
+# Matriz trabajador x día compartida por el calendario, el cuadrante y las métricas.
+# Las filas van por user_id (en str): renombrar un usuario no toca ni eventos ni matriz.
+matriz_estados = MatrizEstados(
+    events_collection, PRIORIDAD_ESTADOS, es_dia_habil, CALENDARIO_INICIO, CALENDARIO_FIN,
+    campo="user_id", valor_consulta=ObjectId
+)
+
+
+def datos_trabajador(usuario):
+    """Campos que identifican al trabajador de un evento nuevo.
+
+    `user_id` es la referencia que usan todas las lecturas; `trabajador` guarda el nombre
+    en el momento de escribir y es sólo informativo (no se actualiza al renombrar).
+    """
+    if isinstance(usuario, User):
+        return {"trabajador": f"{usuario.nombre} {usuario.apellidos}".strip(), "user_id": ObjectId(usuario.id)}
+    nombre = f"{usuario.get('nombre', '')} {usuario.get('apellidos', '')}".strip()
+    return {"trabajador": nombre, "user_id": ObjectId(usuario["_id"])}
+
+
+def campos_evento(fecha_inicio, fecha_fin=None):
+    """Campos derivados de las fechas (dia_inicio, dia_fin) para un evento nuevo."""
+    return campos_fecha(fecha_inicio, fecha_fin)
+
+
+def nuevo_evento(usuario, fecha_inicio, fecha_fin, tipo):
+    """Documento de evento listo para insertar, con la referencia al usuario y los campos de fecha."""
+    return {
+        **datos_trabajador(usuario),
+        "fecha_inicio": normalizar_fecha_str(fecha_inicio),
+        "fecha_fin": normalizar_fecha_str(fecha_fin),
+        "tipo": tipo,
+        **campos_evento(fecha_inicio, fecha_fin)
+    }
+
+
+def upsert_evento(evento):
+    """Operación idempotente para bulk_write: escribe el evento sobre su clave única.
+
+    Sustituye al tramo guardado que empiece el mismo día y no mira los que lo cubren desde
+    antes, así que sólo sirve para tramos que ya salen de `planificar` (escribir_en_lotes).
+    Los eventos nuevos, también los de un día, se escriben con `escribir_tramos_lote`.
+    """
+    return UpdateOne(clave_unica(evento), {"$set": evento}, upsert=True)
+
+
+def nombres_por_id(query=None):
+    """{str(user_id): nombre completo actual} de los usuarios que cumplen `query`."""
+    return {
+        str(u["_id"]): f"{u.get('nombre', '')} {u.get('apellidos', '')}".strip()
+        for u in users_collection.find(query or {}, {"nombre": 1, "apellidos": 1})
+    }
+
+
+def migrar_user_id():
+    """Rellena `user_id` en los eventos antiguos que sólo tienen el nombre del trabajador.
+
+    Es idempotente: sólo toca eventos sin `user_id`. Los nombres repetidos entre usuarios
+    son ambiguos y se dejan sin migrar. Devuelve (eventos migrados, eventos sin usuario).
+    """
+    if events_collection.find_one({"user_id": {"$exists": False}}, {"_id": 1}) is None:
+        return 0, 0
+    ids_por_nombre = {}
+    repetidos = set()
+    for user_id, nombre in nombres_por_id().items():
+        if nombre in ids_por_nombre:
+            repetidos.add(nombre)
+        ids_por_nombre[nombre] = ObjectId(user_id)
+    for nombre in repetidos:
+        print(f"⚠️ migrar_user_id: nombre repetido entre usuarios, sus eventos no se migran: {nombre}")
+        del ids_por_nombre[nombre]
+
+    operaciones = [
+        UpdateMany({"trabajador": nombre, "user_id": {"$exists": False}}, {"$set": {"user_id": user_id}})
+        for nombre, user_id in ids_por_nombre.items()
+    ]
+    migrados = events_collection.bulk_write(operaciones, ordered=False).modified_count if operaciones else 0
+    huerfanos = events_collection.count_documents({"user_id": {"$exists": False}})
+    if migrados:
+        invalidate_cache()
+    print(f"🔗 Eventos con user_id añadido: {migrados} (sin usuario asociado: {huerfanos})")
+    if huerfanos:
+        print("⚠️ Los eventos sin user_id no aparecen en el calendario: asígnalos en /admin/eventos-sin-usuario")
+    return migrados, huerfanos
+
+
+def eventos_sin_usuario():
+    """Eventos que la migración no pudo asociar, agrupados por el nombre guardado.
+
+    Devuelve [{clave, nombre, count, desde, hasta, candidatos}] donde `candidatos` son los
+    ids de los usuarios que tienen ese nombre (varios = nombre ambiguo, ninguno = usuario
+    borrado o renombrado). `clave` es un hash del nombre para los formularios: el nombre real
+    no sale en la página en modo demo.
+    """
+    pipeline = [
+        {"$match": {"user_id": {"$exists": False}}},
+        {"$group": {
+            "_id": "$trabajador",
+            "count": {"$sum": 1},
+            "desde": {"$min": "$fecha_inicio"},
+            "hasta": {"$max": "$fecha_fin"}
+        }},
+        {"$sort": {"_id": 1}}
+    ]
+    ids_por_nombre = {}
+    for user_id, nombre in nombres_por_id().items():
+        ids_por_nombre.setdefault(nombre, []).append(user_id)
+    return [
+        {"clave": hashlib.sha1(json.dumps(grupo["_id"]).encode("utf-8")).hexdigest()[:16],
+         "nombre": grupo["_id"], "count": grupo["count"], "desde": grupo["desde"],
+         "hasta": grupo["hasta"], "candidatos": ids_por_nombre.get(grupo["_id"], [])}
+        for grupo in events_collection.aggregate(pipeline)
+    ]
+
+
+# Versión de datos en la que se comprobó si quedan eventos sin user_id (aviso del menú de admin)
+_AVISO_SIN_USUARIO = {"version": None, "hay": False}
+
+
+def hay_eventos_sin_usuario():
+    """True si quedan eventos sin user_id; se vuelve a consultar sólo si cambia la versión de datos."""
+    version = obtener_version_datos()
+    if _AVISO_SIN_USUARIO["version"] != version:
+        hay = events_collection.find_one({"user_id": {"$exists": False}}, {"_id": 1}) is not None
+        _AVISO_SIN_USUARIO.update(version=version, hay=hay)
+    return _AVISO_SIN_USUARIO["hay"]
+
+
+def migrar_campos_fecha():
+    """Rellena dia_inicio/dia_fin en los eventos que no los tienen.
+
+    Quita también `es_habil` y `semana_iso` de los eventos que los guardaron (ya no los lee
+    nada). Devuelve (rellenados, limpiados).
+    """
+    rellenados = events_collection.update_many(
+        {"dia_inicio": {"$exists": False}}, [etapa_dias()]
+    ).modified_count
+    limpiados = events_collection.update_many(
+        {"$or": [{"es_habil": {"$exists": True}}, {"semana_iso": {"$exists": True}}]},
+        {"$unset": {"es_habil": "", "semana_iso": ""}}
+    ).modified_count
+    if rellenados or limpiados:
+        print(f"📅 Campos de fecha: {rellenados} eventos rellenados, {limpiados} sin es_habil/semana_iso")
+    return rellenados, limpiados
+
+
+def compactar_tramos():
+    """Fusiona los eventos de un día (formato antiguo) en tramos de días consecutivos.
+
+    Agrupa por (user_id, tipo) y reescribe sólo los grupos en los que hay días contiguos
+    o repetidos. Devuelve (documentos borrados, tramos insertados).
+    """
+    eventos = events_collection.find(
+        {"user_id": {"$exists": True}}
+    ).sort([("user_id", ASCENDING), ("tipo", ASCENDING), ("fecha_inicio", ASCENDING)])
+
+    borrados = insertados = 0
+    grupo, clave_grupo = [], None
+
+    def reescribir(grupo):
+        dias = [dia for evento in grupo for dia in dias_evento(evento)]
+        nuevos = [evento_en_tramo(grupo[0], inicio, fin) for inicio, fin in tramos(dias)]
+        if len(nuevos) >= len(grupo):
+            return 0, 0
+        events_collection.bulk_write(
+            [DeleteMany({"_id": {"$in": [evento["_id"] for evento in grupo]}})]
+            + [upsert_evento(nuevo) for nuevo in nuevos]
+        )
+        return len(grupo), len(nuevos)
+
+    for evento in eventos:
+        clave = (evento["user_id"], evento.get("tipo"))
+        if clave != clave_grupo and grupo:
+            b, i = reescribir(grupo)
+            borrados, insertados = borrados + b, insertados + i
+            grupo = []
+        clave_grupo = clave
+        grupo.append(evento)
+    if grupo:
+        b, i = reescribir(grupo)
+        borrados, insertados = borrados + b, insertados + i
+
+    if borrados:
+        registrar_cambio_eventos()
+        print(f"🧱 Tramos: {borrados} eventos fusionados en {insertados} tramos")
+    return borrados, insertados
+
+
+def deduplicar_eventos():
+    """Deja un solo evento por (user_id, dia_inicio, tipo) y crea el índice único si falta.
+
+    De cada grupo se conserva el tramo que llega más lejos (empiezan el mismo día, así que
+    cubre a los demás). Sólo hace algo mientras no exista el índice. Devuelve los borrados.
+    """
+    if "evento_unico" in events_collection.index_information():
+        return 0
+    sobrantes = list(events_collection.aggregate(pipeline_redundantes(), allowDiskUse=True))
+    borrados, _, _ = escribir_en_lotes([s["_id"] for s in sobrantes], [])
+    if borrados:
+        registrar_cambio_eventos()
+        print(f"🧹 Eventos duplicados eliminados antes de crear el índice único: {borrados}")
+    asegurar_indices(db)
+    return borrados
+
+
+def registrar_cambio_eventos(trabajadores=None, fecha_inicio=None, fecha_fin=None):
+    """Punto único de aviso tras escribir eventos.
+
+    `trabajadores` son user_id (ObjectId o str). Recalcula en la matriz sólo las celdas
+    afectadas (None = todos, fechas None = rango abierto) e invalida los cachés derivados.
+    """
+    if trabajadores is not None:
+        trabajadores = {str(t) for t in trabajadores if t}
+    matriz_estados.recargar(trabajadores, fecha_inicio, fecha_fin)
+    invalidate_cache(trabajadores, fecha_inicio, fecha_fin)
+
+
+def evento_en_tramo(evento, inicio, fin):
+    """Copia de un evento (sin _id) restringida al tramo [inicio, fin]."""
+    copia = {k: v for k, v in evento.items() if k != "_id"}
+    copia["fecha_inicio"] = inicio.strftime("%Y-%m-%d")
+    copia["fecha_fin"] = fin.strftime("%Y-%m-%d")
+    copia.update(campos_evento(inicio, fin))
+    return copia
+
+
+# Operaciones por llamada a bulk_write en las escrituras masivas de eventos
+TAMANO_LOTE_ESCRITURA = 1000
+
+
+def escribir_en_lotes(ids_a_borrar, documentos):
+    """Borra `ids_a_borrar` y hace upsert de `documentos` con bulk_write ordenados por lotes.
+
+    Los borrados van antes que los upserts (un tramo puede reescribirse con la misma clave)
+    y cada lote lleva TAMANO_LOTE_ESCRITURA operaciones. Devuelve (borrados, escritos, lotes);
+    `escritos` son los upserts enviados, también los que dejan el documento igual (un tramo
+    borrado y vuelto a escribir con la misma clave no cuenta como modificado en Mongo).
+    """
+    operaciones = [
+        DeleteMany({"_id": {"$in": ids_a_borrar[i:i + TAMANO_LOTE_ESCRITURA]}})
+        for i in range(0, len(ids_a_borrar), TAMANO_LOTE_ESCRITURA)
+    ]
+    operaciones.extend(upsert_evento(documento) for documento in documentos)
+    borrados = lotes = 0
+    for i in range(0, len(operaciones), TAMANO_LOTE_ESCRITURA):
+        resultado = events_collection.bulk_write(operaciones[i:i + TAMANO_LOTE_ESCRITURA], ordered=True)
+        borrados += resultado.deleted_count
+        lotes += 1
+    return borrados, len(documentos), lotes
+
+
+def filtro_solape(desde=None, hasta=None):
+    """Filtro por ordinales de los eventos que solapan con [desde, hasta] ({} = sin límites)."""
+    filtro = {}
+    if hasta is not None:
+        filtro["dia_inicio"] = {"$lte": hasta.toordinal()}
+    if desde is not None:
+        filtro["dia_fin"] = {"$gte": desde.toordinal()}
+    return filtro
+
+
+def rango_formulario(formulario):
+    """(desde, hasta) como date a partir de los campos opcionales del formulario (None si vacíos)."""
+    desde = a_fecha(formulario.get("desde")) if formulario.get("desde") else None
+    hasta = a_fecha(formulario.get("hasta")) if formulario.get("hasta") else None
+    if desde and hasta and hasta < desde:
+        desde, hasta = hasta, desde
+    return desde, hasta
+
+
+def pipeline_redundantes(filtro=None):
+    """Agregación que emite {_id, user_id} de cada evento sobrante con la misma clave única.
+
+    De cada grupo (user_id, dia_inicio, tipo) se conserva el tramo que llega más lejos.
+    """
+    return [
+        {"$match": {"user_id": {"$exists": True}, "dia_inicio": {"$exists": True}, **(filtro or {})}},
+        {"$sort": {"dia_fin": -1}},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "dia_inicio": "$dia_inicio", "tipo": "$tipo"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$unwind": {"path": "$ids", "includeArrayIndex": "posicion"}},
+        {"$match": {"posicion": {"$gt": 0}}},
+        {"$project": {"_id": "$ids", "user_id": "$_id.user_id"}}
+    ]
+
+
+def pipeline_conflictos_vacaciones(filtro=None):
+    """Agregación con los tramos de Vacaciones que solapan con otros eventos del mismo usuario.
+
+    Parte de las vacaciones del rango (índice tipo_dia) y busca los solapes por user_id, que es
+    una igualdad indexada, en lugar de cruzar cada evento que no es de vacaciones. Cada tramo
+    sale con la lista `solapes` de los eventos de otro tipo con los que coincide.
+    El `$lookup` usa `let` + `$expr` con `$eq` (sin localField/foreignField junto a `pipeline`,
+    que exige MongoDB 5.0).
+    """
+    return [
+        {"$match": {"tipo": "Vacaciones", "user_id": {"$exists": True},
+                    "dia_inicio": {"$exists": True}, **(filtro or {})}},
+        {"$project": {"user_id": 1, "fecha_inicio": 1, "fecha_fin": 1, "dia_inicio": 1, "dia_fin": 1}},
+        {"$lookup": {
+            "from": events_collection.name,
+            "let": {"user_id": "$user_id", "inicio": "$dia_inicio", "fin": "$dia_fin"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
+                {"$match": {"tipo": {"$ne": "Vacaciones"}}},
+                {"$match": {"$expr": {"$and": [
+                    {"$lte": ["$dia_inicio", "$$fin"]},
+                    {"$gte": ["$dia_fin", "$$inicio"]}
+                ]}}}
+            ],
+            "as": "solapes"
+        }},
+        {"$match": {"solapes.0": {"$exists": True}}}
+    ]
+
+
+def escribir_tramos_lote(cambios):
+    """Aplica cambios de tramos de varios usuarios con una sola lectura y bulk_write por lotes.
+
+    Cada cambio es (usuario, tipo, dias, tipos_a_quitar, dias_a_quitar), como en
+    `escribir_tramos`. Un usuario puede aparecer en varios cambios si no comparten ningún tipo
+    (a poner ni a quitar): todos se planifican sobre la misma lectura. Sólo se escribe la diferencia con
+    lo guardado (ver `planificar`); si no hay nada que cambiar no hay bulk_write. Todos los borrados van antes que
+    los upserts (un tramo puede reescribirse con la misma clave) en lotes ordenados de
+    TAMANO_LOTE_ESCRITURA operaciones. Devuelve un resumen con trabajadores, tramos borrados,
+    tramos escritos (upserts enviados) y lotes enviados.
+    """
+    planes = []
+    for usuario, tipo, dias, tipos_a_quitar, dias_a_quitar in cambios:
+        dias = set(dias) if tipo else set()
+        quitar = set(dias_a_quitar)
+        tipos_a_quitar = set(tipos_a_quitar)
+        tipos = tipos_a_quitar | ({tipo} if dias else set())
+        afectados = dias | quitar
+        if afectados and tipos:
+            # +-1 día: también se leen los tramos contiguos para fusionarlos
+            ventana = (min(afectados) - timedelta(days=1), max(afectados) + timedelta(days=1))
+            planes.append((usuario, datos_trabajador(usuario)["user_id"], tipo, dias, tipos_a_quitar, quitar, tipos, ventana))
+
+    resumen = {"trabajadores": len({str(plan[1]) for plan in planes}), "borrados": 0, "escritos": 0, "lotes": 0}
+    if not planes:
+        return resumen
+
+    eventos_por_usuario = {}
+    for evento in events_collection.find({
+        "user_id": {"$in": [plan[1] for plan in planes]},
+        "tipo": {"$in": sorted(set().union(*(plan[6] for plan in planes)))},
+        "fecha_inicio": {"$lte": max(plan[7][1] for plan in planes).strftime("%Y-%m-%d")},
+        "fecha_fin": {"$gte": min(plan[7][0] for plan in planes).strftime("%Y-%m-%d")}
+    }):
+        eventos_por_usuario.setdefault(str(evento["user_id"]), []).append(evento)
+
     ids_a_borrar = []
-    for vacacion in cursor:
-        inicio = normalizar_fecha_str(vacacion.get("fecha_inicio"))
-        fin = normalizar_fecha_str(vacacion.get("fecha_fin"))
-        clave = (inicio, fin)
-        if clave in vistos:
-            ids_a_borrar.append(vacacion["_id"])
-        else:
-            vistos.add(clave)
-    if ids_a_borrar:
-        events_collection.delete_many({"_id": {"$in": ids_a_borrar}})
-        invalidate_cache()  # Invalidar caché al limpiar duplicados
+    documentos = []
+    for usuario, user_id, tipo, dias, tipos_a_quitar, quitar, tipos, (desde, hasta) in planes:
+        propios = [
+            evento for evento in eventos_por_usuario.get(str(user_id), [])
+            if evento["tipo"] in tipos and any(desde <= dia <= hasta for dia in dias_evento(evento))
+        ]
+        ids, restos, nuevos = planificar(propios, tipo, dias, tipos_a_quitar, quitar)
+        ids_a_borrar.extend(ids)
+        documentos.extend(evento_en_tramo(evento, inicio, fin) for evento, inicio, fin in restos)
+        documentos.extend(nuevo_evento(usuario, inicio, fin, tipo) for inicio, fin in nuevos)
 
+    resumen["borrados"], resumen["escritos"], resumen["lotes"] = escribir_en_lotes(ids_a_borrar, documentos)
+    return resumen
 
-def filtrar_vacaciones_unicas(vacaciones):
-    """Devuelve sólo un registro por día para evitar duplicados en memoria."""
-    resultado = []
-    vistos = set()
-    for vacacion in vacaciones:
-        inicio = normalizar_fecha_str(vacacion.get("fecha_inicio"))
-        fin = normalizar_fecha_str(vacacion.get("fecha_fin"))
-        clave = (inicio, fin)
-        if clave in vistos:
-            continue
-        vistos.add(clave)
-        resultado.append(vacacion)
-    return resultado
+
+def escribir_tramos(usuario, tipo, dias, tipos_a_quitar=(), dias_a_quitar=()):
+    """Pone `tipo` en `dias` para el usuario guardándolo como tramos de días consecutivos.
+
+    Antes quita `dias_a_quitar` de sus eventos de `tipos_a_quitar`, partiendo los tramos que
+    los contienen, y fusiona los días nuevos con los tramos de `tipo` que se solapan o son
+    contiguos. Con `tipo=None` sólo quita. Devuelve (tramos borrados, escritos).
+    """
+    resumen = escribir_tramos_lote([(usuario, tipo, dias, tipos_a_quitar, dias_a_quitar)])
+    return resumen["borrados"], resumen["escritos"]
+
+
+def cambios_de_eventos(eventos, usuarios):
+    """Agrupa eventos sueltos (user_id, tipo y fechas) en cambios de `escribir_tramos_lote`.
+
+    Sale un cambio por usuario y tipo con todos sus días, así que se fusionan con los tramos
+    guardados en lugar de pisarlos. `usuarios` es {str(user_id): documento del usuario} para
+    el nombre de los tramos nuevos.
+    """
+    dias = {}
+    for evento in eventos:
+        if evento.get("user_id"):
+            clave = (str(evento["user_id"]), evento["tipo"])
+            dias.setdefault(clave, set()).update(dias_evento(evento))
+    return [
+        (usuarios.get(user_id) or {"_id": user_id}, tipo, sorted(dias_tipo), (), ())
+        for (user_id, tipo), dias_tipo in dias.items()
+    ]
+
+
+def mensaje_resumen_escritura(resumen):
+    return (f"✅ {resumen['trabajadores']} trabajadores actualizados: {resumen['escritos']} tramos escritos, "
+            f"{resumen['borrados']} borrados ({resumen['lotes']} lotes)")
+
+
+def vacaciones_por_dia(user_id):
+    """Vacaciones del usuario expandidas a un registro por día hábil, ordenadas.
+
+    Cada registro conserva el `_id` del tramo del que sale para poder borrar ese día.
+    """
+    tramos_vacaciones = events_collection.find(
+        {"user_id": ObjectId(user_id), "tipo": "Vacaciones"},
+        {"fecha_inicio": 1, "fecha_fin": 1}
+    ).sort("fecha_inicio", ASCENDING)
+    return [
+        {"_id": tramo["_id"], "fecha_inicio": datetime.combine(dia, datetime.min.time()),
+         "fecha_fin": datetime.combine(dia, datetime.min.time())}
+        for dia, tramo in expandir(tramos_vacaciones, es_dia_habil)
+    ]
 
 
 VACATION_CYCLES = [
@@ -368,6 +993,148 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
 
+
+@app.cli.command("crear-indices")
+def crear_indices_cli():
+    """Crea los índices del registro que falten (lo mismo que hace cada worker al arrancar)."""
+    asegurar_indices(db)
+    print("📚 Índices comprobados")
+
+
+@app.cli.command("diagnostico-indices")
+def diagnostico_indices():
+    """Muestra qué índice usa cada consulta principal y avisa de los COLLSCAN."""
+    for coleccion, indices in INDICES.items():
+        existentes = sorted(db[coleccion].index_information())
+        print(f"📚 {coleccion}: {', '.join(existentes)}")
+    print()
+    lentas = 0
+    for nombre, coleccion, indices_usados, collscan in diagnosticar_consultas(db):
+        if collscan:
+            lentas += 1
+            print(f"❌ COLLSCAN  {coleccion:<25} {nombre}")
+        else:
+            print(f"✅ {', '.join(indices_usados):<22} {coleccion:<25} {nombre}")
+    print(f"\n{lentas} consultas recorren la colección completa")
+
+
+@app.cli.command("migrar-user-id")
+def migrar_user_id_cli():
+    """Añade user_id a los eventos que sólo tienen el nombre del trabajador."""
+    migrados, huerfanos = migrar_user_id()
+    print(f"{migrados} eventos migrados, {huerfanos} sin usuario asociado")
+
+
+@app.cli.command("migrar-campos-fecha")
+def migrar_campos_fecha_cli():
+    """Rellena dia_inicio/dia_fin en los eventos que no los tienen y quita los campos en desuso."""
+    rellenados, limpiados = migrar_campos_fecha()
+    print(f"{rellenados} eventos rellenados, {limpiados} limpiados de es_habil/semana_iso")
+
+
+@app.cli.command("compactar-tramos")
+def compactar_tramos_cli():
+    """Fusiona los eventos de un día en tramos de días consecutivos (user_id y tipo)."""
+    borrados, insertados = compactar_tramos()
+    print(f"{borrados} eventos fusionados en {insertados} tramos")
+
+
+@app.cli.command("deduplicar-eventos")
+def deduplicar_eventos_cli():
+    """Borra los eventos repetidos por (user_id, dia_inicio, tipo) y crea el índice único."""
+    borrados = deduplicar_eventos()
+    print(f"{borrados} eventos duplicados eliminados")
+
+
+# 🔹 Índices al arrancar: el TTL del diario de cambios y el índice único de eventos no pueden
+# depender de un paso manual. Si ya existen todos sólo se listan (un listIndexes por colección).
+asegurar_indices(db)
+
+
+@app.before_request
+def sincronizar_antes_de_peticion():
+    """Detecta escrituras hechas por otros workers antes de servir la petición.
+
+    La versión se lee de Mongo como mucho una vez cada SINCRONIZACION_INTERVALO por proceso;
+    las escrituras de otros workers se ven con ese retraso máximo.
+    """
+    if request.endpoint != 'static':
+        sincronizar_version_datos(SINCRONIZACION_INTERVALO)
+
+
+def calcular_salt_etag():
+    """Huella del código y las plantillas desplegadas: un despliegue nuevo invalida los ETags."""
+    rutas = [os.path.abspath(__file__)]
+    for raiz, _, ficheros in os.walk(os.path.join(app.root_path, app.template_folder)):
+        rutas.extend(os.path.join(raiz, f) for f in sorted(ficheros))
+    huella = hashlib.sha1()
+    for ruta in rutas:
+        try:
+            huella.update(f"{ruta}:{os.path.getmtime(ruta)}".encode("utf-8"))
+        except OSError:
+            continue
+    return huella.hexdigest()[:12]
+
+ETAG_SALT = calcular_salt_etag()
+
+
+def etag_para(*partes):
+    """ETag fuerte a partir de la versión de datos, el usuario y la clave de los filtros."""
+    usuario = current_user.get_id() if current_user.is_authenticated else None
+    base = json.dumps([ETAG_SALT, obtener_version_datos(), usuario, list(partes)], default=str)
+    return hashlib.sha1(base.encode("utf-8")).hexdigest()
+
+
+def respuesta_no_modificada(etag):
+    """Devuelve un 304 si el cliente ya tiene esa versión (If-None-Match); None en otro caso.
+
+    Cada codificación (gzip, br) tiene su propio ETag fuerte con el sufijo correspondiente.
+    """
+    for variante in [etag] + [f"{etag}-{c}" for c in ("gzip", "br")]:
+        if variante in request.if_none_match:
+            respuesta = con_etag(app.response_class(status=304), variante)
+            respuesta.vary.add("Accept-Encoding")
+            return respuesta
+    return None
+
+
+def con_etag(respuesta, etag):
+    """Añade el ETag y obliga al navegador a revalidar antes de reutilizar la respuesta."""
+    respuesta = make_response(respuesta)
+    respuesta.set_etag(etag)
+    respuesta.headers["Cache-Control"] = "private, no-cache"
+    return respuesta
+
+
+# 🔹 Compresión de respuestas grandes (JSON, HTML, CSV)
+COMPRESION_MIN_BYTES = 1024
+COMPRESION_TIPOS = {"application/json", "text/html", "text/csv", "text/plain", "text/css", "application/javascript"}
+
+
+@app.after_request
+def comprimir_respuesta(respuesta):
+    """Comprime con br/gzip según Accept-Encoding las respuestas de más de COMPRESION_MIN_BYTES.
+
+    Las respuestas en streaming (el calendario) y los ficheros se dejan tal cual: el
+    calendario ya trae sus segmentos comprimidos desde el caché.
+    """
+    if (respuesta.status_code != 200 or respuesta.direct_passthrough or respuesta.is_streamed
+            or "Content-Encoding" in respuesta.headers or respuesta.mimetype not in COMPRESION_TIPOS):
+        return respuesta
+    respuesta.vary.add("Accept-Encoding")
+    datos = respuesta.get_data()
+    if len(datos) < COMPRESION_MIN_BYTES:
+        return respuesta
+    codificacion = elegir_codificacion(request.accept_encodings)
+    if not codificacion:
+        return respuesta
+    respuesta.set_data(comprimir(datos, codificacion))
+    respuesta.headers["Content-Encoding"] = codificacion
+    etag, _ = respuesta.get_etag()
+    if etag:
+        respuesta.set_etag(f"{etag}-{codificacion}")
+    return respuesta
+
 class User(UserMixin):
     def __init__(self, user_data):
         self.id = str(user_data['_id'])
@@ -377,13 +1144,42 @@ class User(UserMixin):
         self.puesto = user_data['puesto']
 
 
+# 🔹 Caché de usuarios de sesión: evita un find_one por petición autenticada
+USER_CACHE_TTL = 30  # segundos
+USER_CACHE_MAX = 1000
+USER_CACHE = {}  # user_id -> (expira, user_data)
+
+
+def invalidar_usuario_cache(user_id=None):
+    """Descarta un usuario del caché de sesión (o todos si no se indica id)."""
+    if user_id is None:
+        USER_CACHE.clear()
+    else:
+        USER_CACHE.pop(str(user_id), None)
+
+
 @login_manager.user_loader
 def load_user(user_id):
     """ Cargar usuario desde MongoDB por ID """
     from bson import ObjectId
+    ahora = time.time()
+    cached = USER_CACHE.get(user_id)
+    if cached and cached[0] > ahora:
+        return User(cached[1])
     try:
-        user_data = users_collection.find_one({"_id": ObjectId(user_id)})
-        return User(user_data) if user_data else None
+        user_data = users_collection.find_one(
+            {"_id": ObjectId(user_id)},
+            {"nombre": 1, "apellidos": 1, "usuario": 1, "puesto": 1}
+        )
+        if not user_data:
+            USER_CACHE.pop(user_id, None)
+            return None
+        if len(USER_CACHE) >= USER_CACHE_MAX:
+            for clave, (expira, _) in list(USER_CACHE.items()):
+                if expira <= ahora:
+                    USER_CACHE.pop(clave, None)
+        USER_CACHE[user_id] = (ahora + USER_CACHE_TTL, user_data)
+        return User(user_data)
     except Exception as e:
         print(f"Error al cargar usuario {user_id}: {e}")
         return None
@@ -440,10 +1236,13 @@ def calendar_page():
     
     # Check for duplicates warning (only for admins)
     duplicates_warning = False
+    orphans_warning = False
     if current_user.puesto == "Administrador/a":
         duplicates_warning = check_duplicates_cached()
+        orphans_warning = hay_eventos_sin_usuario()
         
-    return render_template('index.html', usuarios=usuarios_context, duplicates_warning=duplicates_warning)
+    return render_template('index.html', usuarios=usuarios_context, duplicates_warning=duplicates_warning,
+                           orphans_warning=orphans_warning)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -533,7 +1332,7 @@ def add_user():
         if users_collection.find_one({"usuario": user_data["usuario"]}):
             return "El usuario ya existe", 400
         users_collection.insert_one(user_data)
-        invalidate_cache()  # Invalidar caché al añadir usuario
+        invalidate_cache(cambio_usuarios=True)  # Invalidar caché al añadir usuario
         return redirect('/admin/users')
     return render_template('add_user.html')
 
@@ -574,9 +1373,6 @@ def edit_user(user_id):
             flash('El nombre de usuario ya existe', 'error')
             return render_template('edit_user.html', usuario=usuario_actualizado), 400
 
-        nombre_anterior = f"{usuario['nombre']} {usuario['apellidos']}".strip()
-        nuevo_nombre_completo = f"{nombre} {apellidos}".strip()
-
         users_collection.update_one(
             {"_id": ObjectId(user_id)},
             {"$set": {
@@ -593,13 +1389,9 @@ def edit_user(user_id):
             }}
         )
 
-        if nombre_anterior != nuevo_nombre_completo:
-            events_collection.update_many(
-                {"trabajador": nombre_anterior},
-                {"$set": {"trabajador": nuevo_nombre_completo}}
-            )
-
-        invalidate_cache()  # Invalidar caché al modificar usuario
+        # Los eventos apuntan al usuario por user_id: un renombrado no los toca.
+        # Cambio global: los alias anónimos se asignan por orden alfabético de todos los usuarios
+        invalidate_cache(cambio_usuarios=True)  # Invalidar caché al modificar usuario
         flash('Usuario actualizado correctamente', 'success')
         return redirect(url_for('admin_users'))
 
@@ -621,10 +1413,10 @@ def delete_user(user_id):
     users_collection.delete_one({"_id": ObjectId(user_id)})
 
     # 🔹 Eliminar también los eventos asociados al usuario
-    nombre_completo = f"{usuario['nombre']} {usuario['apellidos']}".strip()
-    result = events_collection.delete_many({"trabajador": nombre_completo})
-    
-    invalidate_cache()  # Invalidar caché al eliminar usuario
+    result = events_collection.delete_many({"user_id": usuario["_id"]})
+
+    matriz_estados.recargar([user_id])
+    invalidate_cache(cambio_usuarios=True)  # Cambio global: desaparece un usuario y se renumeran los alias anónimos
     flash(f"Usuario {usuario['usuario']} eliminado correctamente. Se eliminaron {result.deleted_count} eventos asociados.", "success")
     return redirect('/admin/users')
 
@@ -647,6 +1439,7 @@ def reset_password(user_id):
         return redirect(url_for('reset_passwords'))
     hashed = generate_password_hash(new_password)
     users_collection.update_one({"_id": ObjectId(user_id)}, {"$set": {"password": hashed}})
+    invalidar_usuario_cache(user_id)
     flash("Contraseña actualizada", "success")
     return redirect(url_for('reset_passwords'))
 
@@ -677,6 +1470,7 @@ def cambiar_password():
             {"_id": ObjectId(current_user.id)},
             {"$set": {"password": new_hashed_password}}
         )
+        invalidar_usuario_cache(current_user.id)
         flash("Contraseña actualizada exitosamente", "success")
         return redirect(url_for('dashboard'))
     
@@ -727,11 +1521,19 @@ def admin_skills():
     users = list(users_collection.find(query).sort("nombre", 1))
     return render_template('skills_matrix.html', users=users)
 
+def siguiente_dia_habil(fecha):
+    dia = fecha + timedelta(days=1)
+    while not es_dia_habil(dia):
+        dia += timedelta(days=1)
+    return dia
+
+
 def agrupar_vacaciones(vacaciones):
     """
     Agrupa las vacaciones consecutivas. Se asume que la lista 'vacaciones' está ordenada por 'fecha_inicio'.
     Cada grupo es una lista de vacaciones consecutivas, donde la fecha de inicio de una vacación
-    es exactamente un día después de la fecha de fin de la vacación anterior.
+    es el día hábil siguiente a la fecha de fin de la vacación anterior (los tramos guardados
+    se parten en fines de semana y festivos).
     """
     grupos = []
     grupo_actual = []
@@ -741,7 +1543,7 @@ def agrupar_vacaciones(vacaciones):
         else:
             ultimo = grupo_actual[-1]
             # Comprobamos si la vacación actual es consecutiva con respecto al grupo actual.
-            if vacacion["fecha_inicio"] == ultimo["fecha_fin"] + timedelta(days=1):
+            if vacacion["fecha_inicio"] == siguiente_dia_habil(ultimo["fecha_fin"]):
                 grupo_actual.append(vacacion)
             else:
                 grupos.append(grupo_actual)
@@ -754,57 +1556,18 @@ def agrupar_vacaciones(vacaciones):
 @login_required
 def add_vacation():
     if request.method == 'POST':
-        vacation_data = {
-            "trabajador": f"{current_user.nombre} {current_user.apellidos}",
-            "fecha_inicio": request.form.get('fecha_inicio'),
-            "fecha_fin": request.form.get('fecha_fin'),
-            "tipo": "Vacaciones"
-        }
-        # Convertir las fechas a objetos datetime para iterar día a día
-        fecha_inicio_dt = datetime.strptime(vacation_data["fecha_inicio"], "%Y-%m-%d")
-        fecha_fin_dt = datetime.strptime(vacation_data["fecha_fin"], "%Y-%m-%d")
-        
-        # Insertar un evento por cada día en el rango
-        current_day = fecha_inicio_dt
-        while current_day <= fecha_fin_dt:
-            day_str = current_day.strftime("%Y-%m-%d")
-            event = {
-                "trabajador": vacation_data["trabajador"],
-                "fecha_inicio": day_str,
-                "fecha_fin": day_str,
-                "tipo": "Vacaciones"
-            }
-            query = {
-                "trabajador": vacation_data["trabajador"],
-                "fecha_inicio": day_str,
-                "fecha_fin": day_str,
-                "tipo": "Vacaciones"
-            }
-            existentes = list(events_collection.find(query, {"_id": 1}).sort("_id", ASCENDING))
-            if existentes:
-                ids_sobrantes = [doc["_id"] for doc in existentes[1:]]
-                if ids_sobrantes:
-                    events_collection.delete_many({"_id": {"$in": ids_sobrantes}})
-            else:
-                events_collection.insert_one(event)
-            current_day += timedelta(days=1)
-        limpiar_vacaciones_duplicadas(vacation_data["trabajador"])
-        invalidate_cache()  # Invalidar caché al añadir vacaciones
+        fecha_inicio = request.form.get('fecha_inicio')
+        fecha_fin = request.form.get('fecha_fin')
+        # Un documento por tramo de días hábiles consecutivos, fusionado con las vacaciones contiguas
+        # (una lectura de sus vacaciones cercanas y, si hay diferencias, un único bulk_write)
+        dias = [dia for dia in dias_entre(fecha_inicio, fecha_fin) if es_dia_habil(dia)]
+        borrados, escritos = escribir_tramos(current_user, "Vacaciones", dias)
+        if borrados or escritos:
+            registrar_cambio_eventos([current_user.id], fecha_inicio, fecha_fin)
         return redirect('/add-vacation')
     
-    # Obtener las vacaciones existentes para el usuario, ordenadas por fecha de inicio
-    trabajador_actual = f"{current_user.nombre} {current_user.apellidos}"
-    limpiar_vacaciones_duplicadas(trabajador_actual)
-    vacaciones = list(events_collection.find({
-        "trabajador": trabajador_actual,
-        "tipo": "Vacaciones"
-    }).sort("fecha_inicio", 1))
-    vacaciones = filtrar_vacaciones_unicas(vacaciones)
-    
-    # Convertir los strings de fechas a objetos datetime
-    for vacacion in vacaciones:
-        vacacion["fecha_inicio"] = datetime.strptime(vacacion["fecha_inicio"], "%Y-%m-%d")
-        vacacion["fecha_fin"] = datetime.strptime(vacacion["fecha_fin"], "%Y-%m-%d")
+    # Vacaciones del usuario: se leen los tramos y se expanden a un registro por día hábil
+    vacaciones = vacaciones_por_dia(current_user.id)
     
     # Agrupar las vacaciones consecutivas
     grupos_vacaciones = agrupar_vacaciones(vacaciones)
@@ -841,40 +1604,28 @@ def add_recurring():
                 dias_generados.append(current)
             current += timedelta(days=1)
 
+        dias_generados = [dia.date() for dia in dias_generados]
+        dias_habiles = [dia for dia in dias_generados if es_dia_habil(dia)]
+        tipos_recurrentes = ["Baja", "CADE 30", "CADE 50", "CADE Tardes", "Guardia CADE", "Refuerzo Cade", "Mail"]
+
         trabajadores = list(users_collection.find())
+        trabajadores_modificados = []
+        cambios = []
         for trabajador in trabajadores:
             estado = request.form.get(f"tipo_{trabajador['_id']}")
             if not estado:
                 continue
 
-            nombre_completo = f"{trabajador['nombre']} {trabajador['apellidos']}"
-            for dia in dias_generados:
-                day_str = dia.strftime("%Y-%m-%d")
-                query_filter = {
-                    "trabajador": nombre_completo,
-                    "fecha_inicio": day_str,
-                    "fecha_fin": day_str,
-                    "tipo": {"$in": ["Baja", "CADE 30", "CADE 50", "CADE Tardes", "Guardia CADE", "Refuerzo Cade", "Mail"]}
-                }
-
-                if not es_dia_habil(dia):
-                    if estado == "normal":
-                        events_collection.delete_many(query_filter)
-                    continue
-
-                if estado == "normal":
-                    events_collection.delete_many(query_filter)
-                else:
-                    events_collection.delete_many(query_filter)
-                    nuevo_evento = {
-                        "trabajador": nombre_completo,
-                        "fecha_inicio": day_str,
-                        "fecha_fin": day_str,
-                        "tipo": estado
-                    }
-                    events_collection.insert_one(nuevo_evento)
+            trabajadores_modificados.append(trabajador['_id'])
+            if estado == "normal":
+                # 🔹 "normal" limpia los estados recurrentes de todos los días generados
+                cambios.append((trabajador, None, (), tipos_recurrentes, dias_generados))
+            else:
+                cambios.append((trabajador, estado, dias_habiles, tipos_recurrentes, dias_habiles))
 
-        invalidate_cache()  # Invalidar caché al asignar estados recurrentes
+        resumen = escribir_tramos_lote(cambios)
+        registrar_cambio_eventos(trabajadores_modificados, fecha_inicio, fecha_fin)  # Invalidar caché al asignar estados recurrentes
+        flash(mensaje_resumen_escritura(resumen), "success")
         return redirect('/add-recurring')
 
     trabajadores = list(users_collection.find({"visible_calendario": True}))
@@ -897,18 +1648,8 @@ def user_vacations(user_id):
     if not usuario:
         abort(404)
 
-    # Obtener las vacaciones, ordenadas por fecha de inicio (ascendente)
-    nombre_completo = f"{usuario['nombre']} {usuario['apellidos']}"
-    limpiar_vacaciones_duplicadas(nombre_completo)
-    vacaciones = list(events_collection.find(
-        {"trabajador": nombre_completo, "tipo": "Vacaciones"}
-    ).sort("fecha_inicio", 1))
-    vacaciones = filtrar_vacaciones_unicas(vacaciones)
-
-    # Convertir las fechas de string a objetos datetime
-    for vacacion in vacaciones:
-        vacacion["fecha_inicio"] = datetime.strptime(vacacion["fecha_inicio"], "%Y-%m-%d")
-        vacacion["fecha_fin"] = datetime.strptime(vacacion["fecha_fin"], "%Y-%m-%d")
+    # Vacaciones expandidas a un registro por día hábil, ordenadas por fecha
+    vacaciones = vacaciones_por_dia(usuario["_id"])
 
     # Agrupar las vacaciones consecutivas
     grupos_vacaciones = agrupar_vacaciones(vacaciones)
@@ -935,8 +1676,15 @@ def delete_vacation(vacation_id):
         query = {"_id": ObjectId(vacation_id)}
         vacacion = events_collection.find_one(query)
 
-        if vacacion and vacacion["trabajador"] == f"{current_user.nombre} {current_user.apellidos}":
-            events_collection.delete_one(query)
+        if vacacion and str(vacacion.get("user_id")) == current_user.id:
+            # 🔹 Con ?dia=YYYY-MM-DD sólo se quita ese día del tramo; sin él, el tramo entero
+            dia = a_fecha(request.args.get("dia")) if request.args.get("dia") else None
+            if dia is not None:
+                escribir_tramos(current_user, None, (), ["Vacaciones"], [dia])
+                registrar_cambio_eventos([vacacion["user_id"]], dia, dia)
+            else:
+                events_collection.delete_one(query)
+                registrar_cambio_eventos([vacacion["user_id"]], vacacion.get("fecha_inicio"), vacacion.get("fecha_fin"))
             print("✅ Vacación eliminada correctamente")
             return redirect('/add-vacation')
         else:
@@ -948,106 +1696,20 @@ def delete_vacation(vacation_id):
         return jsonify({"error": "Error interno"}), 500
     
     
-@app.route('/api/events', methods=['GET', 'POST'])
-@login_required
-def events():
-    if request.method == 'POST':
-        event_data = request.get_json()
-        event_data["trabajador"] = f"{current_user.nombre} {current_user.apellidos}"
-        events_collection.insert_one(event_data)
-        # Invalidar caché cuando se añade un evento
-        invalidate_cache()
-        return jsonify({"message": "Evento agregado correctamente"}), 201
-
-    # 🔹 Obtener parámetros de filtro desde la query string
-    estados_filtro = request.args.getlist('estados')
-    persona_filtro = request.args.get('persona', 'todos')
-    rol_filtro = request.args.get('rol', 'todos')
-    busqueda = request.args.get('busqueda', '').strip()
-    persona_nombre = resolve_persona_nombre(persona_filtro)
-
-    demo_admin_mode = is_demo_admin_user()
-    anonymized_labels = build_anonymized_label_map() if demo_admin_mode else None
-
-    # 🔹 Verificar caché
-    cache_key = f"{get_cache_key(estados_filtro, persona_filtro, rol_filtro, busqueda)}|anon={int(demo_admin_mode)}"
-    if cache_key in events_cache and is_cache_valid(events_cache[cache_key]):
-        print(f"🚀 Sirviendo desde caché: {cache_key}")
-        return jsonify(events_cache[cache_key]['data'])
-
-    print(f"🔄 Generando datos frescos para: {cache_key}")
-    
-    # 🔹 Lista de festivos
-    festivos = FESTIVOS
-
-    # 🔹 Definir el orden de los puestos
-    orden_puestos = {"Administrador/a": 1, "ADM": 2, "TS": 3}
-    colores_puestos = {
-        "Administrador/a": "#9932CC",
-        "ADM": "#B0FFB0",
-        "TS": "#A3C4FF"
-    }
-
-    # 🔹 Obtener usuarios con filtros aplicados
-    usuarios_query = {"visible_calendario": {"$ne": False}}
-    if rol_filtro != 'todos':
-        usuarios_query["puesto"] = rol_filtro
-    
-    usuarios = list(users_collection.find(usuarios_query))
-    for usuario in usuarios:
-        usuario['_id'] = str(usuario['_id'])
-        usuario['nombre_completo'] = f"{usuario.get('nombre', '')} {usuario.get('apellidos', '')}".strip()
-        usuario['display_name'] = get_display_name_for_user(usuario, anonymized_labels)
-    usuarios_ordenados = sorted(usuarios, key=lambda u: orden_puestos.get(u.get('puesto', ''), 4))
-
-    # 🔹 Filtrar usuarios por persona si es necesario
-    if persona_nombre:
-        usuarios_ordenados = [u for u in usuarios_ordenados if u['nombre_completo'] == persona_nombre]
-
-    # 🔹 Filtrar usuarios por búsqueda si es necesario
-    if busqueda:
-        busqueda_lower = busqueda.lower()
-        usuarios_ordenados = [
-            u for u in usuarios_ordenados
-            if busqueda_lower in (u['display_name'] if demo_admin_mode else u['nombre_completo']).lower()
-        ]
-
-    # 🔹 Obtener eventos solo para los usuarios filtrados
-    nombres_usuarios = [u['nombre_completo'] for u in usuarios_ordenados]
-    eventos_query = {"trabajador": {"$in": nombres_usuarios}} if nombres_usuarios else {}
-    eventos = list(events_collection.find(eventos_query))
-
-    # Agrupar los eventos por trabajador y por tipo
-    eventos_por_trabajador = {}
-    for evento in eventos:
-        nombre = evento["trabajador"]  # Supongo que se guarda el nombre completo
-        tipo = evento.get("tipo", "Vacaciones")
-        if nombre not in eventos_por_trabajador:
-            eventos_por_trabajador[nombre] = {}
-        if tipo not in eventos_por_trabajador[nombre]:
-            eventos_por_trabajador[nombre][tipo] = []
-        eventos_por_trabajador[nombre][tipo].append((evento["fecha_inicio"], evento["fecha_fin"]))
-
-    # 🔹 Estructura para agrupar vacaciones por trabajador
-    dias_no_disponibles = {}
-    for evento in eventos:
-        nombre = evento["trabajador"]
-        if nombre not in dias_no_disponibles:
-            dias_no_disponibles[nombre] = []
-        dias_no_disponibles[nombre].append((evento["fecha_inicio"], evento["fecha_fin"]))
-
+def construir_segmento_completo(usuarios_ordenados, estados_filtro, segmento_inicio, segmento_fin, codigos_estado):
+    """Un objeto por usuario y día laborable (formato que consume FullCalendar)."""
     eventos_json = []
     contador_disponibles = {}
 
-    # 🔹 Generar eventos desde el 1 de enero hasta el 31 de diciembre de 2025
-    fecha_actual = datetime(2025, 1, 1)
-    fecha_fin = datetime(2028, 1, 15)
-  
+    # 🔹 Generar eventos sólo para los días del segmento
+    fecha_actual = datetime.combine(segmento_inicio, datetime.min.time())
+    fecha_fin = datetime.combine(segmento_fin, datetime.min.time())
+
     while fecha_actual <= fecha_fin:
         fecha_str = fecha_actual.strftime("%Y-%m-%d")
         dia_semana = fecha_actual.weekday()
 
-        if fecha_str in festivos:
+        if fecha_str in FESTIVOS:
             eventos_json.append({
                 "id": f"Festivo-{fecha_str}",
                 "title": "Festivo",
@@ -1061,63 +1723,23 @@ def events():
             disponibles_en_dia = 0
             eventos_dia = []
 
-            for usuario in usuarios_ordenados:
-                nombre_completo = usuario['nombre_completo']
+            columna = (fecha_actual.date() - segmento_inicio).days
+            for fila, usuario in enumerate(usuarios_ordenados):
                 display_name = usuario['display_name']
-                color = colores_puestos.get(usuario["puesto"], "#D3D3D3")
+                color = COLORES_PUESTOS.get(usuario["puesto"], "#D3D3D3")
                 event_label = f"{usuario['puesto']} - {display_name}"
 
-                # Verifica si hay eventos asignados para este usuario en la fecha
-                user_events = eventos_por_trabajador.get(nombre_completo, {})
-                evento_asignado = None
-                # Verifica en orden de prioridad: Vacaciones, CADE 30, CADE 50, Mail.
-                for tipo in ["Ausencia", "Baja", "CADE 30", "CADE 50", "CADE Tardes", "Guardia CADE", "Refuerzo Cade", "Mail", "Vacaciones"]:
-                    if tipo in user_events:
-                        for inicio, fin in user_events[tipo]:
-                            # Suponiendo que inicio y fin son strings "YYYY-MM-DD"
-                            if fecha_str >= inicio and fecha_str <= fin:
-                                evento_asignado = tipo
-                                break
-                    if evento_asignado:
-                        break
+                # Estado asignado para este usuario en la fecha (-1 = disponible)
+                codigo = codigos_estado[fila][columna]
+                evento_asignado = PRIORIDAD_ESTADOS[codigo] if codigo >= 0 else None
                 if evento_asignado:
-                    if evento_asignado == "Vacaciones":
-                        event_label += " (Ausente)"
-                        color = "#E53935"  # Rojo brillante
-                    elif evento_asignado == "Ausencia":
-                        event_label += " (Ausente)"
-                        color = "#757575"  # Gris medio
-                    elif evento_asignado == "Baja":
-                        event_label += " (Baja)"
-                        color = "#757575"  # Gris medio
-                    elif evento_asignado == "CADE 30":
-                        event_label += " (CADE 30)"
-                        color = "#FB8C00"  # Naranja fuerte
-                    elif evento_asignado == "CADE 50":
-                        event_label += " (CADE 50)"
-                        color = "#FDD835"  # Amarillo brillante
-                    elif evento_asignado == "CADE Tardes":
-                        event_label += " (CADE Tardes)"
-                        color = "#F6AE2D"  # Dorado/miel vibrante
-                    elif evento_asignado == "Guardia CADE":
-                        event_label += " (Guardia CADE)"
-                        color = "#49A275"  # Verde oscuro
-                    elif evento_asignado == "Refuerzo Cade":
-                        event_label += " (Refuerzo Cade)"
-                        color = "#FCF2B1"  # Amarillo clarito
-                    elif evento_asignado == "Mail":
-                        event_label += " (Mail)"
-                        color = "#8D6E63"  # Marrón rosado apagado
+                    etiqueta, color = ESTILO_ESTADOS[evento_asignado]
+                    event_label += f" ({etiqueta})"
                 else:
                     disponibles_en_dia += 1
 
-                # Mapear el estado para el frontend (Vacaciones -> Ausente)
-                estado_value = "PIAS"
-                if evento_asignado:
-                    if evento_asignado == "Vacaciones":
-                        estado_value = "Ausente"
-                    else:
-                        estado_value = evento_asignado
+                # Estado para el frontend (Vacaciones -> Ausente, disponible -> PIAS)
+                estado_value = ESTADOS_CALENDARIO[codigo + 1]
 
                 # 🔹 Aplicar filtro de estados en el backend
                 if estados_filtro and estado_value not in estados_filtro:
@@ -1136,20 +1758,333 @@ def events():
                     }
                 })
 
-            eventos_dia.sort(key=lambda e: orden_puestos.get(e["title"].split(" - ")[0], 4))
+            eventos_dia.sort(key=lambda e: ORDEN_PUESTOS.get(e["title"].split(" - ")[0], 4))
             eventos_json.extend(eventos_dia)
             contador_disponibles[fecha_str] = disponibles_en_dia
 
         fecha_actual += timedelta(days=1)
 
-    # 🔹 Guardar en caché
-    result = {"eventos": eventos_json, "contador": contador_disponibles}
-    events_cache[cache_key] = {
-        'data': result,
-        'timestamp': time.time()
-    }
-    
-    return jsonify(result)
+    return eventos_json, contador_disponibles
+
+def construir_segmento_compacto(usuarios_ordenados, estados_filtro, segmento_inicio, segmento_fin, codigos_estado):
+    """Por día, pares planos [fila_usuario, índice_estado, ...]; los festivos van a null."""
+    dias = {}
+    contador_disponibles = {}
+    for columna in range((segmento_fin - segmento_inicio).days + 1):
+        dia = segmento_inicio + timedelta(days=columna)
+        fecha_str = dia.strftime("%Y-%m-%d")
+        if fecha_str in FESTIVOS:
+            dias[fecha_str] = None
+            contador_disponibles[fecha_str] = 0
+        elif dia.weekday() < 5:
+            celdas = []
+            disponibles_en_dia = 0
+            for fila in range(len(usuarios_ordenados)):
+                indice_estado = codigos_estado[fila][columna] + 1  # 0 = PIAS
+                if indice_estado == 0:
+                    disponibles_en_dia += 1
+                if estados_filtro and ESTADOS_CALENDARIO[indice_estado] not in estados_filtro:
+                    continue
+                celdas.extend((fila, indice_estado))
+            dias[fecha_str] = celdas
+            contador_disponibles[fecha_str] = disponibles_en_dia
+    return dias, contador_disponibles
+
+
+def obtener_segmento_eventos(formato, usuarios_ordenados, estados_filtro, demo_admin_mode,
+                             segmento_inicio, segmento_fin, version_actual, receta=None):
+    """Segmento mensual del calendario desde el caché o calculado y guardado en él.
+
+    Devuelve (datos, contador, datos_gzip): JSON sin corchetes/llaves exteriores, listo para
+    concatenar, y los datos ya comprimidos como bloque deflate. `receta` registra el uso del
+    segmento para el precalentado.
+    """
+    cache_key = get_cache_key(
+        estados_filtro, [u['_id'] for u in usuarios_ordenados], demo_admin_mode,
+        segmento_inicio.strftime("%Y-%m-%d"), segmento_fin.strftime("%Y-%m-%d"), formato
+    )
+    if receta is not None:
+        registrar_uso_segmento(receta)
+    cache_entry = events_cache.get(cache_key)
+    if cache_entry:
+        print(f"🚀 Sirviendo desde caché: {cache_key}")
+        return cache_entry['data']
+
+    print(f"🔄 Generando datos frescos para: {cache_key}")
+
+    # 🔹 Estados del segmento leídos de la matriz (índice en PRIORIDAD_ESTADOS, -1 = disponible)
+    ids_usuarios = [u['_id'] for u in usuarios_ordenados]
+    codigos_estado = matriz_estados.codigos_prioritarios(ids_usuarios, segmento_inicio, segmento_fin)
+    construir = construir_segmento_compacto if formato == "compacto" else construir_segmento_completo
+    datos, contador_disponibles = construir(usuarios_ordenados, estados_filtro, segmento_inicio, segmento_fin, codigos_estado)
+
+    # 🔹 Guardar el segmento ya serializado (sin corchetes/llaves, para concatenarlo)
+    segmento_datos = json.dumps(datos, separators=(",", ":"))[1:-1].encode("utf-8")
+    segmento_contador = json.dumps(contador_disponibles, separators=(",", ":"))[1:-1].encode("utf-8")
+    segmento_gzip = deflate_bloque(segmento_datos)
+    events_cache.set(cache_key, {
+        'data': (segmento_datos, segmento_contador, segmento_gzip),
+        'version': version_actual,
+        'timestamp': time.time(),
+        'mes': segmento_inicio.strftime("%Y-%m"),
+        'trabajadores': ids_usuarios
+    })
+    return segmento_datos, segmento_contador, segmento_gzip
+
+
+@app.route('/api/events', methods=['GET', 'POST'])
+@login_required
+def events():
+    if request.method == 'POST':
+        event_data = request.get_json() or {}
+        tipo = event_data.get("tipo")
+        dias = dias_entre(event_data.get("fecha_inicio"), event_data.get("fecha_fin") or event_data.get("fecha_inicio"))
+        if not tipo or not dias:
+            return jsonify({"error": "Faltan tipo o fechas válidas"}), 400
+        # 🔹 Se fusiona con los tramos del mismo tipo que solapan o son contiguos (repetir el POST no duplica)
+        borrados, escritos = escribir_tramos(current_user, tipo, dias)
+        if borrados or escritos:
+            # Invalidar caché cuando se añade un evento
+            registrar_cambio_eventos([current_user.id], dias[0], dias[-1])
+        return jsonify({"message": "Evento agregado correctamente"}), 201
+
+    # 🔹 Obtener parámetros de filtro desde la query string
+    estados_filtro = request.args.getlist('estados')
+    persona_filtro = request.args.get('persona', 'todos')
+    rol_filtro = request.args.get('rol', 'todos')
+    busqueda = request.args.get('busqueda', '').strip()
+    persona_nombre = resolve_persona_nombre(persona_filtro)
+    # 🔹 format=compact: tablas de usuarios/estados y por día pares de índices (ver index.html)
+    formato = "compacto" if request.args.get('format') == 'compact' else "completo"
+
+    # 🔹 Ventana visible enviada por FullCalendar (start incluido, end excluido)
+    ventana_inicio, ventana_fin = resolver_rango_calendario(request.args.get('start'), request.args.get('end'))
+    ventana_inicio_str = ventana_inicio.strftime("%Y-%m-%d")
+    ventana_fin_str = ventana_fin.strftime("%Y-%m-%d")
+
+    demo_admin_mode = is_demo_admin_user()
+
+    # 🔹 Obtener usuarios con filtros aplicados
+    usuarios_ordenados = obtener_usuarios_calendario(rol_filtro, persona_nombre, busqueda, demo_admin_mode)
+
+    # 🔹 Si el navegador ya tiene esta misma respuesta se contesta 304 sin generar nada
+    ids_usuarios = [u['_id'] for u in usuarios_ordenados]
+    etag = etag_para(get_cache_key(
+        estados_filtro, ids_usuarios, demo_admin_mode, ventana_inicio_str, ventana_fin_str, formato
+    ))
+    no_modificada = respuesta_no_modificada(etag)
+    if no_modificada:
+        return no_modificada
+
+    # 🔹 La respuesta se compone de segmentos mensuales cacheados por separado: una escritura
+    # sólo invalida los meses y trabajadores que toca y el resto de la ventana sigue en caché.
+    # Se envía en streaming mes a mes: sólo hay un segmento en memoria y el primer byte sale
+    # antes de calcular el último día.
+    version_actual = obtener_version_datos()
+    # Parámetros que permiten reconstruir cada segmento fuera de la petición (precalentado)
+    receta = (rol_filtro, persona_nombre, busqueda, demo_admin_mode, tuple(sorted(set(estados_filtro))), formato)
+
+    if formato == "compacto":
+        usuarios_tabla = [fila_usuario_compacta(u) for u in usuarios_ordenados]
+        apertura = (
+            b'{"formato":"compact","usuarios":' + json.dumps(usuarios_tabla, separators=(",", ":")).encode("utf-8")
+            + b',"estados":' + json.dumps(ESTADOS_TABLA_COMPACTA, separators=(",", ":")).encode("utf-8")
+            + b',"dias":{'
+        )
+        cierre = b'},"contador":{'
+    else:
+        apertura = b'{"eventos":['
+        cierre = b'],"contador":{'
+
+    # 🔹 Con gzip se envían los segmentos ya comprimidos al llenar el caché
+    usar_gzip = elegir_codificacion(request.accept_encodings, ["gzip"]) == "gzip"
+    gzip_stream = GzipEnStreaming() if usar_gzip else None
+
+    def emitir(datos, comprimido=None):
+        return gzip_stream.fragmento(datos, comprimido) if gzip_stream else datos
+
+    def generar_respuesta():
+        if gzip_stream:
+            yield gzip_stream.cabecera()
+        yield emitir(apertura)
+        fragmentos_contador = []  # Los contadores son pequeños: se emiten al final
+        hay_datos = False
+
+        for segmento_inicio, segmento_fin in dividir_en_meses(ventana_inicio, ventana_fin):
+            segmento_datos, segmento_contador, segmento_gzip = obtener_segmento_eventos(
+                formato, usuarios_ordenados, estados_filtro, demo_admin_mode, segmento_inicio, segmento_fin,
+                version_actual, receta + (segmento_inicio, segmento_fin)
+            )
+
+            if segmento_datos:
+                if hay_datos:
+                    yield emitir(b",")
+                yield emitir(segmento_datos, segmento_gzip)
+                hay_datos = True
+            if segmento_contador:
+                fragmentos_contador.append(segmento_contador)
+
+        yield emitir(cierre + b",".join(fragmentos_contador) + b'}}')
+        if gzip_stream:
+            yield gzip_stream.cola()
+
+    respuesta = app.response_class(stream_with_context(generar_respuesta()), mimetype='application/json')
+    respuesta.vary.add("Accept-Encoding")
+    respuesta.headers["X-Data-Version"] = str(version_actual)  # Base para /api/events/changes
+    if usar_gzip:
+        respuesta.headers["Content-Encoding"] = "gzip"
+        etag = f"{etag}-gzip"
+    return con_etag(respuesta, etag)
+
+@app.route('/api/events/changes')
+@login_required
+def events_changes():
+    """Celdas usuario/día que han cambiado desde la versión `since` que ya tiene el cliente.
+
+    Acepta los mismos filtros y ventana que /api/events y responde en su formato compacto,
+    limitado a los usuarios y días afectados según el diario de cambios. Con
+    `completo: true` el cliente debe volver a pedir el calendario entero (diario caducado
+    o cambio global, p. ej. de usuarios, que también cambia nombres y alias).
+    """
+    version_actual = obtener_version_datos()
+    try:
+        desde = int(request.args.get('since', ''))
+    except ValueError:
+        return jsonify({"error": "Parámetro 'since' inválido"}), 400
+
+    def responder(datos):
+        respuesta = jsonify(dict(datos, version=version_actual))
+        respuesta.headers["X-Data-Version"] = str(version_actual)
+        return respuesta
+
+    cambios = diario_cambios.entre(desde, version_actual) if desde < version_actual else []
+    if len(cambios) != version_actual - desde:
+        return responder({"completo": True})
+
+    ventana_inicio, ventana_fin = resolver_rango_calendario(request.args.get('start'), request.args.get('end'))
+
+    # 🔹 Trabajadores afectados por día dentro de la ventana (None = todos)
+    afectados_por_dia = {}
+    for cambio in cambios:
+        trabajadores = cambio.get("trabajadores")
+        if trabajadores is None and not cambio.get("fecha_inicio") and not cambio.get("fecha_fin"):
+            return responder({"completo": True})
+        inicio = max(_parse_metrics_date(cambio.get("fecha_inicio")) or ventana_inicio, ventana_inicio)
+        fin = min(_parse_metrics_date(cambio.get("fecha_fin")) or ventana_fin, ventana_fin)
+        dia = inicio
+        while dia <= fin:
+            if es_dia_habil(dia):
+                actuales = afectados_por_dia.get(dia, set())
+                if trabajadores is None or actuales is None:
+                    afectados_por_dia[dia] = None
+                else:
+                    afectados_por_dia[dia] = actuales | set(trabajadores)
+            dia += timedelta(days=1)
+
+    if not afectados_por_dia:
+        return responder({"completo": False, "usuarios": [], "estados": ESTADOS_TABLA_COMPACTA,
+                          "dias": {}, "afectados": {}, "contador": {}})
+
+    estados_filtro = request.args.getlist('estados')
+    usuarios_ordenados = obtener_usuarios_calendario(
+        request.args.get('rol', 'todos'),
+        resolve_persona_nombre(request.args.get('persona', 'todos')),
+        request.args.get('busqueda', '').strip(),
+        is_demo_admin_user()
+    )
+    ids_usuarios = [u['_id'] for u in usuarios_ordenados]
+    primer_dia = min(afectados_por_dia)
+    codigos_estado = matriz_estados.codigos_prioritarios(ids_usuarios, primer_dia, max(afectados_por_dia))
+
+    # 🔹 Sólo se envían los usuarios con alguna celda afectada, renumerados en su propia tabla
+    filas_delta = {}
+    usuarios_tabla = []
+    dias = {}
+    afectados = {}
+    contador = {}
+    for dia in sorted(afectados_por_dia):
+        ids_afectados = afectados_por_dia[dia]
+        columna = (dia - primer_dia).days
+        fecha_str = dia.strftime("%Y-%m-%d")
+        celdas = []
+        filas_afectadas = []
+        for fila, usuario in enumerate(usuarios_ordenados):
+            if ids_afectados is not None and usuario['_id'] not in ids_afectados:
+                continue
+            if fila not in filas_delta:
+                filas_delta[fila] = len(usuarios_tabla)
+                usuarios_tabla.append(fila_usuario_compacta(usuario))
+            filas_afectadas.append(filas_delta[fila])
+            indice_estado = codigos_estado[fila][columna] + 1  # 0 = PIAS
+            if estados_filtro and ESTADOS_CALENDARIO[indice_estado] not in estados_filtro:
+                continue
+            celdas.extend((filas_delta[fila], indice_estado))
+        dias[fecha_str] = celdas
+        afectados[fecha_str] = filas_afectadas
+        contador[fecha_str] = sum(1 for fila in codigos_estado if fila[columna] < 0)
+
+    return responder({
+        "completo": False,
+        "usuarios": usuarios_tabla,
+        "estados": ESTADOS_TABLA_COMPACTA,
+        "dias": dias,
+        "afectados": afectados,
+        "contador": contador
+    })
+
+@app.route('/api/events/stream')
+@login_required
+def events_stream():
+    """Server-Sent Events con los cambios de datos (usuarios afectados y rango de fechas).
+
+    Se envían ids de usuario y no nombres para no exponer nombres reales en modo demo.
+    `usuarios: null` significa que el cambio afecta a todos los usuarios. Si el proceso ya
+    tiene SSE_MAX_CONEXIONES streams abiertos se cierra enseguida y el navegador reintenta
+    pasados SSE_REINTENTO_LLENO segundos.
+    """
+    try:
+        desde = int(request.headers.get('Last-Event-ID') or request.args.get('since') or obtener_version_datos())
+    except ValueError:
+        desde = obtener_version_datos()
+
+    def generar_eventos():
+        # Se reserva dentro del generador: el servidor lo cierra siempre y el finally libera el hueco
+        if not conexiones_sse.acquire(blocking=False):
+            yield f"retry: {SSE_REINTENTO_LLENO * 1000}\n\n"
+            return
+        try:
+            yield "retry: 5000\n\n"
+            version = desde
+            limite = time.time() + SSE_DURACION
+            while time.time() < limite:
+                cambios = notificador_cambios.esperar(version, SSE_LATIDO)
+                if not cambios:
+                    yield ": latido\n\n"
+                    continue
+                for cambio in cambios:
+                    datos = {
+                        "version": cambio["_id"],
+                        "usuarios": cambio.get("trabajadores"),
+                        "fecha_inicio": cambio.get("fecha_inicio"),
+                        "fecha_fin": cambio.get("fecha_fin")
+                    }
+                    yield f"id: {cambio['_id']}\nevent: cambio\ndata: {json.dumps(datos)}\n\n"
+                    version = cambio["_id"]
+        finally:
+            conexiones_sse.release()
+
+    return app.response_class(
+        stream_with_context(generar_eventos()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/admin/cache_stats')
+@login_required
+@admin_required
+def cache_stats():
+    """Estado del caché del calendario: tamaño y contadores de aciertos/fallos/expulsiones."""
+    return jsonify(events_cache.estadisticas())
 
 @app.route('/api/events/<event_id>', methods=['DELETE'])
 @login_required
@@ -1158,12 +2093,12 @@ def delete_event(event_id):
     if not evento:
         return jsonify({"message": "Evento no encontrado"}), 404
 
-    if evento["trabajador"] != f"{current_user.nombre} {current_user.apellidos}":
+    if str(evento.get("user_id")) != current_user.id:
         return jsonify({"message": "No puedes eliminar eventos de otros"}), 403
 
     events_collection.delete_one({"_id": ObjectId(event_id)})
     # Invalidar caché cuando se elimina un evento
-    invalidate_cache()
+    registrar_cambio_eventos([evento["user_id"]], evento.get("fecha_inicio"), evento.get("fecha_fin"))
     return jsonify({"message": "Evento eliminado, el usuario vuelve a estar disponible"}), 200
 
 @app.route('/admin/asignar-estados', methods=['GET', 'POST'])
@@ -1180,55 +2115,33 @@ def asignar_estados():
         trabajadores = list(users_collection.find())
         
         # Pre-calcular días hábiles y totales en el rango
-        dias_rango = []
-        dias_habiles = []
-        current_day = fecha_inicio_dt
-        while current_day <= fecha_fin_dt:
-            dias_rango.append(current_day.strftime("%Y-%m-%d"))
-            if es_dia_habil(current_day):
-                dias_habiles.append(current_day.strftime("%Y-%m-%d"))
-            current_day += timedelta(days=1)
+        dias_rango = dias_entre(fecha_inicio_dt, fecha_fin_dt)
+        dias_habiles = [dia for dia in dias_rango if es_dia_habil(dia)]
         
         # Tipos de eventos a limpiar
         tipos_a_limpiar = ["Baja", "Baja Médica", "Ausencia", "CADE 30", "CADE 50", "CADE Tardes", "Guardia CADE", "Refuerzo Cade", "Mail", "PIAS"]
 
+        trabajadores_modificados = []
+        cambios = []
         for trabajador in trabajadores:
             estado = request.form.get(f"tipo_{trabajador['_id']}")
             if not estado:
                 continue
 
-            nombre_completo = f"{trabajador['nombre']} {trabajador['apellidos']}"
+            trabajadores_modificados.append(trabajador['_id'])
 
             if estado == "normal":
-                # Si es normal, borramos eventos de los tipos especiales en TOOOODO el rango (hábiles y no hábiles)
-                if dias_rango:
-                    events_collection.delete_many({
-                        "trabajador": nombre_completo,
-                        "fecha_inicio": {"$in": dias_rango},
-                        "tipo": {"$in": tipos_a_limpiar}
-                    })
+                # Si es normal, quitamos los tipos especiales de TOOOODO el rango (hábiles y no hábiles)
+                cambios.append((trabajador, None, (), tipos_a_limpiar, dias_rango))
             else:
-                # Si es un estado especial (Vacaciones, etc), solo afectamos días hábiles
-                if dias_habiles:
-                    # 1. Borrar conflictos en días hábiles
-                    events_collection.delete_many({
-                        "trabajador": nombre_completo,
-                        "fecha_inicio": {"$in": dias_habiles},
-                        "tipo": {"$in": tipos_a_limpiar}
-                    })
-                    
-                    # 2. Insertar nuevos eventos en bloque
-                    nuevos_eventos = [{
-                        "trabajador": nombre_completo,
-                        "fecha_inicio": dia,
-                        "fecha_fin": dia,
-                        "tipo": estado
-                    } for dia in dias_habiles]
-                    
-                    if nuevos_eventos:
-                        events_collection.insert_many(nuevos_eventos)
-
-        invalidate_cache()  # Invalidar caché al asignar estados masivos
+                # Si es un estado especial (Vacaciones, etc), solo afectamos días hábiles:
+                # se recortan los conflictos y el estado se guarda como tramos consecutivos
+                cambios.append((trabajador, estado, dias_habiles, tipos_a_limpiar, dias_habiles))
+
+        # 🔹 Todos los trabajadores en una lectura y unos pocos bulk_write
+        resumen = escribir_tramos_lote(cambios)
+        registrar_cambio_eventos(trabajadores_modificados, fecha_inicio, fecha_fin)  # Invalidar caché al asignar estados masivos
+        flash(mensaje_resumen_escritura(resumen), "success")
         return redirect(url_for('asignar_estados'))
     else:
         trabajadores = list(users_collection.find({"visible_calendario": True}))
@@ -1244,58 +2157,98 @@ def asignar_estados():
         return render_template("asignar_estados.html", trabajadores=trabajadores, hide_real_names=demo_mode)
     
 
+@app.route('/admin/eventos-sin-usuario', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def admin_eventos_sin_usuario():
+    """Eventos antiguos sin user_id: no salen en ninguna vista hasta asignarlos a un usuario."""
+    if request.method == 'POST':
+        clave = request.form.get('clave', '')
+        grupo = next((g for g in eventos_sin_usuario() if g["clave"] == clave), None)
+        user_id = request.form.get('user_id', '')
+        usuario = users_collection.find_one({"_id": ObjectId(user_id)}) if ObjectId.is_valid(user_id) else None
+        if not usuario or grupo is None:
+            flash("Usuario o grupo de eventos no válido", "danger")
+            return redirect(url_for('admin_eventos_sin_usuario'))
+        nombre = grupo["nombre"]
+        # Se reescriben como tramos del usuario (fusionados con los suyos, sin chocar con la clave
+        # única) y después se borran los originales
+        huerfanos = list(events_collection.find({"trabajador": nombre, "user_id": {"$exists": False}}))
+        dias_por_tipo = {}
+        for evento in huerfanos:
+            dias_por_tipo.setdefault(evento.get("tipo", "Vacaciones"), set()).update(dias_evento(evento))
+        for tipo, dias in dias_por_tipo.items():
+            escribir_tramos(usuario, tipo, dias)
+        if huerfanos:
+            events_collection.delete_many({"_id": {"$in": [evento["_id"] for evento in huerfanos]}})
+            todos = set().union(*dias_por_tipo.values())
+            registrar_cambio_eventos([user_id], min(todos, default=None), max(todos, default=None))
+        destino = get_display_name_for_user(usuario, build_anonymized_label_map(visible_only=False) if is_demo_admin_user() else None)
+        flash(f"{len(huerfanos)} eventos asignados a {destino}", "success")
+        return redirect(url_for('admin_eventos_sin_usuario'))
+
+    demo_mode = is_demo_admin_user()
+    etiquetas = build_anonymized_label_map(visible_only=False) if demo_mode else nombres_por_id()
+    usuarios = sorted(etiquetas.items(), key=lambda par: par[1].lower())
+    return render_template("eventos_sin_usuario.html", grupos=eventos_sin_usuario(), usuarios=usuarios,
+                           etiquetas=etiquetas, hide_real_names=demo_mode)
+
+
+# Filas por página del informe de duplicados
+DUPLICADOS_POR_PAGINA = 100
+
+
 @app.route('/admin/duplicados', methods=['GET'])
 @login_required
 @admin_required
 def duplicados():
-    pipeline = [
-        # Excluir fines de semana antes de agrupar (independiente del tipo de campo)
-        {"$addFields": {"_fechaDate": {"$toDate": "$fecha_inicio"}}},
-        {"$match": {"$expr": {"$not": {"$in": [{"$isoDayOfWeek": "$_fechaDate"}, [6, 7]]}}}},
-        {
-            "$match": {
-                "$expr": {
-                    "$not": {
-                        "$in": [
-                            {"$dateToString": {"format": "%Y-%m-%d", "date": "$_fechaDate"}},
-                            FESTIVOS_LIST
-                        ]
-                    }
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "trabajador": "$trabajador",
-                    "fecha_inicio": "$fecha_inicio",
-                    "fecha_fin": "$fecha_fin"
-                },
-                "tipos": {"$addToSet": "$tipo"},
-                "count": {"$sum": 1},
-                "ids": {"$push": "$_id"}
-            }
-        },
-        {
-            "$match": {
-                "count": {"$gt": 1}
-            }
-        },
-        {"$sort": {"_id.fecha_inicio": 1}},
-        {"$project": {"_fechaDate": 0}}
+    # 🔹 Informe acotado por rango y trabajador, paginado por clave (día, user_id): cada página
+    # sigue después de la última fila de la anterior, sin recorrer lo ya servido
+    hoy = date.today()
+    desde = a_fecha(request.args.get('desde') or '') or date(hoy.year, 1, 1)
+    hasta = a_fecha(request.args.get('hasta') or '') or date(hoy.year, 12, 31)
+    if hasta < desde:
+        desde, hasta = hasta, desde
+    persona = request.args.get('persona', 'todos')
+    trabajadores = [persona] if ObjectId.is_valid(persona) else None
+
+    despues = None
+    cursor = request.args.get('despues', '')
+    if '_' in cursor:
+        dia_cursor, user_cursor = cursor.split('_', 1)
+        if a_fecha(dia_cursor):
+            despues = (a_fecha(dia_cursor), user_cursor)
+
+    # Días hábiles con más de un evento por trabajador (tipos distintos o tramos del mismo tipo
+    # que se solapan), leídos de la matriz (al día en cada escritura)
+    pagina = matriz_estados.conflictos(desde, hasta, trabajadores=trabajadores, despues=despues,
+                                       limite=DUPLICADOS_POR_PAGINA + 1)
+    siguiente = None
+    if len(pagina) > DUPLICADOS_POR_PAGINA:
+        pagina = pagina[:DUPLICADOS_POR_PAGINA]
+        siguiente = f"{pagina[-1][0].strftime('%Y-%m-%d')}_{pagina[-1][1]}"
+    duplicados = [
+        {"_id": {"user_id": trabajador, "fecha_inicio": dia.strftime("%Y-%m-%d")}, "tipos": tipos, "count": eventos}
+        for dia, trabajador, tipos, eventos in pagina
     ]
-    duplicados = list(events_collection.aggregate(pipeline))
+
     demo_mode = is_demo_admin_user()
-    fullname_labels = None
-    if demo_mode:
-        _, fullname_labels = build_anonymized_label_map(visible_only=False, include_fullname_map=True)
+    etiquetas = build_anonymized_label_map(visible_only=False) if demo_mode else nombres_por_id()
     for dup in duplicados:
-        real_name = dup["_id"].get("trabajador", "")
-        if fullname_labels:
-            dup["display_trabajador"] = fullname_labels.get(real_name, real_name)
-        else:
-            dup["display_trabajador"] = real_name
-    return render_template("duplicados.html", duplicados=duplicados, hide_real_names=demo_mode)
+        user_id = str(dup["_id"].get("user_id"))
+        dup["display_trabajador"] = etiquetas.get(user_id, user_id)
+    personas = sorted(etiquetas.items(), key=lambda par: par[1].lower())
+    return render_template(
+        "duplicados.html",
+        duplicados=duplicados,
+        hide_real_names=demo_mode,
+        desde=desde.strftime("%Y-%m-%d"),
+        hasta=hasta.strftime("%Y-%m-%d"),
+        persona=persona,
+        personas=personas,
+        siguiente=siguiente,
+        es_primera_pagina=despues is None
+    )
 
 
 @app.route('/admin/clean_redundant_duplicates', methods=['POST'])
@@ -1303,35 +2256,15 @@ def duplicados():
 @admin_required
 def clean_redundant_duplicates():
     """
-    Elimina duplicados técnicos: Mismo trabajador, misma fecha, MISMO tipo.
-    Mantiene 1, borra el resto.
+    Elimina duplicados técnicos: Mismo trabajador, mismo día de inicio, MISMO tipo.
+    Mantiene 1 (el tramo más largo), borra el resto. Acepta un rango opcional (desde/hasta).
     """
-    pipeline = [
-        {"$group": {
-            "_id": {
-                "trabajador": "$trabajador",
-                "fecha_inicio": "$fecha_inicio",
-                "fecha_fin": "$fecha_fin",
-                "tipo": "$tipo"
-            },
-            "count": {"$sum": 1},
-            "ids": {"$push": "$_id"}
-        }},
-        {"$match": {"count": {"$gt": 1}}}
-    ]
-    
-    redundancias = list(events_collection.aggregate(pipeline))
-    bajas_count = 0
-    
-    for red in redundancias:
-        # red['ids'] es una lista de todos los IDs. Borramos todos menos el primero (-1 para dejar 1)
-        ids_to_delete = red['ids'][1:]
-        if ids_to_delete:
-            result = events_collection.delete_many({"_id": {"$in": ids_to_delete}})
-            bajas_count += result.deleted_count
+    desde, hasta = rango_formulario(request.form)
+    sobrantes = list(events_collection.aggregate(pipeline_redundantes(filtro_solape(desde, hasta)), allowDiskUse=True))
+    bajas_count, _, _ = escribir_en_lotes([s["_id"] for s in sobrantes], [])
 
     if bajas_count > 0:
-        invalidate_cache()
+        registrar_cambio_eventos({s["user_id"] for s in sobrantes}, desde, hasta)
         flash(f"🧹 Limpieza completada: Se eliminaron {bajas_count} registros redundantes (idénticos).", "success")
     else:
         flash("No se encontraron registros idénticos redundantes para limpiar.", "info")
@@ -1344,61 +2277,39 @@ def clean_redundant_duplicates():
 @admin_required
 def approve_vacations_conflicts():
     """
-    Resuelve conflictos automáticos: Si un día tiene 'Vacaciones' y otros eventos,
-    mantiene 'Vacaciones' y borra el resto.
+    Resuelve conflictos automáticos: Si un día hábil tiene 'Vacaciones' y otros eventos,
+    mantiene 'Vacaciones' y quita ese día del resto (los tramos se recortan, no se borran enteros).
+    Acepta un rango opcional (desde/hasta).
     """
-    pipeline = [
-        {"$addFields": {"_fechaDate": {"$toDate": "$fecha_inicio"}}},
-        {"$match": {"$expr": {"$not": {"$in": [{"$isoDayOfWeek": "$_fechaDate"}, [6, 7]]}}}},
-         {
-            "$match": {
-                "$expr": {
-                    "$not": {
-                        "$in": [
-                            {"$dateToString": {"format": "%Y-%m-%d", "date": "$_fechaDate"}},
-                            FESTIVOS_LIST
-                        ]
-                    }
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "trabajador": "$trabajador",
-                    "fecha_inicio": "$fecha_inicio",
-                    "fecha_fin": "$fecha_fin"
-                },
-                "tipos": {"$addToSet": "$tipo"},
-                "ids": {"$push": "$_id"}
-            }
-        },
-        {
-            "$match": {
-                "$expr": {"$gt": [{"$size": "$tipos"}, 1]}
-            }
+    desde, hasta = rango_formulario(request.form)
+    vacaciones = events_collection.aggregate(pipeline_conflictos_vacaciones(filtro_solape(desde, hasta)), allowDiskUse=True)
+
+    # Un evento puede solapar con varios tramos de vacaciones: se juntan sus días antes de recortar
+    eventos = {}
+    dias_vacaciones = {}
+    for vacacion in vacaciones:
+        dias = {
+            dia for dia in dias_evento(vacacion)
+            if es_dia_habil(dia) and (desde is None or dia >= desde) and (hasta is None or dia <= hasta)
         }
-    ]
-    
-    duplicados = list(events_collection.aggregate(pipeline))
-    count_deleted = 0
-    
-    for dup in duplicados:
-        tipos = dup.get("tipos", [])
-        if "Vacaciones" in tipos:
-            trabajador = dup["_id"]["trabajador"]
-            fecha = dup["_id"]["fecha_inicio"]
-            
-            # Borrar todo lo que NO sea Vacaciones para ese trabajador y fecha
-            result = events_collection.delete_many({
-                "trabajador": trabajador,
-                "fecha_inicio": fecha,
-                "tipo": {"$ne": "Vacaciones"}
-            })
-            count_deleted += result.deleted_count
+        for evento in vacacion["solapes"]:
+            eventos[evento["_id"]] = evento
+            dias_vacaciones.setdefault(evento["_id"], set()).update(dias)
+
+    ids_a_borrar = []
+    documentos = []
+    trabajadores_modificados = set()
+    for evento_id, evento in eventos.items():
+        ids, restos = recortar([evento], dias_vacaciones[evento_id])
+        if ids:
+            ids_a_borrar.extend(ids)
+            documentos.extend(evento_en_tramo(e, inicio, fin) for e, inicio, fin in restos)
+            trabajadores_modificados.add(evento["user_id"])
+
+    count_deleted, _, _ = escribir_en_lotes(ids_a_borrar, documentos)
 
     if count_deleted > 0:
-        invalidate_cache()
+        registrar_cambio_eventos(trabajadores_modificados, desde, hasta)
         flash(f"✅ Se han resuelto conflictos en {count_deleted} eventos. Las Vacaciones prevalecen.", "success")
     else:
         flash("No se encontraron conflictos de Vacaciones para aprobar.", "info")
@@ -1473,119 +2384,52 @@ def aplicar_pias(metricas, dias_periodo):
 def calcular_metricas_por_usuario(fecha_inicio=None, fecha_fin=None, puesto=None):
     """Devuelve un diccionario con el conteo de eventos por tipo para cada trabajador
     y el ranking de los 5 con más registros por tipo. Se pueden filtrar los
-    eventos por rango de fechas."""
+    eventos por rango de fechas.
 
-    match_stage = {}
-    if fecha_inicio and fecha_fin:
-        match_stage = {"fecha_inicio": {"$gte": fecha_inicio, "$lte": fecha_fin}}
-    elif fecha_inicio:
-        match_stage = {"fecha_inicio": {"$gte": fecha_inicio}}
-    elif fecha_fin:
-        match_stage = {"fecha_inicio": {"$lte": fecha_fin}}
+    Las claves son user_id (dos usuarios pueden llamarse igual); el nombre o alias
+    se pone al pintar con `etiquetar_metricas`."""
 
     trabajadores_query = {"visible_calendario": {"$ne": False}}
-    pipeline = []
     if puesto:
         puesto_db = "Administrador/a" if puesto.lower() in ["admin", "administrador", "administrador/a"] else puesto
         trabajadores_query["puesto"] = puesto_db
 
-    trabajadores_base = [
-        f"{u['nombre']} {u['apellidos']}".strip()
-        for u in users_collection.find(trabajadores_query, {"nombre": 1, "apellidos": 1})
-    ]
+    nombres_base = nombres_por_id(trabajadores_query)
+    trabajadores_base = list(nombres_base)
+    # Sin filtro de puesto cuentan todos los usuarios con eventos, también los ocultos
+    nombres = nombres_base if puesto else nombres_por_id()
 
-    if puesto:
-        if trabajadores_base:
-            pipeline.append({"$match": {"trabajador": {"$in": trabajadores_base}}})
-        else:
-            pipeline.append({"$match": {"_id": {"$exists": False}}})
-    if match_stage:
-        pipeline.append({"$match": match_stage})
-    
-    pipeline.append({
-        "$addFields": {
-            "fecha_date": {
-                "$switch": {
-                    "branches": [
-                        {
-                            "case": {"$eq": [{"$type": "$fecha_inicio"}, "date"]},
-                            "then": "$fecha_inicio"
-                        },
-                        {
-                            "case": {"$eq": [{"$type": "$fecha_inicio"}, "string"]},
-                            "then": {"$dateFromString": {"dateString": "$fecha_inicio"}}
-                        }
-                    ],
-                    "default": {"$toDate": "$fecha_inicio"}
-                }
-            }
-        }
-    })
-    pipeline.append({"$match": {"fecha_date": {"$ne": None}}})
-    pipeline.append({
-        "$match": {
-            "$expr": {
-                "$and": [
-                    {
-                        "$not": [
-                            {
-                                "$in": [
-                                    {"$dateToString": {"format": "%Y-%m-%d", "date": "$fecha_date"}},
-                                    FESTIVOS_LIST
-                                ]
-                            }
-                        ]
-                    },
-                    {"$ne": [{"$dayOfWeek": "$fecha_date"}, 1]},
-                    {"$ne": [{"$dayOfWeek": "$fecha_date"}, 7]}
-                ]
-            }
-        }
-    })
-
-    pipeline.append({
-        "$group": {
-            "_id": {
-                "trabajador": "$trabajador",
-                "tipo": "$tipo",
-                "fecha": {"$dateToString": {"format": "%Y-%m-%d", "date": "$fecha_date"}}
-            }
-        }
-    })
-    pipeline.append({
-        "$group": {
-            "_id": {"trabajador": "$_id.trabajador", "tipo": "$_id.tipo"},
-            "count": {"$sum": 1}
-        }
-    })
-    resultado = list(events_collection.aggregate(pipeline))
+    # Conteo de días hábiles por trabajador y tipo leído de la matriz de estados (filas por user_id)
+    conteos_por_id = matriz_estados.contar_por_tipo(
+        list(nombres_base) if puesto else None,
+        _parse_metrics_date(fecha_inicio),
+        _parse_metrics_date(fecha_fin)
+    )
+    conteos = {user_id: por_tipo for user_id, por_tipo in conteos_por_id.items() if user_id in nombres}
 
-    estados_base = [estado for estado in events_collection.distinct("tipo") if estado and estado != "PIAS"]
+    estados_base = [estado for estado in matriz_estados.tipos_presentes() if estado and estado != "PIAS"]
 
     metricas = {}
     estados_periodo = set()
     top5_por_tipo = {}
 
-    for item in resultado:
-        trabajador = item["_id"]["trabajador"]
-        tipo = item["_id"].get("tipo", "Desconocido")
-        estados_periodo.add(tipo)
+    for trabajador, por_tipo in conteos.items():
+        for tipo, count in por_tipo.items():
+            estados_periodo.add(tipo)
 
-        if trabajador not in metricas:
-            metricas[trabajador] = {}
-        metricas[trabajador][tipo] = item["count"]
+            if trabajador not in metricas:
+                metricas[trabajador] = {}
+            metricas[trabajador][tipo] = count
 
-        if tipo not in top5_por_tipo:
-            top5_por_tipo[tipo] = []
-        top5_por_tipo[tipo].append((trabajador, item["count"]))
+            if tipo not in top5_por_tipo:
+                top5_por_tipo[tipo] = []
+            top5_por_tipo[tipo].append((trabajador, count))
 
     for trabajador in trabajadores_base:
         metricas.setdefault(trabajador, {})
 
     # Ordenar alfabéticamente los trabajadores
-    metricas = dict(sorted(metricas.items(), key=lambda x: x[0]))
-
-
+    metricas = dict(sorted(metricas.items(), key=lambda x: nombres.get(x[0], "")))
 
     estados_final = sorted(set(estados_base) | estados_periodo, key=lambda s: str(s).lower())
 
@@ -1629,26 +2473,26 @@ def calcular_metricas_por_usuario(fecha_inicio=None, fecha_fin=None, puesto=None
     return metricas, estados_final, top5_por_tipo
 
 
-def anonymize_metric_results(metricas, top5_por_tipo, fullname_labels):
-    """Devuelve copias de metricas/top5 usando etiquetas anonimizadas."""
-    if not fullname_labels:
-        return metricas, top5_por_tipo
+def etiquetas_metricas(demo_mode):
+    """{user_id: texto a mostrar} para las métricas: alias en modo demo, nombre real si no."""
+    nombres = nombres_por_id()
+    if demo_mode:
+        alias = build_anonymized_label_map(visible_only=False)
+        return {user_id: alias.get(user_id, "Trabajador") for user_id in nombres}
+    return nombres
 
-    top5_por_tipo = top5_por_tipo or {}
-    masked_metricas = {}
-    for nombre, datos in metricas.items():
-        label = fullname_labels.get(nombre, nombre)
-        masked_metricas[label] = dict(datos)
-    masked_metricas = dict(sorted(masked_metricas.items(), key=lambda x: x[0]))
 
-    masked_top5 = {}
-    for tipo, lista in top5_por_tipo.items():
-        masked_top5[tipo] = [
-            (fullname_labels.get(nombre, nombre), count)
-            for nombre, count in lista
-        ]
+def etiquetar_metricas(metricas, top5_por_tipo, etiquetas):
+    """Ordena las filas de `metricas` por su etiqueta y pasa el top 5 a etiquetas.
 
-    return masked_metricas, masked_top5
+    Las filas siguen indexadas por user_id: con nombres repetidos cada usuario
+    conserva su fila aunque se muestren igual."""
+    metricas = dict(sorted(metricas.items(), key=lambda x: etiquetas.get(x[0], "")))
+    top5_por_tipo = {
+        tipo: [(etiquetas.get(user_id, user_id), count) for user_id, count in lista]
+        for tipo, lista in (top5_por_tipo or {}).items()
+    }
+    return metricas, top5_por_tipo
 
 
 @app.route('/dashboard-metrics')
@@ -1659,16 +2503,20 @@ def dashboard_metrics():
     fecha_fin_raw = request.args.get('fecha_fin')
     puesto = request.args.get('puesto')
     fecha_inicio, fecha_fin, dias_periodo = resolver_rango_metricas(fecha_inicio_raw, fecha_fin_raw)
+    etag = etag_para("dashboard-metrics", fecha_inicio, fecha_fin, puesto)
+    no_modificada = respuesta_no_modificada(etag)
+    if no_modificada:
+        return no_modificada
     metricas, estados, top5_por_tipo = calcular_metricas_por_usuario(fecha_inicio, fecha_fin, puesto)
     demo_mode = is_demo_admin_user()
-    if demo_mode:
-        _, fullname_labels = build_anonymized_label_map(visible_only=False, include_fullname_map=True)
-        metricas, top5_por_tipo = anonymize_metric_results(metricas, top5_por_tipo, fullname_labels)
+    etiquetas = etiquetas_metricas(demo_mode)
+    metricas, top5_por_tipo = etiquetar_metricas(metricas, top5_por_tipo, etiquetas)
 
     total_pias = aplicar_pias(metricas, dias_periodo)
-    return render_template(
+    return con_etag(render_template(
         'dashboard_metrics.html',
         metricas=metricas,
+        etiquetas=etiquetas,
         estados=estados,
         top5_por_tipo=top5_por_tipo,
         dias_periodo=dias_periodo,
@@ -1677,7 +2525,7 @@ def dashboard_metrics():
         fecha_fin=fecha_fin,
         puesto=puesto,
         hide_real_names=demo_mode
-    )
+    ), etag)
 
 @app.route('/admin/regenerate_user_shifts', methods=['POST'])
 @login_required
@@ -1704,7 +2552,7 @@ def regenerate_user_shifts():
         generator.save_results() # Save the changes (deletions and insertions)
         
         if success:
-            invalidate_cache()
+            registrar_cambio_eventos(None, start_date, end_date)
             
             # Format detailed message
             if summary_list:
@@ -1757,11 +2605,13 @@ def dashboard_metrics_export():
     puesto = request.args.get('puesto')
 
     fecha_inicio, fecha_fin, dias_periodo = resolver_rango_metricas(fecha_inicio_raw, fecha_fin_raw)
+    etag = etag_para("dashboard-metrics-export", use_xlsx, fecha_inicio, fecha_fin, puesto)
+    no_modificada = respuesta_no_modificada(etag)
+    if no_modificada:
+        return no_modificada
     metricas, estados, _ = calcular_metricas_por_usuario(fecha_inicio, fecha_fin, puesto)
-    demo_mode = is_demo_admin_user()
-    if demo_mode:
-        _, fullname_labels = build_anonymized_label_map(visible_only=False, include_fullname_map=True)
-        metricas, _ = anonymize_metric_results(metricas, None, fullname_labels)
+    etiquetas = etiquetas_metricas(is_demo_admin_user())
+    metricas, _ = etiquetar_metricas(metricas, None, etiquetas)
     aplicar_pias(metricas, dias_periodo)
     headers = ["Trabajador", "PIAS"] + list(estados)
 
@@ -1793,7 +2643,7 @@ def dashboard_metrics_export():
             cell.border = border
 
         for trabajador, datos in metricas.items():
-            row = [trabajador, int(datos.get('PIAS', 0))] + [int(datos.get(estado, 0)) for estado in estados]
+            row = [etiquetas.get(trabajador, trabajador), int(datos.get('PIAS', 0))] + [int(datos.get(estado, 0)) for estado in estados]
             ws.append(row)
 
         ws.column_dimensions['A'].width = 40
@@ -1812,12 +2662,12 @@ def dashboard_metrics_export():
         wb.save(output)
         output.seek(0)
         filename = "_".join(filename_parts) + ".xlsx"
-        return send_file(
+        return con_etag(send_file(
             output,
             as_attachment=True,
             download_name=filename,
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        ), etag)
     else:
         # Fallback a CSV para compatibilidad sin dependencias
         import csv
@@ -1826,16 +2676,16 @@ def dashboard_metrics_export():
         writer = csv.writer(sio)
         writer.writerow(headers)
         for trabajador, datos in metricas.items():
-            row = [trabajador, int(datos.get('PIAS', 0))] + [int(datos.get(estado, 0)) for estado in estados]
+            row = [etiquetas.get(trabajador, trabajador), int(datos.get('PIAS', 0))] + [int(datos.get(estado, 0)) for estado in estados]
             writer.writerow(row)
         output = BytesIO(sio.getvalue().encode('utf-8-sig'))
         filename = "_".join(filename_parts) + ".csv"
-        return send_file(
+        return con_etag(send_file(
             output,
             as_attachment=True,
             download_name=filename,
             mimetype='text/csv'
-        )
+        ), etag)
 
 
 # Configuramos asistente de IA
@@ -2337,16 +3187,25 @@ def save_shifts():
             return redirect(url_for('generate_shifts'))
             
         events = json.loads(events_json)
+        for e in events:
+            e["user_id"] = ObjectId(e["user_id"])  # Viaja como texto en el JSON de la vista previa
         if events:
             # 1. Eliminar PIAS existentes que entren en conflicto con los nuevos turnos
             # (Para evitar duplicados si se re-genera sobre días con PIAS)
-            cleanup_targets = [{"trabajador": e["trabajador"], "fecha_inicio": e["fecha_inicio"]} for e in events]
-            if cleanup_targets:
-                events_collection.delete_many({"tipo": "PIAS", "$or": cleanup_targets})
+            # Los PIAS se guardan como tramos: se recortan los días de los turnos nuevos
+            dias_por_usuario = {}
+            for e in events:
+                dias_por_usuario.setdefault(e["user_id"], set()).add(a_fecha(e["fecha_inicio"]))
+            for user_id, dias in dias_por_usuario.items():
+                escribir_tramos({"_id": user_id}, None, (), ["PIAS"], dias)
                 
-            # 2. Insertar nuevos turnos
-            events_collection.insert_many(events)
-            invalidate_cache()
+            # 2. Escribir los nuevos turnos como tramos por usuario y tipo: se fusionan con los
+            # guardados, así que volver a guardar la misma vista previa no duplica ni recorta
+            usuarios = {str(u["_id"]): u for u in users_collection.find(
+                {"_id": {"$in": list(dias_por_usuario)}}, {"nombre": 1, "apellidos": 1})}
+            escribir_tramos_lote(cambios_de_eventos(events, usuarios))
+            fechas = [e["fecha_inicio"] for e in events]
+            registrar_cambio_eventos({e["user_id"] for e in events}, min(fechas), max(fechas))
             flash(f"Se han guardado {len(events)} turnos correctamente.", "success")
         else:
             flash("La lista de eventos estaba vacía.", "warning")
@@ -2365,63 +3224,54 @@ def save_shifts():
 def view_roster_select():
     return render_template('admin_view_roster_select.html', now=datetime.now())
 
-@app.route('/admin/view_roster', methods=['POST'])
+@app.route('/admin/view_roster', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def view_roster():
     try:
-        year = int(request.form.get('year'))
-        months_raw = request.form.getlist('months')
+        # GET permite que el navegador revalide el cuadrante con If-None-Match
+        year = int(request.values.get('year'))
+        months_raw = request.values.getlist('months')
         
         if not months_raw:
             flash("Selecciona al menos un mes.", "warning")
             return redirect(url_for('view_roster_select'))
             
         months = sorted([int(m) for m in months_raw])
+
+        etag = etag_para("view-roster", year, months)
+        if request.method == 'GET':
+            no_modificada = respuesta_no_modificada(etag)
+            if no_modificada:
+                return no_modificada
         
         # Calculate date range
         start_date = date(year, months[0], 1)
         _, last_day = monthrange(year, months[-1])
         end_date = date(year, months[-1], last_day)
         
-        start_str = start_date.strftime("%Y-%m-%d")
-        end_str = end_date.strftime("%Y-%m-%d")
-        
-        # Fetch Events
-        query = {
-            "fecha_inicio": {"$gte": start_str, "$lte": end_str}
-        }
-        events = list(events_collection.find(query))
-        
-        # Grouping Logic
+        # Grouping Logic (cells read from the shared status matrix)
         from collections import defaultdict
         
         # {WeekNum: {DayStr: {Type: [Users]}}}
         grouped_weeks = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        busy_users_by_day = defaultdict(set)
         
-        for r in events:
-            if 'fecha_inicio' not in r: continue
-            
-            d_obj = datetime.strptime(r['fecha_inicio'], "%Y-%m-%d")
-            week_num = d_obj.isocalendar()[1]
-            
-            tipo = r.get('tipo', 'Desconocido')
-            trabajador = r.get('trabajador', 'Desconocido')
-            
-            grouped_weeks[week_num][r['fecha_inicio']][tipo].append(trabajador)
+        # Matrix rows are user ids: resolve the current names once
+        nombres = nombres_por_id()
+        for day, types_dict in matriz_estados.tipos_por_dia(start_date, end_date).items():
+            day_str = day.strftime("%Y-%m-%d")
+            week_num = day.isocalendar()[1]
+            for tipo, user_ids in types_dict.items():
+                trabajadores = [nombres[uid] for uid in user_ids if uid in nombres]
+                grouped_weeks[week_num][day_str][tipo].extend(trabajadores)
+                busy_users_by_day[day_str].update(trabajadores)
         
         # --- Generate PIAS (Implicit Availability) ---
         # 1. Get all visible "TS" users (PIAS is only for TS)
-        all_users_cursor = users_collection.find({"visible_calendario": {"$ne": False}, "puesto": "TS"})
-        all_users = [f"{u['nombre']} {u['apellidos']}".strip() for u in all_users_cursor]
+        all_users = list(nombres_por_id({"visible_calendario": {"$ne": False}, "puesto": "TS"}).values())
         
-        # 2. Identify busy users per day from the events we just fetched
-        busy_users_by_day = defaultdict(set)
-        for r in events:
-            if 'fecha_inicio' in r and 'trabajador' in r:
-                busy_users_by_day[r['fecha_inicio']].add(r['trabajador'])
-        
-        # 3. Iterate through every day in the range to fill gaps
+        # 2. Iterate through every day in the range to fill gaps
         curr = start_date
         while curr <= end_date:
             day_str = curr.strftime("%Y-%m-%d")
@@ -2495,14 +3345,13 @@ def view_roster():
             except:
                 week_month_map[w] = ""
         
-        return render_template(
+        return con_etag(render_template(
             'roster_view.html',
             grouped_weeks=sorted_weeks,
             week_month_map=week_month_map,
             selected_year=year,
-            selected_months=months_raw,
-            results=events
-        )
+            selected_months=months_raw
+        ), etag)
         
     except Exception as e:
         import traceback
@@ -2531,8 +3380,10 @@ def export_roster():
         start_str = start_date.strftime("%Y-%m-%d")
         end_str = end_date.strftime("%Y-%m-%d")
         
+        # Tramos que solapan con el periodo (pueden empezar antes del primer mes)
         query = {
-            "fecha_inicio": {"$gte": start_str, "$lte": end_str}
+            "fecha_inicio": {"$lte": end_str},
+            "fecha_fin": {"$gte": start_str}
         }
         events = list(events_collection.find(query))
         
@@ -2540,21 +3391,22 @@ def export_roster():
             flash("No hay datos para exportar en ese periodo.", "warning")
             return redirect(url_for('view_roster_select'))
             
-        # Create DataFrame
+        # Create DataFrame (names resolved from user_id: the stored name may predate a rename)
+        nombres = nombres_por_id()
         data = []
         dias_semana = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
         
         for e in events:
-            d_str = e['fecha_inicio']
-            d_obj = datetime.strptime(d_str, "%Y-%m-%d")
-            dia_sem = dias_semana[d_obj.weekday()]
-            
-            data.append({
-                "Fecha": d_str,
-                "Día": dia_sem,
-                "Tipo Turno": e.get('tipo', ''),
-                "Trabajador": e.get('trabajador', '')
-            })
+            # Una fila por día del tramo dentro del periodo
+            for d_obj in dias_evento(e):
+                if not start_date <= d_obj <= end_date:
+                    continue
+                data.append({
+                    "Fecha": d_obj.strftime("%Y-%m-%d"),
+                    "Día": dias_semana[d_obj.weekday()],
+                    "Tipo Turno": e.get('tipo', ''),
+                    "Trabajador": nombres.get(str(e.get('user_id')), e.get('trabajador', ''))
+                })
             
         df = pd.DataFrame(data)
         df = df.sort_values(by=["Fecha", "Tipo Turno", "Trabajador"])
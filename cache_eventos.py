@@ -0,0 +1,401 @@
+"""Backends de caché para las respuestas del calendario y contador de versión compartido.
+
+Las entradas son segmentos mensuales del calendario: diccionarios {'data', 'version',
+'timestamp', 'mes', 'trabajadores'}. Cada escritura incrementa el contador de versión
+(en MongoDB, común a todos los workers) y deja en el diario de cambios qué trabajadores
+y fechas ha tocado; con eso sólo se descartan los segmentos de esos meses que incluyen
+a alguno de esos trabajadores. El resto del caché sigue caliente.
+"""
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+from pymongo import ReturnDocument
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 60
+
+
+class ContadorVersion:
+    """Contador monotónico guardado en un documento de MongoDB."""
+
+    def __init__(self, collection, nombre):
+        self.collection = collection
+        self.nombre = nombre
+
+    def actual(self):
+        doc = self.collection.find_one({"_id": self.nombre}, {"version": 1})
+        return doc["version"] if doc else 0
+
+    def incrementar(self):
+        doc = self.collection.find_one_and_update(
+            {"_id": self.nombre},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return doc["version"]
+
+
+class DiarioCambios:
+    """Registro de qué ha cambiado en cada versión de datos ({_id: versión, trabajadores, fechas})."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def registrar(self, version, trabajadores=None, fecha_inicio=None, fecha_fin=None, usuarios=False):
+        """`usuarios=True` indica que también cambió la colección de usuarios."""
+        self.collection.insert_one({
+            "_id": version,
+            "trabajadores": sorted(trabajadores) if trabajadores is not None else None,
+            "fecha_inicio": fecha_inicio,
+            "fecha_fin": fecha_fin,
+            "usuarios": bool(usuarios),
+            "creado": datetime.now(timezone.utc)
+        })
+
+    def entre(self, version_desde, version_hasta):
+        """Cambios con versión en (version_desde, version_hasta], en orden."""
+        return list(self.collection.find(
+            {"_id": {"$gt": version_desde, "$lte": version_hasta}}
+        ).sort("_id", 1))
+
+
+class NotificadorCambios:
+    """Hilo que vigila la versión de datos y despierta a quien espera cambios (p. ej. SSE).
+
+    Un único sondeo a MongoDB por proceso, da igual cuántas conexiones haya abiertas. Guarda
+    los últimos cambios del diario para entregarlos a cada conexión desde su versión.
+    """
+
+    def __init__(self, contador, diario, intervalo=2.0, max_cambios=500):
+        self.contador = contador
+        self.diario = diario
+        self.intervalo = intervalo
+        self.version = None
+        self._cambios = deque(maxlen=max_cambios)
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def _asegurar_hilo(self):
+        # El hilo se arranca en el primer uso de cada proceso (los hilos no sobreviven a un fork)
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.version = self.contador.actual()
+            self._cambios.clear()
+        threading.Thread(target=self._vigilar, name="notificador-cambios", daemon=True).start()
+
+    def _vigilar(self):
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                version = self.contador.actual()
+                if version == self.version:
+                    continue
+                cambios = self.diario.entre(self.version, version) if version > self.version else []
+                if len(cambios) != version - self.version:
+                    # Diario incompleto: se avisa de un cambio global
+                    cambios = [{"_id": version, "trabajadores": None, "fecha_inicio": None, "fecha_fin": None}]
+            except Exception as e:
+                print(f"⚠️ Notificador de cambios: {e}")
+                continue
+            with self._cond:
+                self._cambios.extend(cambios)
+                self.version = version
+                self._cond.notify_all()
+
+    def esperar(self, desde, timeout):
+        """Cambios posteriores a la versión `desde`; espera hasta `timeout` segundos si no hay."""
+        self._asegurar_hilo()
+        with self._cond:
+            self._cond.wait_for(lambda: self.version is not None and self.version > desde, timeout)
+            if self.version is None or self.version <= desde:
+                return []
+            cambios = [c for c in self._cambios if c["_id"] > desde]
+            if not cambios or cambios[0]["_id"] != desde + 1:
+                # La conexión viene de una versión que ya no está en memoria
+                return [{"_id": self.version, "trabajadores": None, "fecha_inicio": None, "fecha_fin": None}]
+            return cambios
+
+
+def meses_entre(mes_inicio, mes_fin):
+    """Lista de meses 'YYYY-MM' entre ambos extremos (incluidos)."""
+    anio, mes = int(mes_inicio[:4]), int(mes_inicio[5:7])
+    resultado = []
+    while f"{anio:04d}-{mes:02d}" <= mes_fin:
+        resultado.append(f"{anio:04d}-{mes:02d}")
+        anio, mes = (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+    return resultado
+
+
+def _afecta(entrada_mes, entrada_trabajadores, trabajadores, mes_inicio, mes_fin):
+    if mes_inicio is not None and entrada_mes < mes_inicio:
+        return False
+    if mes_fin is not None and entrada_mes > mes_fin:
+        return False
+    return trabajadores is None or not trabajadores.isdisjoint(entrada_trabajadores)
+
+
+def tamano_entrada(data):
+    """Bytes que ocupa el contenido de una entrada (exacto para payloads ya serializados)."""
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    if isinstance(data, (tuple, list)) and all(isinstance(d, (bytes, bytearray)) for d in data):
+        return sum(len(d) for d in data)
+    return len(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class CacheMemoria:
+    """LRU local al proceso, acotada en bytes y con caducidad por entrada."""
+    compartida = False
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._datos = OrderedDict()  # clave -> (entrada, tamaño)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Versión de la última invalidación por mes ('*' = todos): evita guardar segmentos
+        # calculados con datos anteriores a una escritura que ya se ha invalidado
+        self._invalidaciones = {}
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+        self.caducadas = 0
+        self.invalidadas = 0
+
+    def _eliminar(self, clave):
+        _, tamano = self._datos.pop(clave)
+        self._bytes -= tamano
+
+    def _obsoleta(self, mes, version):
+        limite = max(self._invalidaciones.get(mes, 0), self._invalidaciones.get("*", 0))
+        return version < limite
+
+    def get(self, clave):
+        """Devuelve la entrada si existe y no ha caducado."""
+        with self._lock:
+            item = self._datos.get(clave)
+            if item is None:
+                self.fallos += 1
+                return None
+            entrada = item[0]
+            if time.time() >= entrada["expira"]:
+                self._eliminar(clave)
+                self.caducadas += 1
+                self.fallos += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.aciertos += 1
+            return entrada
+
+    def set(self, clave, entrada, ttl=None):
+        tamano = tamano_entrada(entrada["data"])
+        if tamano > self.max_bytes:
+            return
+        entrada = dict(entrada, expira=time.time() + (ttl or self.ttl))
+        with self._lock:
+            if self._obsoleta(entrada["mes"], entrada["version"]):
+                return
+            if clave in self._datos:
+                self._eliminar(clave)
+            self._datos[clave] = (entrada, tamano)
+            self._bytes += tamano
+            while self._bytes > self.max_bytes:
+                self._eliminar(next(iter(self._datos)))
+                self.expulsiones += 1
+
+    def invalidar(self, version, trabajadores=None, mes_inicio=None, mes_fin=None):
+        """Descarta los segmentos de esos meses (None = abierto) que incluyen a esos trabajadores."""
+        trabajadores = set(trabajadores) if trabajadores is not None else None
+        with self._lock:
+            if mes_inicio is None or mes_fin is None:
+                self._invalidaciones["*"] = max(self._invalidaciones.get("*", 0), version)
+            else:
+                for mes in meses_entre(mes_inicio, mes_fin):
+                    self._invalidaciones[mes] = max(self._invalidaciones.get(mes, 0), version)
+            for clave, (entrada, _) in list(self._datos.items()):
+                if _afecta(entrada["mes"], entrada["trabajadores"], trabajadores, mes_inicio, mes_fin):
+                    self._eliminar(clave)
+                    self.invalidadas += 1
+
+    def clear(self, version=0):
+        with self._lock:
+            self._invalidaciones["*"] = max(self._invalidaciones.get("*", 0), version)
+            self._datos.clear()
+            self._bytes = 0
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "backend": "memoria",
+                "entradas": len(self._datos),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "expulsiones": self.expulsiones,
+                "caducadas": self.caducadas,
+                "invalidadas": self.invalidadas,
+            }
+
+    def __len__(self):
+        return len(self._datos)
+
+
+class CacheSQLite:
+    """LRU compartida por todos los workers de la misma máquina en un fichero SQLite.
+
+    Los contadores de aciertos/fallos son del proceso actual; el tamaño y las entradas
+    son los del fichero compartido.
+    """
+    compartida = True
+
+    def __init__(self, ruta, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.ruta = ruta
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+        self.caducadas = 0
+        self.invalidadas = 0
+        self._local = threading.local()
+        con = self._conexion()
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS cache_segmentos ("
+            "clave TEXT PRIMARY KEY, valor BLOB NOT NULL, version INTEGER NOT NULL, "
+            "timestamp REAL NOT NULL, expira REAL NOT NULL, tamano INTEGER NOT NULL, acceso REAL NOT NULL, "
+            "mes TEXT NOT NULL, trabajadores TEXT NOT NULL)"
+        )
+        con.execute("CREATE INDEX IF NOT EXISTS cache_segmentos_acceso ON cache_segmentos (acceso)")
+        con.execute("CREATE INDEX IF NOT EXISTS cache_segmentos_mes ON cache_segmentos (mes)")
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS cache_invalidaciones (mes TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+        )
+
+    def _conexion(self):
+        # Una conexión por hilo y proceso: no se reutilizan conexiones heredadas de un fork
+        con = getattr(self._local, "con", None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.ruta, timeout=5, isolation_level=None, check_same_thread=False)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    def get(self, clave):
+        con = self._conexion()
+        fila = con.execute(
+            "SELECT valor, version, timestamp, expira, mes, trabajadores FROM cache_segmentos WHERE clave = ?",
+            (clave,)
+        ).fetchone()
+        if fila is None:
+            self.fallos += 1
+            return None
+        ahora = time.time()
+        if ahora >= fila[3]:
+            con.execute("DELETE FROM cache_segmentos WHERE clave = ?", (clave,))
+            self.caducadas += 1
+            self.fallos += 1
+            return None
+        con.execute("UPDATE cache_segmentos SET acceso = ? WHERE clave = ?", (ahora, clave))
+        self.aciertos += 1
+        return {
+            "data": pickle.loads(fila[0]), "version": fila[1], "timestamp": fila[2], "expira": fila[3],
+            "mes": fila[4], "trabajadores": json.loads(fila[5])
+        }
+
+    def set(self, clave, entrada, ttl=None):
+        valor = pickle.dumps(entrada["data"], protocol=pickle.HIGHEST_PROTOCOL)
+        if len(valor) > self.max_bytes:
+            return
+        ahora = time.time()
+        con = self._conexion()
+        # Sólo se guarda si ninguna invalidación posterior al cálculo afecta a ese mes
+        cursor = con.execute(
+            "INSERT OR REPLACE INTO cache_segmentos "
+            "(clave, valor, version, timestamp, expira, tamano, acceso, mes, trabajadores) "
+            "SELECT ?, ?, ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS ("
+            "SELECT 1 FROM cache_invalidaciones WHERE mes IN (?, '*') AND version > ?)",
+            (clave, valor, entrada["version"], entrada["timestamp"], ahora + (ttl or self.ttl), len(valor), ahora,
+             entrada["mes"], json.dumps(sorted(entrada["trabajadores"])), entrada["mes"], entrada["version"])
+        )
+        if not cursor.rowcount:
+            return
+        total = con.execute("SELECT COALESCE(SUM(tamano), 0) FROM cache_segmentos").fetchone()[0]
+        while total > self.max_bytes:
+            fila = con.execute(
+                "SELECT clave, tamano FROM cache_segmentos WHERE clave != ? ORDER BY acceso LIMIT 1", (clave,)
+            ).fetchone()
+            if fila is None:
+                break
+            con.execute("DELETE FROM cache_segmentos WHERE clave = ?", (fila[0],))
+            total -= fila[1]
+            self.expulsiones += 1
+
+    def _registrar_invalidacion(self, con, meses, version):
+        con.executemany(
+            "INSERT INTO cache_invalidaciones (mes, version) VALUES (?, ?) "
+            "ON CONFLICT(mes) DO UPDATE SET version = MAX(version, excluded.version)",
+            [(mes, version) for mes in meses]
+        )
+
+    def invalidar(self, version, trabajadores=None, mes_inicio=None, mes_fin=None):
+        """Descarta los segmentos de esos meses (None = abierto) que incluyen a esos trabajadores."""
+        trabajadores = set(trabajadores) if trabajadores is not None else None
+        con = self._conexion()
+        if mes_inicio is None or mes_fin is None:
+            self._registrar_invalidacion(con, ["*"], version)
+        else:
+            self._registrar_invalidacion(con, meses_entre(mes_inicio, mes_fin), version)
+        filas = con.execute(
+            "SELECT clave, mes, trabajadores FROM cache_segmentos WHERE mes >= ? AND mes <= ?",
+            (mes_inicio or "", mes_fin or "9999-12")
+        ).fetchall()
+        claves = [
+            (clave,) for clave, mes, nombres in filas
+            if _afecta(mes, json.loads(nombres), trabajadores, mes_inicio, mes_fin)
+        ]
+        if claves:
+            con.executemany("DELETE FROM cache_segmentos WHERE clave = ?", claves)
+            self.invalidadas += len(claves)
+
+    def clear(self, version=0):
+        con = self._conexion()
+        self._registrar_invalidacion(con, ["*"], version)
+        con.execute("DELETE FROM cache_segmentos")
+
+    def estadisticas(self):
+        entradas, total = self._conexion().execute(
+            "SELECT COUNT(*), COALESCE(SUM(tamano), 0) FROM cache_segmentos"
+        ).fetchone()
+        return {
+            "backend": "sqlite",
+            "entradas": entradas,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "expulsiones": self.expulsiones,
+            "caducadas": self.caducadas,
+            "invalidadas": self.invalidadas,
+        }
+
+    def __len__(self):
+        return self._conexion().execute("SELECT COUNT(*) FROM cache_segmentos").fetchone()[0]
+
+
+def crear_cache(backend, ruta_sqlite=None, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+    """Devuelve el backend configurado ('memoria' por defecto o 'sqlite')."""
+    if backend == "sqlite":
+        return CacheSQLite(ruta_sqlite or "cache_eventos.sqlite3", max_bytes, ttl)
+    return CacheMemoria(max_bytes, ttl)
@@ -0,0 +1,67 @@
+"""Campos derivados de las fechas de un evento, guardados al escribirlo.
+
+Las fechas se guardan como texto 'YYYY-MM-DD', así que filtrar por rango obligaba a
+convertirlas en cada documento ($toDate/$dateToString). Cada evento lleva además
+`dia_inicio`/`dia_fin`: ordinal del primer y último día del tramo (date.toordinal),
+numéricos e indexables.
+
+La etapa `etapa_dias` calcula lo mismo dentro de MongoDB para migrar los eventos antiguos
+con un único update_many (pipeline de actualización, MongoDB >= 4.2).
+
+`dia_inicio` forma parte además de la clave única (user_id, dia_inicio, tipo): las escrituras
+son upserts sobre esa clave, así que repetir una petición no crea duplicados.
+"""
+from datetime import date, datetime
+
+# Clave del índice único de eventos: un documento por trabajador, día de inicio y tipo
+CLAVE_UNICA = ("user_id", "dia_inicio", "tipo")
+
+# date(1970, 1, 1).toordinal(): pasa de milisegundos desde epoch a ordinal dentro de Mongo
+ORDINAL_EPOCH = 719163
+MS_DIA = 86400000
+
+
+def _a_fecha(valor):
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    try:
+        return datetime.strptime(str(valor)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def campos_fecha(fecha_inicio, fecha_fin):
+    """Campos derivados para un evento nuevo ({} si la fecha de inicio no es válida)."""
+    inicio = _a_fecha(fecha_inicio)
+    if inicio is None:
+        return {}
+    fin = _a_fecha(fecha_fin) or inicio
+    return {"dia_inicio": inicio.toordinal(), "dia_fin": fin.toordinal()}
+
+
+def clave_unica(evento):
+    """Filtro del upsert idempotente de un evento (campos de CLAVE_UNICA)."""
+    return {campo: evento.get(campo) for campo in CLAVE_UNICA}
+
+
+def _fecha_expr(campo):
+    """Fecha del campo (texto o date de Mongo) o null si no se puede interpretar."""
+    texto = {"$substrBytes": [{"$convert": {"input": campo, "to": "string", "onError": "", "onNull": ""}}, 0, 10]}
+    return {"$dateFromString": {"dateString": texto, "format": "%Y-%m-%d", "onError": None, "onNull": None}}
+
+
+def _ordinal_expr(fecha):
+    return {"$add": [{"$toLong": {"$floor": {"$divide": [{"$toLong": fecha}, MS_DIA]}}}, ORDINAL_EPOCH]}
+
+
+def etapa_dias():
+    """Etapa $set que calcula dia_inicio y dia_fin a partir de las fechas en texto."""
+    return {"$set": {
+        "dia_inicio": {"$let": {"vars": {"f": _fecha_expr("$fecha_inicio")}, "in": _ordinal_expr("$$f")}},
+        "dia_fin": {"$let": {
+            "vars": {"f": {"$ifNull": [_fecha_expr("$fecha_fin"), _fecha_expr("$fecha_inicio")]}},
+            "in": _ordinal_expr("$$f")
+        }},
+    }}
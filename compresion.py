@@ -0,0 +1,60 @@
+"""Compresión HTTP (gzip y, si está instalado el paquete `brotli`, br).
+
+Las respuestas normales se comprimen enteras en un hook de Flask. El calendario se envía
+en streaming a partir de segmentos mensuales cacheados, así que para él se guarda cada
+segmento ya comprimido como bloques deflate independientes (Z_FULL_FLUSH); al servir la
+respuesta basta con encadenarlos entre la cabecera y la cola gzip.
+"""
+import gzip
+import struct
+import zlib
+
+try:
+    import brotli
+except ImportError:  # Opcional: sin el paquete sólo se ofrece gzip
+    brotli = None
+
+NIVEL_GZIP = 6
+CABECERA_GZIP = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+CODIFICACIONES = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def elegir_codificacion(accept_encodings, permitidas=None):
+    """Mejor codificación aceptada por el cliente entre las disponibles (None = sin comprimir)."""
+    return accept_encodings.best_match(permitidas or CODIFICACIONES)
+
+
+def comprimir(datos, codificacion):
+    if codificacion == "br":
+        return brotli.compress(datos, quality=5)
+    return gzip.compress(datos, compresslevel=NIVEL_GZIP, mtime=0)
+
+
+def deflate_bloque(datos):
+    """Bloques deflate sin cabecera que se pueden concatenar con otros (sin diccionario compartido)."""
+    compresor = zlib.compressobj(NIVEL_GZIP, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compresor.compress(datos) + compresor.flush(zlib.Z_FULL_FLUSH)
+
+
+# Bloque deflate final vacío que cierra el flujo
+DEFLATE_FINAL = zlib.compressobj(NIVEL_GZIP, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+
+
+class GzipEnStreaming:
+    """Construye un gzip válido a partir de fragmentos, comprimidos al vuelo o de antemano."""
+
+    def __init__(self):
+        self.crc = 0
+        self.longitud = 0
+
+    def cabecera(self):
+        return CABECERA_GZIP
+
+    def fragmento(self, datos, comprimido=None):
+        """Bytes a enviar para `datos`; `comprimido` es su deflate_bloque() si ya se tiene."""
+        self.crc = zlib.crc32(datos, self.crc)
+        self.longitud += len(datos)
+        return comprimido if comprimido is not None else deflate_bloque(datos)
+
+    def cola(self):
+        return DEFLATE_FINAL + struct.pack("<II", self.crc & 0xFFFFFFFF, self.longitud & 0xFFFFFFFF)
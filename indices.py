@@ -0,0 +1,143 @@
+"""Registro declarativo de los índices de MongoDB que necesitan las consultas de la app.
+
+`asegurar_indices` crea los que falten. Se ejecuta una vez al arrancar cada worker (sólo
+lista los índices existentes si no falta ninguno) y también con `flask --app app crear-indices`.
+El índice único `evento_unico` no se puede crear mientras haya duplicados (se avisa y se
+reintenta en el siguiente arranque): `flask --app app deduplicar-eventos` los quita y lo crea.
+`diagnosticar_consultas` ejecuta `explain` sobre las consultas representativas y marca las
+que acaban en un recorrido completo de la colección (COLLSCAN).
+"""
+from datetime import date, datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+# coleccion -> [(claves, opciones, consultas que lo usan)]
+INDICES = {
+    "eventos": [
+        ([("user_id", ASCENDING), ("tipo", ASCENDING), ("fecha_inicio", ASCENDING)],
+         {"name": "user_id_tipo_fecha"},
+         "vacaciones_por_dia, repair_schedule, migrar_user_id, compactar_tramos"),
+        ([("fecha_inicio", ASCENDING), ("tipo", ASCENDING)],
+         {"name": "fecha_tipo"},
+         "load_existing_events, get_annual_balance, export_roster, duplicados"),
+        ([("user_id", ASCENDING), ("fecha_fin", ASCENDING), ("fecha_inicio", ASCENDING)],
+         {"name": "user_id_rango"},
+         "MatrizEstados.recargar, delete_user, escribir_tramos (add_vacation, asignar_estados, add_recurring), "
+         "approve_vacations_conflicts ($lookup por user_id)"),
+        ([("user_id", ASCENDING), ("dia_inicio", ASCENDING), ("tipo", ASCENDING)],
+         {"name": "evento_unico", "unique": True,
+          "partialFilterExpression": {"user_id": {"$exists": True}, "dia_inicio": {"$exists": True}}},
+         "upserts de escribir_tramos, events (POST), save_shifts y ShiftGenerator; deduplicar_eventos"),
+        ([("dia_inicio", ASCENDING)], {"name": "dia_inicio"},
+         "migrar_campos_fecha, clean_redundant_duplicates con rango (filtro_solape)"),
+        ([("tipo", ASCENDING), ("dia_inicio", ASCENDING)], {"name": "tipo_dia"},
+         "approve_vacations_conflicts (vacaciones del rango)"),
+    ],
+    "usuarios": [
+        ([("usuario", ASCENDING)], {"name": "usuario"}, "login, add_user, edit_user"),
+        ([("visible_calendario", ASCENDING), ("puesto", ASCENDING)],
+         {"name": "visible_puesto"},
+         "events, view_roster, asignar_estados"),
+    ],
+    "historial_conversaciones": [
+        ([("usuario", ASCENDING), ("timestamp", DESCENDING)],
+         {"name": "usuario_timestamp"},
+         "ai_response (últimos mensajes del usuario)"),
+        ([("timestamp", ASCENDING)], {"name": "timestamp"}, "informe_uso_ia"),
+    ],
+    "cambios_datos": [
+        ([("creado", ASCENDING)], {"expireAfterSeconds": 86400},
+         "diario de cambios (caduca a las 24 h)"),
+    ],
+}
+
+
+def _nombre_indice(claves, opciones):
+    """Nombre con el que queda el índice en MongoDB (el de pymongo si no se indica uno)."""
+    return opciones.get("name") or "_".join(f"{campo}_{orden}" for campo, orden in claves)
+
+
+def asegurar_indices(db):
+    """Crea los índices del registro que no existan todavía.
+
+    Se compara por nombre con los que ya hay, así que con todo creado sólo cuesta un
+    listIndexes por colección y no se lanza ningún create_index.
+    """
+    for coleccion, indices in INDICES.items():
+        try:
+            existentes = set(db[coleccion].index_information())
+        except Exception as e:
+            print(f"⚠️ No se pudieron listar los índices de {coleccion}: {e}")
+            existentes = set()
+        for claves, opciones, _ in indices:
+            if _nombre_indice(claves, opciones) in existentes:
+                continue
+            try:
+                db[coleccion].create_index(claves, **opciones)
+            except Exception as e:
+                print(f"⚠️ No se pudo crear el índice {opciones.get('name', claves)} en {coleccion}: {e}")
+
+
+def _consultas_diagnostico():
+    """Consultas representativas: (nombre, colección, filtro, orden)."""
+    hoy = date.today()
+    inicio_mes = hoy.replace(day=1).strftime("%Y-%m-%d")
+    fin_mes = (hoy.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    fin_mes = fin_mes.strftime("%Y-%m-%d")
+    user_id = ObjectId("000000000000000000000000")
+    return [
+        ("vacaciones_por_dia", "eventos",
+         {"user_id": user_id, "tipo": "Vacaciones"}, [("fecha_inicio", ASCENDING)]),
+        ("load_existing_events / export_roster", "eventos",
+         {"fecha_inicio": {"$lte": fin_mes}, "fecha_fin": {"$gte": inicio_mes}}, None),
+        ("get_annual_balance", "eventos",
+         {"fecha_inicio": {"$lte": f"{hoy.year}-12-31"}, "fecha_fin": {"$gte": f"{hoy.year}-01-01"}}, None),
+        ("repair_schedule", "eventos",
+         {"user_id": user_id, "fecha_inicio": {"$lte": fin_mes}, "fecha_fin": {"$gte": inicio_mes},
+          "tipo": {"$nin": ["Vacaciones", "Baja", "Baja Médica", "Ausencia"]}}, None),
+        ("MatrizEstados.recargar", "eventos",
+         {"user_id": {"$in": [user_id]}, "fecha_inicio": {"$lte": fin_mes},
+          "fecha_fin": {"$gte": inicio_mes}}, None),
+        ("repair_schedule (eventos del día)", "eventos",
+         {"fecha_inicio": {"$lte": inicio_mes}, "fecha_fin": {"$gte": inicio_mes}}, None),
+        ("upsert por clave única", "eventos",
+         {"user_id": user_id, "dia_inicio": hoy.toordinal(), "tipo": "Vacaciones"}, None),
+        ("migrar_campos_fecha", "eventos", {"dia_inicio": {"$exists": False}}, None),
+        ("approve_vacations_conflicts (vacaciones del rango)", "eventos",
+         {"tipo": "Vacaciones", "dia_inicio": {"$lte": hoy.toordinal()},
+          "dia_fin": {"$gte": hoy.replace(day=1).toordinal()}}, None),
+        ("events (usuarios visibles)", "usuarios",
+         {"visible_calendario": {"$ne": False}, "puesto": "TS"}, None),
+        ("login", "usuarios", {"usuario": "diagnostico"}, None),
+        ("ai_response (historial)", "historial_conversaciones",
+         {"usuario": "diagnostico"}, [("timestamp", DESCENDING)]),
+        ("informe_uso_ia", "historial_conversaciones",
+         {"timestamp": {"$gte": datetime.combine(hoy, datetime.min.time())}}, None),
+    ]
+
+
+def _etapas(plan):
+    """Todas las etapas (stage) de un plan de ejecución, recorriendo sus hijos."""
+    etapas = [plan]
+    for clave in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(clave), dict):
+            etapas.extend(_etapas(plan[clave]))
+    for hijo in plan.get("inputStages", []):
+        etapas.extend(_etapas(hijo))
+    return etapas
+
+
+def diagnosticar_consultas(db):
+    """Devuelve [(nombre, colección, índices usados, usa_collscan)] para cada consulta."""
+    resultado = []
+    for nombre, coleccion, filtro, orden in _consultas_diagnostico():
+        cursor = db[coleccion].find(filtro)
+        if orden:
+            cursor = cursor.sort(orden)
+        plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        etapas = _etapas(plan)
+        indices = sorted({e["indexName"] for e in etapas if e.get("indexName")})
+        collscan = any(e.get("stage") == "COLLSCAN" for e in etapas)
+        resultado.append((nombre, coleccion, indices, collscan))
+    return resultado
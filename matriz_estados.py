@@ -0,0 +1,325 @@
+"""Matriz en memoria (trabajador x día) con los estados del calendario.
+
+Las filas se identifican por el valor del campo `campo` de cada evento (en la app,
+`user_id`, para que renombrar un usuario no cambie su fila).
+
+Cada celda es una máscara de bits con los tipos de evento que cubren ese día para
+ese trabajador. Los tipos prioritarios del calendario ocupan los primeros bits en
+su orden de prioridad, así que el estado que se muestra es el bit activo más bajo.
+Junto a la máscara se guarda cuántos eventos cubren cada celda: dos tramos del mismo
+tipo que se solapan (con distinto día de inicio) no se ven en los bits.
+La matriz se carga una vez desde MongoDB y después sólo se recalculan las celdas
+que tocan las escrituras.
+"""
+import threading
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+# Una celda uint32 admite hasta 32 tipos de evento distintos
+MAX_TIPOS = 32
+CAMPOS_EVENTO = ["tipo", "fecha_inicio", "fecha_fin"]
+
+
+def _parse_fecha(valor):
+    """Devuelve un `date` a partir de un string 'YYYY-MM-DD', datetime o date."""
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    try:
+        return datetime.strptime(str(valor)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+class MatrizEstados:
+    def __init__(self, collection, tipos_prioritarios, es_dia_habil, inicio, fin,
+                 campo="trabajador", valor_consulta=None):
+        """`valor_consulta` convierte una clave de fila (siempre str) al tipo guardado en Mongo."""
+        self.collection = collection
+        self.campo = campo
+        self.valor_consulta = valor_consulta or (lambda clave: clave)
+        self.proyeccion = {c: 1 for c in [campo] + CAMPOS_EVENTO}
+        self.tipos_prioritarios = list(tipos_prioritarios)
+        self.es_dia_habil = es_dia_habil
+        self.inicio_base = inicio
+        self.fin_base = fin
+        self.cargada = False
+        self._lock = threading.RLock()
+        self._reiniciar()
+
+    def _reiniciar(self):
+        self.tipos = list(self.tipos_prioritarios)
+        self.indice_tipos = {tipo: idx for idx, tipo in enumerate(self.tipos)}
+        self.filas = {}
+        self.nombres = []
+        self.origen = self.inicio_base
+        n_dias = (self.fin_base - self.inicio_base).days + 1
+        self.datos = np.zeros((0, n_dias), dtype=np.uint32)
+        self.cuenta = np.zeros((0, n_dias), dtype=np.uint16)  # Eventos que cubren cada celda
+
+    # ------------------------------------------------------------------
+    # Estructura interna
+    # ------------------------------------------------------------------
+    def _fila(self, trabajador):
+        fila = self.filas.get(trabajador)
+        if fila is None:
+            fila = len(self.nombres)
+            if fila >= self.datos.shape[0]:
+                extra = np.zeros((max(fila, 16), self.datos.shape[1]), dtype=np.uint32)
+                self.datos = np.vstack([self.datos, extra])
+                self.cuenta = np.vstack([self.cuenta, extra.astype(np.uint16)])
+            self.filas[trabajador] = fila
+            self.nombres.append(trabajador)
+        return fila
+
+    def _bit(self, tipo):
+        idx = self.indice_tipos.get(tipo)
+        if idx is None:
+            if len(self.tipos) >= MAX_TIPOS:
+                print(f"⚠️ Matriz de estados: se ignora el tipo '{tipo}' (máximo {MAX_TIPOS} tipos)")
+                return None
+            idx = len(self.tipos)
+            self.tipos.append(tipo)
+            self.indice_tipos[tipo] = idx
+        return np.uint32(1 << idx)
+
+    def _asegurar_columnas(self, inicio, fin):
+        if inicio < self.origen:
+            extra = (self.origen - inicio).days
+            relleno = np.zeros((self.datos.shape[0], extra), dtype=np.uint32)
+            self.datos = np.hstack([relleno, self.datos])
+            self.cuenta = np.hstack([relleno.astype(np.uint16), self.cuenta])
+            self.origen = inicio
+        ultimo = self.origen + timedelta(days=self.datos.shape[1] - 1)
+        if fin > ultimo:
+            extra = (fin - ultimo).days
+            relleno = np.zeros((self.datos.shape[0], extra), dtype=np.uint32)
+            self.datos = np.hstack([self.datos, relleno])
+            self.cuenta = np.hstack([self.cuenta, relleno.astype(np.uint16)])
+
+    def _aplicar_evento(self, evento, limite_inicio=None, limite_fin=None):
+        trabajador = evento.get(self.campo)
+        trabajador = str(trabajador) if trabajador else None
+        inicio = _parse_fecha(evento.get("fecha_inicio"))
+        fin = _parse_fecha(evento.get("fecha_fin", evento.get("fecha_inicio")))
+        if not trabajador or inicio is None or fin is None:
+            return
+        if limite_inicio is not None:
+            inicio = max(inicio, limite_inicio)
+        if limite_fin is not None:
+            fin = min(fin, limite_fin)
+        if fin < inicio:
+            return
+        bit = self._bit(evento.get("tipo", "Vacaciones"))
+        if bit is None:
+            return
+        self._asegurar_columnas(inicio, fin)
+        fila = self._fila(trabajador)
+        c0 = (inicio - self.origen).days
+        c1 = (fin - self.origen).days + 1
+        self.datos[fila, c0:c1] |= bit
+        self.cuenta[fila, c0:c1] += 1
+
+    def _mascara_habiles(self, inicio, n_dias):
+        return np.array(
+            [self.es_dia_habil(inicio + timedelta(days=i)) for i in range(n_dias)],
+            dtype=bool
+        )
+
+    def _submatriz(self, trabajadores, inicio, fin, matriz=None):
+        """Copia de las celdas (trabajadores x días del rango); ceros donde no hay datos.
+
+        `matriz` elige de qué array se copia (por defecto las máscaras; `self.cuenta` para
+        el número de eventos)."""
+        matriz = self.datos if matriz is None else matriz
+        n_dias = (fin - inicio).days + 1
+        resultado = np.zeros((len(trabajadores), max(n_dias, 0)), dtype=matriz.dtype)
+        if n_dias <= 0:
+            return resultado
+        c0 = (inicio - self.origen).days
+        d0 = max(c0, 0)
+        d1 = min(c0 + n_dias, self.datos.shape[1])
+        if d0 < d1:
+            posiciones = [(i, self.filas[t]) for i, t in enumerate(trabajadores) if t in self.filas]
+            if posiciones:
+                destino = [p[0] for p in posiciones]
+                origen = [p[1] for p in posiciones]
+                resultado[destino, d0 - c0:d1 - c0] = matriz[origen, d0:d1]
+        return resultado
+
+    # ------------------------------------------------------------------
+    # Carga y actualización incremental
+    # ------------------------------------------------------------------
+    def cargar(self):
+        """Construye la matriz completa a partir de la colección de eventos."""
+        with self._lock:
+            self._reiniciar()
+            for evento in self.collection.find({}, self.proyeccion):
+                self._aplicar_evento(evento)
+            self.cargada = True
+            print(f"🧮 Matriz de estados cargada: {len(self.nombres)} trabajadores x {self.datos.shape[1]} días")
+
+    def marcar_obsoleta(self):
+        """Fuerza una recarga completa en la próxima lectura (p. ej. tras escrituras de otro proceso)."""
+        with self._lock:
+            self.cargada = False
+
+    def _asegurar_cargada(self):
+        if not self.cargada:
+            self.cargar()
+
+    def recargar(self, trabajadores=None, fecha_inicio=None, fecha_fin=None):
+        """Recalcula sólo las celdas de los trabajadores y fechas indicados.
+
+        `trabajadores=None` afecta a todas las filas; un extremo de fecha a None deja
+        el rango abierto por ese lado.
+        """
+        with self._lock:
+            if not self.cargada:
+                return
+            inicio = _parse_fecha(fecha_inicio) if fecha_inicio else None
+            fin = _parse_fecha(fecha_fin) if fecha_fin else None
+            if inicio and fin and fin < inicio:
+                inicio, fin = fin, inicio
+
+            query = {}
+            if trabajadores is not None:
+                trabajadores = [str(t) for t in set(trabajadores) if t]
+                if not trabajadores:
+                    return
+                query[self.campo] = {"$in": [self.valor_consulta(t) for t in trabajadores]}
+                filas = [self.filas[t] for t in trabajadores if t in self.filas]
+            else:
+                filas = list(range(len(self.nombres)))
+            if fin is not None:
+                query["fecha_inicio"] = {"$lte": fin.strftime("%Y-%m-%d")}
+            if inicio is not None:
+                query["fecha_fin"] = {"$gte": inicio.strftime("%Y-%m-%d")}
+
+            c0 = 0 if inicio is None else max((inicio - self.origen).days, 0)
+            c1 = self.datos.shape[1] if fin is None else min((fin - self.origen).days + 1, self.datos.shape[1])
+            if filas and c0 < c1:
+                self.datos[filas, c0:c1] = 0
+                self.cuenta[filas, c0:c1] = 0
+
+            for evento in self.collection.find(query, self.proyeccion):
+                self._aplicar_evento(evento, inicio, fin)
+
+    # ------------------------------------------------------------------
+    # Lecturas
+    # ------------------------------------------------------------------
+    def codigos_prioritarios(self, trabajadores, inicio, fin):
+        """Índice en `tipos_prioritarios` del estado de cada trabajador/día (-1 = libre).
+
+        Devuelve una lista de listas (una fila por trabajador, una columna por día).
+        """
+        with self._lock:
+            self._asegurar_cargada()
+            sub = self._submatriz(list(trabajadores), inicio, fin)
+        mascara = np.uint32((1 << len(self.tipos_prioritarios)) - 1)
+        sub &= mascara
+        bit_bajo = sub & (~sub + np.uint32(1))
+        codigos = np.full(sub.shape, -1, dtype=np.int16)
+        activos = bit_bajo != 0
+        codigos[activos] = np.log2(bit_bajo[activos]).astype(np.int16)
+        return codigos.tolist()
+
+    def contar_por_tipo(self, trabajadores=None, inicio=None, fin=None, solo_habiles=True):
+        """Días por tipo y trabajador en el rango: {trabajador: {tipo: dias}} (sólo > 0)."""
+        with self._lock:
+            self._asegurar_cargada()
+            if trabajadores is None:
+                trabajadores = list(self.nombres)
+            inicio = inicio or self.origen
+            fin = fin or (self.origen + timedelta(days=self.datos.shape[1] - 1))
+            sub = self._submatriz(list(trabajadores), inicio, fin)
+            tipos = list(self.tipos)
+        if solo_habiles and sub.shape[1]:
+            sub = sub[:, self._mascara_habiles(inicio, sub.shape[1])]
+
+        resultado = {}
+        presentes = int(np.bitwise_or.reduce(sub, axis=None)) if sub.size else 0
+        for idx, tipo in enumerate(tipos):
+            if not presentes & (1 << idx):
+                continue
+            conteos = ((sub >> np.uint32(idx)) & np.uint32(1)).sum(axis=1)
+            for fila, total in zip(np.nonzero(conteos)[0], conteos[conteos > 0]):
+                resultado.setdefault(trabajadores[fila], {})[tipo] = int(total)
+        return resultado
+
+    def tipos_por_dia(self, inicio, fin):
+        """{date: {tipo: [trabajadores]}} con todas las celdas ocupadas del rango."""
+        with self._lock:
+            self._asegurar_cargada()
+            nombres = list(self.nombres)
+            sub = self._submatriz(nombres, inicio, fin)
+            tipos = list(self.tipos)
+
+        resultado = {}
+        filas, columnas = np.nonzero(sub)
+        for fila, columna in zip(filas.tolist(), columnas.tolist()):
+            valor = int(sub[fila, columna])
+            dia = inicio + timedelta(days=columna)
+            por_tipo = resultado.setdefault(dia, {})
+            for idx, tipo in enumerate(tipos):
+                if valor & (1 << idx):
+                    por_tipo.setdefault(tipo, []).append(nombres[fila])
+        return resultado
+
+    def _celdas_con_conflicto(self, inicio, fin, solo_habiles, trabajadores=None):
+        """(trabajadores, tipos, inicio, máscara de celdas con más de un evento, submatriz, cuentas)."""
+        with self._lock:
+            self._asegurar_cargada()
+            inicio = inicio or self.origen
+            fin = fin or (self.origen + timedelta(days=self.datos.shape[1] - 1))
+            trabajadores = list(self.nombres) if trabajadores is None else [str(t) for t in trabajadores]
+            sub = self._submatriz(trabajadores, inicio, fin)
+            cuentas = self._submatriz(trabajadores, inicio, fin, self.cuenta)
+            tipos = list(self.tipos)
+        # Dos tipos implican dos eventos; la cuenta además detecta tramos repetidos del mismo tipo
+        varios = cuentas > 1
+        if solo_habiles and sub.shape[1]:
+            varios &= self._mascara_habiles(inicio, sub.shape[1])[np.newaxis, :]
+        return trabajadores, tipos, inicio, varios, sub, cuentas
+
+    def hay_conflictos(self, inicio=None, fin=None, solo_habiles=True):
+        """True si algún trabajador tiene más de un evento (del mismo tipo o no) el mismo día en el rango."""
+        return bool(self._celdas_con_conflicto(inicio, fin, solo_habiles)[3].any())
+
+    def conflictos(self, inicio=None, fin=None, solo_habiles=True, trabajadores=None, despues=None, limite=None):
+        """Celdas con más de un evento: [(día, trabajador, [tipos], eventos)] ordenadas por día y trabajador.
+
+        Si `eventos` es mayor que el número de tipos hay tramos del mismo tipo que se solapan.
+
+        La matriz se mantiene al día en cada escritura, así que el coste es el de recorrer la
+        submatriz en memoria y el resultado es proporcional al número de conflictos.
+        `trabajadores` limita las filas; `despues` es la clave (día, trabajador) de la última
+        celda ya servida (paginación por clave) y `limite` corta el resultado.
+        """
+        if despues is not None:
+            inicio = max(inicio or despues[0], despues[0])
+            if fin is not None and fin < inicio:
+                return []
+        trabajadores, tipos, inicio, varios, sub, cuentas = self._celdas_con_conflicto(inicio, fin, solo_habiles, trabajadores)
+        columnas, filas = np.nonzero(varios.T)  # Ordenadas por día
+        resultado = []
+        for columna, fila in sorted(zip(columnas.tolist(), filas.tolist()), key=lambda c: (c[0], trabajadores[c[1]])):
+            clave = (inicio + timedelta(days=columna), trabajadores[fila])
+            if despues is not None and clave <= despues:
+                continue
+            valor = int(sub[fila, columna])
+            presentes = [tipo for idx, tipo in enumerate(tipos) if valor & (1 << idx)]
+            resultado.append((clave[0], clave[1], presentes, int(cuentas[fila, columna])))
+            if limite is not None and len(resultado) >= limite:
+                break
+        return resultado
+
+    def tipos_presentes(self):
+        """Tipos que aparecen en al menos una celda de la matriz."""
+        with self._lock:
+            self._asegurar_cargada()
+            usados = self.datos[:len(self.nombres)]
+            presentes = int(np.bitwise_or.reduce(usados, axis=None)) if usados.size else 0
+            return [tipo for idx, tipo in enumerate(self.tipos) if presentes & (1 << idx)]
@@ -4,16 +4,20 @@ from calendar import monthrange
 import random
 from collections import defaultdict, deque
 from bson import ObjectId
+from pymongo import DeleteMany, UpdateOne
+from campos_fecha import campos_fecha, clave_unica
+from tramos_eventos import dias_entre, dias_evento, recortar
 
 # Importar referencias a la BD desde app (asumiendo que están inicializadas allí)
 # Si esto causa problemas de importación circular, moveremos la inicialización aquí.
 try:
-    from app import users_collection, events_collection, es_dia_habil, FESTIVOS_DATES
+    from app import users_collection, events_collection, es_dia_habil, FESTIVOS_DATES, cambios_de_eventos, escribir_tramos_lote
 except ImportError:
     # Fallback para pruebas si app no está disponible
     print("Warning: Could not import from app, running in standalone mode or mocks needed.")
     users_collection = None
     events_collection = None
+    cambios_de_eventos = escribir_tramos_lote = None
     es_dia_habil = lambda d: d.weekday() < 5
     FESTIVOS_DATES = set()
 
@@ -110,8 +114,10 @@ class ShiftGenerator:
         start_str = start_date.strftime("%Y-%m-%d")
         end_str = end_date.strftime("%Y-%m-%d")
         
+        # Tramos que solapan con el mes (una vacación puede empezar el mes anterior)
         query = {
-            "fecha_inicio": {"$gte": start_str, "$lte": end_str}
+            "fecha_inicio": {"$lte": end_str},
+            "fecha_fin": {"$gte": start_str}
         }
         
         events = list(events_collection.find(query))
@@ -121,7 +127,9 @@ class ShiftGenerator:
             # Expandir eventos de rango a días individuales para chequeo rápido
             f_inicio = datetime.datetime.strptime(e["fecha_inicio"], "%Y-%m-%d").date()
             f_fin = datetime.datetime.strptime(e["fecha_fin"], "%Y-%m-%d").date()
-            trabajador = e["trabajador"] # Nombre completo suele ser la clave actual
+            if not e.get("user_id"):
+                continue
+            trabajador = str(e["user_id"])
             
             curr = f_inicio
             while curr <= f_fin:
@@ -140,55 +148,28 @@ class ShiftGenerator:
         end_year = date(year, 12, 31).strftime("%Y-%m-%d")
         
         query = {
-            "fecha_inicio": {"$gte": start_year, "$lte": end_year}
+            "fecha_inicio": {"$lte": end_year},
+            "fecha_fin": {"$gte": start_year}
         }
-        events = list(events_collection.find(query))
-        
-        events = list(events_collection.find(query))
+        events = list(events_collection.find(query, {"user_id": 1, "tipo": 1, "fecha_inicio": 1, "fecha_fin": 1}))
         
         # Initialize dictionary of counters
         # counts[role_type][user_id] = count
         counts = defaultdict(lambda: defaultdict(int))
         
-        exclude_start = exclude_start_date.strftime("%Y-%m-%d")
-        exclude_end = exclude_end_date.strftime("%Y-%m-%d")
-        
-        for e in events:
-            # Skip events in the month we are rewriting
-            if exclude_start <= e["fecha_inicio"] <= exclude_end:
-                continue
-            
-            # Count Tardes (or others if needed later)
-            if e["tipo"] == "CADE Tardes":
-                # Use user ID if possible, but we might only have name. 
-                # Ideally we map name to ID, but current logic uses ID in counters.
-                # Let's try to find user by name to get ID, or fallback to name matching if we change logic.
-                # Wait, 'generate' uses 'str(u["_id"])' for keys.
-                # 'e["trabajador"]' is "Nombre Apellido".
-                # We need a map Name -> ID.
-                pass 
-                
-        # To strictly match IDs used in generate(), we need to map names from DB events to IDs.
-        # Since self.users is loaded, we can build a map.
-        name_to_id = {f"{u.get('nombre', '')} {u.get('apellidos', '')}".strip(): str(u["_id"]) for u in self.users}
+        year_start = date(year, 1, 1)
+        year_end = date(year, 12, 31)
+        counted_types = {"CADE Tardes", "Refuerzo Cade", "CADE 30", "CADE 50", "Mail"}
         
+        # Events reference their user by user_id, the same key generate() uses (str(u["_id"]))
+        # Each event is a run of days: count the days inside the year and outside the excluded range
         for e in events:
-             if exclude_start <= e["fecha_inicio"] <= exclude_end:
-                continue
-             
-             w_name = e["trabajador"]
-             if w_name in name_to_id:
-                 uid = name_to_id[w_name]
-                 if e["tipo"] == "CADE Tardes":
-                     counts["CADE Tardes"][uid] += 1
-                 elif e["tipo"] == "Refuerzo Cade":
-                     counts["Refuerzo Cade"][uid] += 1
-                 elif e["tipo"] == "CADE 30":
-                     counts["CADE 30"][uid] += 1
-                 elif e["tipo"] == "CADE 50":
-                     counts["CADE 50"][uid] += 1
-                 elif e["tipo"] == "Mail":
-                     counts["Mail"][uid] += 1
+             if not e.get("user_id") or e["tipo"] not in counted_types:
+                 continue
+             uid = str(e["user_id"])
+             for d in dias_evento(e):
+                 if year_start <= d <= year_end and not exclude_start_date <= d <= exclude_end_date:
+                     counts[e["tipo"]][uid] += 1
 
         return counts
 
@@ -196,12 +177,10 @@ class ShiftGenerator:
         """Devuelve usuarios disponibles (sin Vacaciones/Baja) para un día."""
         available = []
         for u in self.users:
-            full_name = f"{u.get('nombre', '')} {u.get('apellidos', '')}".strip()
-            
             # Check availability
             # Tipos de bloqueo: Vacaciones, Baja, Asuntos Propios...
             day_events = self.existing_events.get(day_str, {})
-            user_event = day_events.get(full_name)
+            user_event = day_events.get(str(u["_id"]))
             
             if user_event and user_event != "PIAS":
                 # Si tiene cualquier evento en BD (Vacaciones, Baja, CADE 30, etc) SALVO PIAS, NO está disponible
@@ -326,8 +305,7 @@ class ShiftGenerator:
                             continue
 
                     # Además verificar manuales
-                    full_name = f"{tc.get('nombre', '')} {tc.get('apellidos', '')}".strip()
-                    if full_name not in self.existing_events.get(day_str, {}):
+                    if uid not in self.existing_events.get(day_str, {}):
                         tarde_finalists.append(tc)
 
             # Ordenar por Sticky (Misma tarea ayer) y luego carga
@@ -361,13 +339,12 @@ class ShiftGenerator:
             absence_types = ["Vacaciones", "Baja", "Ausencia", "Ausente", "Baja Médica"]
             
             for u in self.users:
-                full_name = f"{u.get('nombre', '')} {u.get('apellidos', '')}".strip()
                 skills = u.get("skills", [])
                 
                 # Check constraints logic: If user with Flex/Reduccion is WORKING today
                 if "Flexibilidad" in skills or "Reducción" in skills:
                     day_events = self.existing_events.get(day_str, {})
-                    user_status = day_events.get(full_name)
+                    user_status = day_events.get(str(u["_id"]))
                     
                     # If user has an absence event, they are NOT working -> No Refuerzo needed for them
                     if user_status in absence_types:
@@ -589,6 +566,8 @@ class ShiftGenerator:
         full_name = f"{user.get('nombre', '')} {user.get('apellidos', '')}".strip()
         self.generated_events.append({
             "trabajador": full_name,
+            # str so the preview can travel as JSON; converted back to ObjectId on save
+            "user_id": str(user["_id"]) if "_id" in user else None,
             "fecha_inicio": date_str,
             "fecha_fin": date_str,
             "tipo": tipo
@@ -613,9 +592,10 @@ class ShiftGenerator:
         self.log(f"Saving {len(self.generated_events)} events to DB...")
         # TODO: Borrar eventos generados previos si se re-ejecuta? 
         # Por seguridad, el flujo debería ser: Preview en UI -> Confirmar -> Save.
-        # Aquí solo implemento la inserción.
+        # Aquí solo implemento la inserción (tramos por usuario y tipo: re-ejecutar no duplica).
         if events_collection is not None:
-            events_collection.insert_many(self.generated_events)
+            users = {str(u["_id"]): u for u in self.users if "_id" in u}
+            escribir_tramos_lote(cambios_de_eventos(self.generated_events, users))
             self.log("Saved successfully.")
 
     def repair_schedule(self, start_date_str, end_date_str, target_user_id):
@@ -645,15 +625,17 @@ class ShiftGenerator:
 
         # 1. DELETE TARGET USER EVENTS IN RANGE
         delete_query = {
-            "trabajador": full_name_target,
-            "fecha_inicio": {"$gte": start_date_str, "$lte": end_date_str},
+            "user_id": target_user["_id"],
+            "fecha_inicio": {"$lte": end_date_str},
+            "fecha_fin": {"$gte": start_date_str},
             # Optional: Restrict types to avoid deleting vacations? 
             # For "Regeneration", we assume we want to clear calculated shifts.
             # Keeping "Vacaciones" safe usually.
             "tipo": {"$nin": ["Vacaciones", "Baja", "Baja Médica", "Ausencia"]} 
         }
-        delete_result = events_collection.delete_many(delete_query)
-        summary_changes.append(f"Eliminados {delete_result.deleted_count} eventos previos de {full_name_target}.")
+        # Runs that stick out of the range are trimmed, not deleted
+        deleted_count = self._carve(events_collection.find(delete_query), dias_entre(start_date, end_date))
+        summary_changes.append(f"Eliminados {deleted_count} eventos previos de {full_name_target}.")
 
         # 2. LOAD CONTEXT (Just like Generate)
         # Need to query day by day to fix deficits/surpluses
@@ -665,6 +647,11 @@ class ShiftGenerator:
         # Exclude the repair range from history to avoid double counting the removed events? 
         # Yes, passing the range to exclude.
         self.fetch_data() # Load users
+        target_uid = str(target_user["_id"])
+        users_by_id = {str(u["_id"]): u for u in self.users}
+        # Current names for the log messages (events only carry the name they were written with)
+        names_by_id = {uid: f"{u.get('nombre', '')} {u.get('apellidos', '')}".strip() for uid, u in users_by_id.items()}
+        names_by_id[target_uid] = full_name_target
         all_counts = self.get_annual_balance(year, start_date, end_date)
         
         # Mapping for counters
@@ -686,18 +673,19 @@ class ShiftGenerator:
                 continue
             
             # Load events for this day
-            day_events = list(events_collection.find({"fecha_inicio": day_str, "fecha_fin": day_str}))
+            day_events = list(events_collection.find({"fecha_inicio": {"$lte": day_str}, "fecha_fin": {"$gte": day_str}}))
             
             # Counts for this day
             type_counts = defaultdict(int)
-            users_with_event = {} # Name -> EventType
-            event_map = {} # Name -> EventID (for deletion)
+            users_with_event = {} # UserID (str) -> EventType
+            event_map = {} # UserID (str) -> Event (for deletion)
             
             for e in day_events:
                 t = e["tipo"]
                 type_counts[t] += 1
-                users_with_event[e["trabajador"]] = t
-                event_map[e["trabajador"]] = e["_id"]
+                users_with_event[str(e.get("user_id"))] = t
+                event_map[str(e.get("user_id"))] = e
+                names_by_id.setdefault(str(e.get("user_id")), e.get("trabajador", ""))
 
             # --- STEP 1: FORCE FIXED ROLE ---
             fixed_role = target_user.get("fixed_shift_role")
@@ -708,16 +696,16 @@ class ShiftGenerator:
                 # Check if user is absent (Vacations/Baja) - Is "Vacaciones" in DB?
                 # We didn't delete Vacaciones, so if it exists, `users_with_event` has it.
                 
-                current_status = users_with_event.get(full_name_target)
+                current_status = users_with_event.get(target_uid)
                 if current_status in ["Vacaciones", "Baja", "Baja Médica", "Ausencia"]:
                     # User is absent, cannot force fixed role.
                     curr += timedelta(days=1)
                     continue
                 
                 # User is available (we deleted their other shifts). Assign Fixed Role.
-                self._insert_single_event(full_name_target, day_str, fixed_role)
+                self._insert_single_event(target_user, day_str, fixed_role)
                 type_counts[fixed_role] += 1
-                users_with_event[full_name_target] = fixed_role
+                users_with_event[target_uid] = fixed_role
                 msg = f"{day_str}: Asignado Rol Fijo '{fixed_role}' a {full_name_target}"
                 self.log(f"   [Repair] {msg}")
                 summary_changes.append(msg)
@@ -745,22 +733,21 @@ class ShiftGenerator:
                     
                     candidates_to_remove = []
                     
-                    for u_name, u_role in users_with_event.items():
+                    for u_id, u_role in users_with_event.items():
                         if u_role == role:
                             # Check if it's the target user
-                            if u_name == full_name_target:
+                            if u_id == target_uid:
                                 continue # Don't remove the one we just fixed!
                             
                             # Check if this user has this as a FIXED role
-                            # Need to match name to user object
-                            u_obj = next((u for u in self.users if f"{u.get('nombre','')} {u.get('apellidos','')}".strip() == u_name), None)
+                            u_obj = users_by_id.get(u_id)
                             if u_obj:
                                 u_fixed = u_obj.get("fixed_shift_role")
                                 if isinstance(u_fixed, list): u_fixed = u_fixed[0] if u_fixed else None
                                 if u_fixed == role:
                                     continue # Protected by Fixed Role
                                     
-                            candidates_to_remove.append(u_obj or u_name)
+                            candidates_to_remove.append(u_obj or u_id)
 
                     # Sort candidates by Fairness (Highest Balance = Most likely to be removed)
                     # If u is string (not found), put at end?
@@ -774,16 +761,17 @@ class ShiftGenerator:
                     
                     for i in range(min(excess, len(candidates_to_remove))):
                         victim = candidates_to_remove[i]
-                        v_name = f"{victim.get('nombre','')} {victim.get('apellidos','')}".strip() if isinstance(victim, dict) else victim
+                        v_id = str(victim["_id"]) if isinstance(victim, dict) else victim
+                        v_name = names_by_id.get(v_id, v_id)
                         
-                        # Delete event
-                        if v_name in event_map:
-                            events_collection.delete_one({"_id": event_map[v_name]})
+                        # Delete event (only this day of its run)
+                        if v_id in event_map:
+                            self._carve([event_map[v_id]], [curr])
                             msg = f"{day_str}: Desplazado {v_name} de '{role}' para resolver exceso (Equidad Histórica)"
                             self.log(f"   [Repair] {msg}")
                             summary_changes.append(msg)
                             type_counts[role] -= 1
-                            del users_with_event[v_name] # Now they are effectively PIAS/Available
+                            del users_with_event[v_id] # Now they are effectively PIAS/Available
                             
             # --- STEP 3: HANDLE UNDER-SUBSCRIPTION (GAP FILLING) ---
             # Check deficits
@@ -796,8 +784,7 @@ class ShiftGenerator:
                     # Get all users
                     avail_candidates = []
                     for u in self.users:
-                        u_name = f"{u.get('nombre','')} {u.get('apellidos','')}".strip()
-                        if u_name not in users_with_event: # Is Available
+                        if str(u["_id"]) not in users_with_event: # Is Available
                             # Check Skill
                             skills = u.get("skills", [])
                             role_check = role
@@ -824,24 +811,39 @@ class ShiftGenerator:
                     # Take top needed
                     for i in range(min(deficit, len(avail_candidates))):
                         winner = avail_candidates[i]
-                        w_name = f"{winner.get('nombre','')} {winner.get('apellidos','')}".strip()
-                        self._insert_single_event(w_name, day_str, role)
+                        w_name = names_by_id[str(winner["_id"])]
+                        self._insert_single_event(winner, day_str, role)
                         msg = f"{day_str}: Asignado {w_name} a '{role}' para cubrir hueco"
                         self.log(f"   [Repair] {msg}")
                         summary_changes.append(msg)
-                        users_with_event[w_name] = role # Mark assigned
+                        users_with_event[str(winner["_id"])] = role # Mark assigned
                         
             curr += timedelta(days=1)
             
         return True, summary_changes
 
-    def _insert_single_event(self, worker_name, date_str, tipo):
-        events_collection.insert_one({
-            "trabajador": worker_name,
-            "fecha_inicio": date_str,
-            "fecha_fin": date_str,
-            "tipo": tipo
-        })
+    def _carve(self, events, days):
+        """Removes `days` from the given events, reinserting what is left of each run."""
+        ids, leftovers = recortar(events, days)
+        if not ids:
+            return 0
+        operations = [DeleteMany({"_id": {"$in": ids}})]
+        for event, start, end in leftovers:
+            doc = {k: v for k, v in event.items() if k != "_id"}
+            doc["fecha_inicio"] = start.strftime("%Y-%m-%d")
+            doc["fecha_fin"] = end.strftime("%Y-%m-%d")
+            operations.append(self._upsert(dict(doc, **campos_fecha(start, end))))
+        events_collection.bulk_write(operations, ordered=True)
+        return len(ids)
+
+    @staticmethod
+    def _upsert(doc):
+        """Idempotent write on the unique key (user_id, dia_inicio, tipo)."""
+        return UpdateOne(clave_unica(doc), {"$set": doc}, upsert=True)
+
+    def _insert_single_event(self, user, date_str, tipo):
+        # Merged with any saved run of the same type that covers or touches the day
+        escribir_tramos_lote([(user, tipo, dias_entre(date_str, date_str), (), ())])
 
     def save_results(self):
         """Persiste los resultados a Mongo."""
@@ -851,9 +853,10 @@ class ShiftGenerator:
         self.log(f"Saving {len(self.generated_events)} events to DB...")
         # TODO: Borrar eventos generados previos si se re-ejecuta? 
         # Por seguridad, el flujo debería ser: Preview en UI -> Confirmar -> Save.
-        # Aquí solo implemento la inserción.
+        # Aquí solo implemento la inserción (tramos por usuario y tipo: re-ejecutar no duplica).
         if events_collection is not None:
-            events_collection.insert_many(self.generated_events)
+            users = {str(u["_id"]): u for u in self.users if "_id" in u}
+            escribir_tramos_lote(cambios_de_eventos(self.generated_events, users))
             self.log("Saved successfully.")
 
 # Bloque de prueba standalone
@@ -0,0 +1,42 @@
+from cache_eventos import CacheMemoria, meses_entre
+
+
+def segmento(mes, trabajadores, version=1):
+    return {"data": (b"[]", b"{}"), "version": version, "timestamp": 0, "mes": mes, "trabajadores": trabajadores}
+
+
+def test_invalidar_solo_meses_y_trabajadores_afectados():
+    cache = CacheMemoria()
+    cache.set("ana-marzo", segmento("2025-03", ["Ana Pérez"]))
+    cache.set("luis-marzo", segmento("2025-03", ["Luis Gil"]))
+    cache.set("todos-abril", segmento("2025-04", ["Ana Pérez", "Luis Gil"]))
+
+    cache.invalidar(2, ["Ana Pérez"], "2025-03", "2025-03")
+
+    assert cache.get("ana-marzo") is None
+    assert cache.get("luis-marzo") is not None
+    assert cache.get("todos-abril") is not None
+
+
+def test_no_guarda_segmentos_calculados_antes_de_invalidar():
+    cache = CacheMemoria()
+    cache.invalidar(5, ["Ana Pérez"], "2025-03", "2025-04")
+
+    cache.set("antiguo", segmento("2025-03", ["Luis Gil"], version=4))
+    cache.set("otro-mes", segmento("2025-05", ["Luis Gil"], version=4))
+    cache.set("nuevo", segmento("2025-03", ["Luis Gil"], version=5))
+
+    assert cache.get("antiguo") is None
+    assert cache.get("otro-mes") is not None
+    assert cache.get("nuevo") is not None
+
+
+def test_meses_entre_cruza_de_anio():
+    assert meses_entre("2025-11", "2026-02") == ["2025-11", "2025-12", "2026-01", "2026-02"]
+
+
+if __name__ == "__main__":
+    test_invalidar_solo_meses_y_trabajadores_afectados()
+    test_no_guarda_segmentos_calculados_antes_de_invalidar()
+    test_meses_entre_cruza_de_anio()
+    print("PASS: caché de eventos")
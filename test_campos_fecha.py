@@ -0,0 +1,35 @@
+from datetime import date
+
+from campos_fecha import ORDINAL_EPOCH, campos_fecha, clave_unica
+
+
+def test_campos_de_un_tramo():
+    campos = campos_fecha("2025-03-03", "2025-03-07")
+    assert campos == {
+        "dia_inicio": date(2025, 3, 3).toordinal(),
+        "dia_fin": date(2025, 3, 7).toordinal(),
+    }
+
+
+def test_sin_fecha_fin_es_un_dia():
+    campos = campos_fecha("2027-01-02", None)
+    assert campos["dia_fin"] == campos["dia_inicio"] == date(2027, 1, 2).toordinal()
+
+
+def test_fecha_invalida_y_constantes():
+    assert campos_fecha("", None) == {}
+    assert date(1970, 1, 1).toordinal() == ORDINAL_EPOCH
+
+
+def test_clave_unica_del_upsert():
+    evento = {"user_id": 7, "trabajador": "Ana Pérez", "tipo": "Mail", "fecha_inicio": "2025-03-03"}
+    evento.update(campos_fecha(evento["fecha_inicio"], None))
+    assert clave_unica(evento) == {"user_id": 7, "dia_inicio": date(2025, 3, 3).toordinal(), "tipo": "Mail"}
+
+
+if __name__ == "__main__":
+    test_campos_de_un_tramo()
+    test_sin_fecha_fin_es_un_dia()
+    test_fecha_invalida_y_constantes()
+    test_clave_unica_del_upsert()
+    print("PASS: campos de fecha")
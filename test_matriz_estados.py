@@ -0,0 +1,146 @@
+from datetime import date
+
+from matriz_estados import MatrizEstados
+
+PRIORIDAD = ["Ausencia", "Baja", "CADE 30", "CADE 50", "CADE Tardes", "Guardia CADE", "Refuerzo Cade", "Mail", "Vacaciones"]
+
+
+class MockCollection:
+    """Colección mínima que entiende los filtros que usa la matriz."""
+    def __init__(self, data):
+        self.data = data
+
+    def find(self, query=None, projection=None):
+        query = query or {}
+        resultado = []
+        for doc in self.data:
+            if any(doc.get(campo) not in query[campo]["$in"] for campo in ("trabajador", "user_id") if campo in query):
+                continue
+            if "fecha_inicio" in query and doc["fecha_inicio"] > query["fecha_inicio"]["$lte"]:
+                continue
+            if "fecha_fin" in query and doc["fecha_fin"] < query["fecha_fin"]["$gte"]:
+                continue
+            resultado.append(dict(doc))
+        return resultado
+
+
+def evento(trabajador, inicio, fin, tipo):
+    return {"trabajador": trabajador, "fecha_inicio": inicio, "fecha_fin": fin, "tipo": tipo}
+
+
+def crear_matriz(eventos):
+    return MatrizEstados(
+        MockCollection(eventos), PRIORIDAD, lambda d: d.weekday() < 5,
+        date(2025, 1, 1), date(2025, 12, 31)
+    )
+
+
+def test_prioridad_y_dias_libres():
+    matriz = crear_matriz([
+        evento("Ana Pérez", "2025-03-03", "2025-03-07", "Vacaciones"),
+        evento("Ana Pérez", "2025-03-05", "2025-03-05", "Baja"),
+    ])
+    codigos = matriz.codigos_prioritarios(["Ana Pérez", "Sin Eventos"], date(2025, 3, 3), date(2025, 3, 10))
+    vacaciones = PRIORIDAD.index("Vacaciones")
+    baja = PRIORIDAD.index("Baja")
+    assert codigos[0] == [vacaciones, vacaciones, baja, vacaciones, vacaciones, -1, -1, -1]
+    assert codigos[1] == [-1] * 8
+
+
+def test_recargar_solo_celdas_afectadas():
+    eventos = [
+        evento("Ana Pérez", "2025-03-03", "2025-03-03", "CADE 30"),
+        evento("Luis Gil", "2025-03-03", "2025-03-03", "Mail"),
+    ]
+    matriz = crear_matriz(eventos)
+    matriz.cargar()
+
+    eventos[0]["tipo"] = "CADE 50"
+    eventos[1]["tipo"] = "Baja"  # No se recarga: la matriz debe conservar el valor previo
+    matriz.recargar(["Ana Pérez"], "2025-03-03", "2025-03-03")
+
+    codigos = matriz.codigos_prioritarios(["Ana Pérez", "Luis Gil"], date(2025, 3, 3), date(2025, 3, 3))
+    assert codigos == [[PRIORIDAD.index("CADE 50")], [PRIORIDAD.index("Mail")]]
+
+
+def test_conteos_solo_dias_habiles():
+    matriz = crear_matriz([
+        evento("Ana Pérez", "2025-03-06", "2025-03-11", "Vacaciones"),  # jue -> mar (4 hábiles)
+        evento("Ana Pérez", "2025-03-06", "2025-03-06", "Tipo Nuevo"),
+    ])
+    conteos = matriz.contar_por_tipo(None, date(2025, 3, 1), date(2025, 3, 31))
+    assert conteos == {"Ana Pérez": {"Vacaciones": 4, "Tipo Nuevo": 1}}
+    assert set(matriz.tipos_presentes()) == {"Vacaciones", "Tipo Nuevo"}
+
+
+def test_tipos_por_dia_fuera_del_rango_base():
+    matriz = crear_matriz([evento("Ana Pérez", "2026-02-02", "2026-02-02", "Mail")])
+    por_dia = matriz.tipos_por_dia(date(2026, 2, 1), date(2026, 2, 28))
+    assert por_dia == {date(2026, 2, 2): {"Mail": ["Ana Pérez"]}}
+
+
+def test_filas_por_user_id_sobreviven_a_un_renombrado():
+    eventos = [dict(evento("Ana Pérez", "2025-03-03", "2025-03-03", "Mail"), user_id=101)]
+    matriz = MatrizEstados(
+        MockCollection(eventos), PRIORIDAD, lambda d: d.weekday() < 5,
+        date(2025, 1, 1), date(2025, 12, 31), campo="user_id", valor_consulta=int
+    )
+    matriz.cargar()
+
+    eventos[0]["trabajador"] = "Ana Pérez Ruiz"
+    eventos[0]["tipo"] = "Baja"
+    matriz.recargar(["101"], "2025-03-03", "2025-03-03")
+
+    codigos = matriz.codigos_prioritarios(["101"], date(2025, 3, 3), date(2025, 3, 3))
+    assert codigos == [[PRIORIDAD.index("Baja")]]
+
+
+def test_conflictos_solo_dias_habiles_con_varios_tipos():
+    matriz = crear_matriz([
+        evento("Ana Pérez", "2025-03-06", "2025-03-10", "Vacaciones"),  # jue -> lun
+        evento("Ana Pérez", "2025-03-07", "2025-03-09", "Mail"),  # vie -> dom
+        evento("Luis Gil", "2025-03-07", "2025-03-07", "Mail"),
+    ])
+    assert matriz.conflictos() == [(date(2025, 3, 7), "Ana Pérez", ["Mail", "Vacaciones"], 2)]
+    assert matriz.hay_conflictos()
+    assert not matriz.hay_conflictos(date(2025, 3, 8), date(2025, 3, 31))
+
+
+def test_conflictos_paginados_por_clave():
+    eventos = []
+    for trabajador in ("Ana Pérez", "Luis Gil"):
+        eventos.append(evento(trabajador, "2025-03-03", "2025-03-04", "Vacaciones"))
+        eventos.append(evento(trabajador, "2025-03-03", "2025-03-04", "Mail"))
+    matriz = crear_matriz(eventos)
+
+    primera = matriz.conflictos(date(2025, 3, 1), date(2025, 3, 31), limite=3)
+    assert [(dia.day, t) for dia, t, *_ in primera] == [(3, "Ana Pérez"), (3, "Luis Gil"), (4, "Ana Pérez")]
+    segunda = matriz.conflictos(date(2025, 3, 1), date(2025, 3, 31), despues=primera[-1][:2], limite=3)
+    assert [(dia.day, t) for dia, t, *_ in segunda] == [(4, "Luis Gil")]
+    assert len(matriz.conflictos(trabajadores=["Luis Gil"])) == 2
+
+
+
+def test_conflictos_tramos_solapados_del_mismo_tipo():
+    matriz = crear_matriz([
+        evento("Ana Pérez", "2025-03-03", "2025-03-05", "Vacaciones"),  # lun -> mié
+        evento("Ana Pérez", "2025-03-05", "2025-03-07", "Vacaciones"),  # mié -> vie, otro inicio
+    ])
+    assert matriz.conflictos() == [(date(2025, 3, 5), "Ana Pérez", ["Vacaciones"], 2)]
+
+    matriz.collection.data.pop()
+    matriz.recargar(["Ana Pérez"], "2025-03-05", "2025-03-07")
+    assert not matriz.hay_conflictos()
+    assert matriz.contar_por_tipo() == {"Ana Pérez": {"Vacaciones": 3}}
+
+
+if __name__ == "__main__":
+    test_prioridad_y_dias_libres()
+    test_recargar_solo_celdas_afectadas()
+    test_conteos_solo_dias_habiles()
+    test_tipos_por_dia_fuera_del_rango_base()
+    test_filas_por_user_id_sobreviven_a_un_renombrado()
+    test_conflictos_solo_dias_habiles_con_varios_tipos()
+    test_conflictos_paginados_por_clave()
+    test_conflictos_tramos_solapados_del_mismo_tipo()
+    print("PASS: matriz de estados")
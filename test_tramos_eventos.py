@@ -0,0 +1,67 @@
+from datetime import date
+
+from tramos_eventos import dias_entre, expandir, planificar, recortar, tramos
+
+
+def es_dia_habil(dia):
+    return dia.weekday() < 5
+
+
+def evento(_id, inicio, fin, tipo="Vacaciones"):
+    return {"_id": _id, "fecha_inicio": inicio, "fecha_fin": fin, "tipo": tipo}
+
+
+def test_tramos_de_dias_consecutivos():
+    dias = [d for d in dias_entre("2025-03-06", "2025-03-12") if es_dia_habil(d)]  # jue -> mié
+    assert tramos(dias) == [
+        (date(2025, 3, 6), date(2025, 3, 7)),
+        (date(2025, 3, 10), date(2025, 3, 12)),
+    ]
+    assert tramos([date(2025, 3, 3), date(2025, 3, 3)]) == [(date(2025, 3, 3), date(2025, 3, 3))]
+    assert dias_entre("2025-03-05", "2025-03-04") == []
+
+
+def test_recortar_parte_el_tramo():
+    eventos = [evento(1, "2025-03-03", "2025-03-07"), evento(2, "2025-03-10", "2025-03-10")]
+    ids, restos = recortar(eventos, [date(2025, 3, 5)])
+    assert ids == [1]
+    assert [(e["_id"], ini, fin) for e, ini, fin in restos] == [
+        (1, date(2025, 3, 3), date(2025, 3, 4)),
+        (1, date(2025, 3, 6), date(2025, 3, 7)),
+    ]
+
+
+def test_expandir_solo_dias_habiles_sin_repetir():
+    eventos = [evento(1, "2025-03-07", "2025-03-10"), evento(2, "2025-03-10", "2025-03-10")]
+    dias = expandir(eventos, es_dia_habil)
+    assert [(dia, e["_id"]) for dia, e in dias] == [(date(2025, 3, 7), 1), (date(2025, 3, 10), 1)]
+
+
+def test_planificar_solo_escribe_la_diferencia():
+    guardados = [evento(1, "2025-03-03", "2025-03-07"), evento(2, "2025-03-10", "2025-03-11")]
+    semana = dias_entre("2025-03-03", "2025-03-07")
+    assert planificar(guardados, "Vacaciones", semana) == ([], [], [])  # Repetir la petición no escribe nada
+
+    ids, restos, nuevos = planificar(guardados, "Vacaciones", [date(2025, 3, 12)])
+    assert ids == [2] and restos == []
+    assert nuevos == [(date(2025, 3, 10), date(2025, 3, 12))]
+
+
+def test_planificar_recorta_otros_tipos():
+    guardados = [evento(1, "2025-03-03", "2025-03-07"), evento(2, "2025-03-05", "2025-03-05", "Mail")]
+    ids, restos, nuevos = planificar(guardados, "Baja", [date(2025, 3, 5)], ["Vacaciones", "Mail"], [date(2025, 3, 5)])
+    assert sorted(ids) == [1, 2]
+    assert [(e["_id"], ini, fin) for e, ini, fin in restos] == [
+        (1, date(2025, 3, 3), date(2025, 3, 4)),
+        (1, date(2025, 3, 6), date(2025, 3, 7)),
+    ]
+    assert nuevos == [(date(2025, 3, 5), date(2025, 3, 5))]
+
+
+if __name__ == "__main__":
+    test_tramos_de_dias_consecutivos()
+    test_recortar_parte_el_tramo()
+    test_expandir_solo_dias_habiles_sin_repetir()
+    test_planificar_solo_escribe_la_diferencia()
+    test_planificar_recorta_otros_tipos()
+    print("PASS: tramos de eventos")
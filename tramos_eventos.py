@@ -0,0 +1,109 @@
+"""Eventos guardados como tramos: un documento por racha de días consecutivos.
+
+Las ausencias de varios días (vacaciones, bajas, estados asignados en bloque) se guardan
+como un único documento con `fecha_inicio`/`fecha_fin` en lugar de uno por día. Al crearlos
+sólo se incluyen días hábiles, así que cada fin de semana o festivo parte el tramo. Para
+quitar días sueltos se recorta: el documento se sustituye por los tramos que quedan.
+"""
+from datetime import date, datetime, timedelta
+
+
+def a_fecha(valor):
+    """`date` a partir de 'YYYY-MM-DD', datetime o date (None si no se puede interpretar)."""
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    try:
+        return datetime.strptime(str(valor)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def dias_entre(inicio, fin):
+    """Todos los días del rango cerrado [inicio, fin]."""
+    inicio, fin = a_fecha(inicio), a_fecha(fin)
+    if inicio is None or fin is None:
+        return []
+    return [inicio + timedelta(days=i) for i in range((fin - inicio).days + 1)]
+
+
+def dias_evento(evento):
+    """Días que cubre un documento de evento."""
+    return dias_entre(evento.get("fecha_inicio"), evento.get("fecha_fin") or evento.get("fecha_inicio"))
+
+
+def tramos(dias):
+    """Agrupa días sueltos en tramos de días consecutivos: [(inicio, fin)] ordenados."""
+    resultado = []
+    for dia in sorted(set(dias)):
+        if resultado and dia == resultado[-1][1] + timedelta(days=1):
+            resultado[-1] = (resultado[-1][0], dia)
+        else:
+            resultado.append((dia, dia))
+    return resultado
+
+
+def recortar(eventos, dias_a_quitar):
+    """Quita `dias_a_quitar` de los eventos.
+
+    Devuelve (ids a borrar, restos) donde cada resto es (evento original, inicio, fin) con
+    un tramo que hay que volver a insertar. Los eventos que no tocan esos días no aparecen.
+    """
+    quitar = set(dias_a_quitar)
+    ids = []
+    restos = []
+    for evento in eventos:
+        propios = set(dias_evento(evento))
+        if propios.isdisjoint(quitar):
+            continue
+        ids.append(evento["_id"])
+        restos.extend((evento, inicio, fin) for inicio, fin in tramos(propios - quitar))
+    return ids, restos
+
+
+def expandir(eventos, es_dia_habil):
+    """Un registro por día hábil a partir de los tramos: [(día, evento)] sin días repetidos."""
+    vistos = {}
+    for evento in eventos:
+        for dia in dias_evento(evento):
+            if dia not in vistos and es_dia_habil(dia):
+                vistos[dia] = evento
+    return sorted(vistos.items(), key=lambda par: par[0])
+
+
+def planificar(eventos, tipo, dias, tipos_a_quitar=(), dias_a_quitar=()):
+    """Diferencia entre los tramos guardados y el resultado de poner `tipo` en `dias`.
+
+    `eventos` son los tramos ya leídos del usuario que tocan los días afectados (+-1 día).
+    Se quitan `dias_a_quitar` de los eventos de `tipos_a_quitar` y los días nuevos se fusionan
+    con los tramos de `tipo`. Los tramos que ya coinciden con el resultado no se tocan.
+
+    Devuelve (ids a borrar, restos, nuevos): restos son (evento, inicio, fin) que quedan de un
+    tramo recortado y nuevos son (inicio, fin) de `tipo` que hay que escribir.
+    """
+    dias = set(dias) if tipo else set()
+    quitar = set(dias_a_quitar)
+    tipos_a_quitar = set(tipos_a_quitar)
+    ids = []
+    restos = []
+    intactos = {}
+    for evento in eventos:
+        propios = set(dias_evento(evento))
+        restantes = propios - quitar if evento["tipo"] in tipos_a_quitar else propios
+        if dias and evento["tipo"] == tipo:
+            dias |= restantes
+            if restantes == propios and (min(propios), max(propios)) not in intactos:
+                intactos[(min(propios), max(propios))] = evento["_id"]
+            else:
+                ids.append(evento["_id"])
+        elif restantes != propios:
+            ids.append(evento["_id"])
+            restos.extend((evento, inicio, fin) for inicio, fin in tramos(restantes))
+
+    nuevos = []
+    for tramo in tramos(dias):
+        if intactos.pop(tramo, None) is None:
+            nuevos.append(tramo)
+    ids.extend(intactos.values())  # Tramos de `tipo` absorbidos por uno más largo
+    return ids, restos, nuevos